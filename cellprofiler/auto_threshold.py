@@ -0,0 +1,627 @@
+'''
+ImageJ's automatic thresholding methods, shared by the MultiThreshold plugin
+and scripts/check_auto_threshold.py.
+
+Ports of ImageJ's AutoThresholder (G. Landini) and of Antti Niemisto's
+HistThresh toolbox (maxLikelihood), with Rosin's unimodal method for rosin.
+They only need NumPy, so they run both in CellProfiler (Python 2) and in the
+scripts (Python 3).
+'''
+
+import numpy as np
+
+# Smallest double ImageJ tells apart from zero (DBL_EPSILON)
+EPSILON = 2.220446049250313e-16
+
+# Iterations after which the smoothing and iterative methods give up
+MAX_ITERATIONS = 10000
+
+# Elements of the blocks in which huang and shanbhag compare every candidate
+# bin to every nonempty bin
+BLOCK_SIZE = 2 ** 20
+
+# Relative difference under which two entropies may be a tie in ImageJ,
+# rounded apart by the vectorized sums
+TIE_TOLERANCE = 1e-9
+
+
+class ImageHistogram(object):
+    '''
+    The histogram of an image, with nbins equal bins over the range of its
+    (masked) pixels, and the bin of every pixel.
+
+    The bins are kept as uint8 (uint16 for more than 256 bins), so the mask
+    of any threshold bin is a comparison of small integers.
+    '''
+
+    def __init__(self, pixels, nbins, mask=None):
+        values = pixels[mask] if mask is not None else pixels
+
+        self.low, high = (float(values.min()), float(values.max())) if values.size > 0 else (0.0, 1.0)
+        self.width     = (high - self.low) / nbins if high > self.low else 1.0 / nbins
+        self.mask      = mask
+
+        bins = np.floor((pixels - self.low) / self.width)
+        np.clip(bins, 0, nbins - 1, out=bins)
+        self.bins = bins.astype(np.uint8 if nbins <= 256 else np.uint16)
+
+        inside = self.bins[mask] if mask is not None else self.bins.ravel()
+        self.counts = np.bincount(inside, minlength=nbins).astype(np.int64)
+
+    def threshold(self, bin):
+        ''' Returns the intensity above which the pixels are over a threshold bin. '''
+        return self.low + (bin + 1) * self.width
+
+    def binarize(self, bin):
+        ''' Returns the mask of the pixels in the bins above a threshold bin. '''
+        binary = self.bins > bin
+        if self.mask is not None:
+            binary &= self.mask
+        return binary
+
+
+def threshold_bin(method, counts):
+    '''
+    Returns the threshold bin of a method (one of METHODS) for a histogram.
+    The pixels above it are the foreground. Like ImageJ, -1 means that the
+    method found no threshold.
+
+    The bin is clamped to [-1, N - 1], as ImageJ's triangle can return N and
+    a degenerate maxLikelihood any int.
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+
+    # A single nonempty bin has nothing to separate
+    nonzero = np.flatnonzero(counts)
+    if len(nonzero) < 2:
+        return int(nonzero[0]) if len(nonzero) > 0 else -1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bin = int(METHODS[method](counts))
+    return min(max(bin, -1), len(counts) - 1)
+
+
+# Helper functions..............................................................
+def _java_int(value):
+    ''' Casts a float to int like Java: NaN is 0 and the infinities saturate. '''
+    if np.isnan(value):
+        return 0
+    return int(np.clip(value, -2 ** 31, 2 ** 31 - 1))
+
+
+def _partial_sums(data):
+    ''' Returns A, B and C of the HistThresh toolbox: the cumulative count, first and second moments. '''
+    index = np.arange(len(data), dtype=np.float64)
+    return np.cumsum(data, dtype=np.float64), np.cumsum(index * data), np.cumsum(index * index * data)
+
+
+def _normalized(data):
+    ''' Returns the normalized histogram and its cumulative sum (P1) and complement (P2). '''
+    norm_histo = data / float(data.sum())
+    p1 = np.cumsum(norm_histo)
+    return norm_histo, p1, 1.0 - p1
+
+
+def _nonzero_range(p1, p2):
+    ''' Returns the first and last bins ImageJ's entropy methods look at. '''
+    first_bin = np.flatnonzero(np.abs(p1) >= EPSILON)
+    first_bin = first_bin[0] if len(first_bin) > 0 else 0
+    last_bin  = np.flatnonzero(np.abs(p2[first_bin:]) >= EPSILON)
+    last_bin  = first_bin + last_bin[-1] if len(last_bin) > 0 else len(p1) - 1
+    return first_bin, last_bin
+
+
+def _blocks(candidates, width):
+    ''' Yields the start and the column of every block of candidates, sized to about BLOCK_SIZE elements against width bins. '''
+    rows = max(1, BLOCK_SIZE // max(width, 1))
+    for start in range(0, len(candidates), rows):
+        yield start, candidates[start:start + rows, np.newaxis]
+
+
+def _ordered_sum(x):
+    ''' Returns the sum of x in order, like ImageJ's loops (np.sum adds pairwise). '''
+    return np.cumsum(x)[-1] if len(x) > 0 else 0.0
+
+
+def _first_max(data, it, criterion, exact, start, default):
+    '''
+    Returns the first bin of it with the largest criterion above start, as
+    ImageJ's loops find it, or default.
+
+    The vectorized criterion rounds differently from ImageJ's, which can
+    break its ties (e.g. between the two splits of counts 1, 2, 1). So the
+    nonempty bins within TIE_TOLERANCE of its maximum are compared again by
+    exact(bin), the criterion summed in ImageJ's order.
+    '''
+    valid = np.where(np.isnan(criterion), -np.inf, criterion)
+    best = np.max(valid)
+    if not np.isfinite(best):
+        return default
+
+    near = it[(valid >= best - TIE_TOLERANCE * max(abs(best), 1.0)) & (data[it] > 0)]
+    threshold, max_crit = default, start
+    for t in near:
+        crit = exact(t)
+        if crit > max_crit:
+            threshold, max_crit = int(t), crit
+    return threshold
+
+
+def _bimodal(y):
+    ''' Returns whether a histogram has exactly two local maxima. '''
+    return np.count_nonzero((y[:-2] < y[1:-1]) & (y[2:] < y[1:-1])) == 2
+
+
+def _smooth_until_bimodal(data):
+    ''' Smooths a histogram with a 3 point running mean (0 outside) until it is bimodal, or returns None. '''
+    histo = data.astype(np.float64)
+    for _ in range(MAX_ITERATIONS):
+        if _bimodal(histo):
+            return histo
+        padded = np.concatenate(([0.0], histo, [0.0]))
+        histo  = (padded[:-2] + padded[1:-1] + padded[2:]) / 3
+    return None
+
+
+# Thresholding methods..........................................................
+def huang(data):
+    n = len(data)
+    index = np.arange(n, dtype=np.float64)
+    nonzero = np.flatnonzero(data)
+    first_bin, last_bin = nonzero[0], nonzero[-1]
+    term = 1.0 / (last_bin - first_bin)
+
+    # Mean of the bins up to (mu_0) and above (mu_1) every bin
+    mu_0 = np.zeros(n)
+    mu_0[first_bin:] = np.cumsum(index * data)[first_bin:] / np.cumsum(data)[first_bin:]
+    mu_1 = np.zeros(n)
+    weights = np.cumsum((index * data)[:last_bin + 1][::-1])[::-1]
+    totals  = np.cumsum(data[:last_bin + 1][::-1])[::-1]
+    mu_1[:last_bin] = weights[1:] / totals[1:]
+
+    # The entropy only changes at the nonempty bins (and is the same for all
+    # the bins below the first one), and only the nonempty bins add to it
+    candidates = np.concatenate(([0], nonzero)) if first_bin > 0 else nonzero
+    ih, counts = index[nonzero], data[nonzero]
+
+    ent = np.empty(len(candidates))
+    for start, it in _blocks(candidates, len(nonzero)):
+        mu_x = 1.0 / (1.0 + term * np.abs(ih - np.where(ih <= it, mu_0[it], mu_1[it])))
+        valid = (mu_x >= 1e-06) & (mu_x <= 0.999999)
+        mu_x = np.where(valid, mu_x, 0.5)
+        terms = counts * (-mu_x * np.log(mu_x) - (1.0 - mu_x) * np.log(1.0 - mu_x))
+        ent[start:start + len(it)] = np.sum(np.where(valid, terms, 0.0), axis=1)
+    return int(candidates[np.argmin(ent)])
+
+
+def ij1(data):
+    # The modified IsoData method of ImageJ's "Default" threshold, which
+    # ignores the first and last bins
+    data = data.copy()
+    data[0] = data[-1] = 0
+    max_value = len(data) - 1
+
+    nonzero = np.flatnonzero(data)
+    if len(nonzero) == 0 or nonzero[0] >= nonzero[-1]:
+        return len(data) // 2
+    low, high = nonzero[0], nonzero[-1]
+
+    a, b, _ = _partial_sums(data)
+    moving_index = low
+    while True:
+        result = (b[moving_index] / a[moving_index] +
+                  (b[high] - b[moving_index]) / (a[high] - a[moving_index])) / 2.0
+        moving_index += 1
+        if not ((moving_index + 1) <= result and moving_index < high - 1):
+            break
+    return int(np.floor(result + 0.5))
+
+
+def intermodes(data):
+    histo = _smooth_until_bimodal(data)
+    if histo is None:
+        return -1
+
+    # The threshold is the mean between the two peaks
+    peaks = 1 + np.flatnonzero((histo[:-2] < histo[1:-1]) & (histo[2:] < histo[1:-1]))
+    return int(np.floor(peaks.sum() / 2.0))
+
+
+def iso_data(data):
+    n = len(data)
+    start = np.flatnonzero(data[1:])
+    g = start[0] + 2 if len(start) > 0 else 0
+    totals = np.cumsum(data)
+    sums   = np.cumsum(np.arange(n) * data)
+
+    # ImageJ gives up past bin n - 2, which is also where it starts when the
+    # first nonempty bin is one of the last ones
+    while g <= n - 2:
+        totl, l = totals[g], sums[g]
+        toth, h = totals[-1] - totl, sums[-1] - l
+        if totl > 0 and toth > 0:
+            # Integer means, as in ImageJ
+            if g == int(np.floor((l // totl + h // toth) / 2.0 + 0.5)):
+                return g
+        g += 1
+    return -1
+
+
+def li(data):
+    num_pixels = float(data.sum())
+    a, b, _ = _partial_sums(data)
+
+    # Initial estimate, the mean gray level
+    new_thresh = b[-1] / num_pixels
+    for _ in range(MAX_ITERATIONS):
+        old_thresh = new_thresh
+        threshold = int(old_thresh + 0.5)
+
+        num_back, sum_back = a[threshold], b[threshold]
+        mean_back = 0.0 if num_back == 0 else sum_back / num_back
+        num_obj, sum_obj = a[-1] - num_back, b[-1] - sum_back
+        mean_obj = 0.0 if num_obj == 0 else sum_obj / num_obj
+
+        temp = (mean_back - mean_obj) / (np.log(mean_back) - np.log(mean_obj))
+        new_thresh = float(int(temp - 0.5) if temp < -EPSILON else int(temp + 0.5))
+
+        if not abs(new_thresh - old_thresh) > 0.5:
+            break
+    return threshold
+
+
+def max_entropy(data):
+    norm_histo, p1, p2 = _normalized(data)
+    first_bin, last_bin = _nonzero_range(p1, p2)
+
+    # With x = p / P, -sum(x log x) = log P - sum(p log p) / P
+    plogp = np.zeros(len(data))
+    plogp[data > 0] = norm_histo[data > 0] * np.log(norm_histo[data > 0])
+    back = np.cumsum(plogp)
+    obj  = back[-1] - back
+
+    it = np.arange(first_bin, last_bin + 1)
+    ent_back = np.log(p1[it]) - back[it] / p1[it]
+    ent_obj  = np.where(obj[it] != 0, np.log(p2[it]) - obj[it] / p2[it], 0.0)
+
+    nonzero = np.flatnonzero(data)
+
+    def exact(t):
+        x = norm_histo[nonzero[nonzero <= t]] / p1[t]
+        ent_back = -_ordered_sum(x * np.log(x))
+        x = norm_histo[nonzero[nonzero > t]] / p2[t]
+        ent_obj = -_ordered_sum(x * np.log(x))
+        return ent_back + ent_obj
+
+    # The first maximum (above ImageJ's Double.MIN_VALUE start)
+    return _first_max(data, it, ent_back + ent_obj, exact, np.finfo(float).tiny, -1)
+
+
+def max_likelihood(data):
+    y = data.astype(np.float64)
+    n = len(y) - 1
+    index = np.arange(n + 1, dtype=np.float64)
+
+    # The initial estimate is the Minimum method's threshold
+    t = minimum(data)
+    if t < 0:
+        return -1
+
+    a, b, c = _partial_sums(y)
+    mu = b[t] / a[t]
+    nu = (b[n] - b[t]) / (a[n] - a[t])
+    p = a[t] / a[n]
+    q = (a[n] - a[t]) / a[n]
+    sigma2 = c[t] / a[t] - mu * mu
+    tau2 = (c[n] - c[t]) / (a[n] - a[t]) - nu * nu
+    if sigma2 == 0 or tau2 == 0:
+        return -1
+
+    # Expectation maximization of a mixture of two gaussians
+    previous = None
+    for _ in range(MAX_ITERATIONS):
+        back = p * np.exp(-((index - mu) ** 2) / (2 * sigma2)) / np.sqrt(sigma2)
+        obj  = q * np.exp(-((index - nu) ** 2) / (2 * tau2)) / np.sqrt(tau2)
+        total = back + obj
+        back, obj = back / total, obj / total
+
+        p = np.sum(back * y) / np.sum(y)
+        q = np.sum(obj * y) / np.sum(y)
+        mu = np.sum(index * back * y) / np.sum(back * y)
+        nu = np.sum(index * obj * y) / np.sum(obj * y)
+        sigma2 = np.sum(index ** 2 * back * y) / np.sum(back * y) - mu ** 2
+        tau2 = np.sum(index ** 2 * obj * y) / np.sum(obj * y) - nu ** 2
+
+        current = np.array([mu, nu, p, q, sigma2, tau2])
+        if previous is not None and np.all(np.abs(current - previous) <= 1e-7):
+            break
+        previous = current
+
+    # The threshold is the integer part of the solution of the quadratic equation
+    w0 = 1 / sigma2 - 1 / tau2
+    w1 = mu / sigma2 - nu / tau2
+    w2 = mu ** 2 / sigma2 - nu ** 2 / tau2 + np.log10((sigma2 * q ** 2) / (tau2 * p ** 2))
+    sqterm = w1 ** 2 - w0 * w2
+    if sqterm < 0:
+        return 0
+
+    # A degenerate fit (w0 == 0, or NaN parameters) is cast like ImageJ does
+    return _java_int(np.floor((w1 + np.sqrt(sqterm)) / w0))
+
+
+def mean(data):
+    return int(np.floor(np.sum(np.arange(len(data)) * data, dtype=np.float64) / data.sum()))
+
+
+def min_error(data):
+    a, b, c = _partial_sums(data)
+    threshold, previous = mean(data), -2
+
+    for _ in range(MAX_ITERATIONS):
+        if threshold == previous:
+            break
+        t = threshold
+        mu = b[t] / a[t]
+        nu = (b[-1] - b[t]) / (a[-1] - a[t])
+        p = a[t] / a[-1]
+        q = (a[-1] - a[t]) / a[-1]
+        sigma2 = c[t] / a[t] - mu * mu
+        tau2 = (c[-1] - c[t]) / (a[-1] - a[t]) - nu * nu
+
+        # The terms of the quadratic equation to be solved
+        w0 = 1.0 / sigma2 - 1.0 / tau2
+        w1 = mu / sigma2 - nu / tau2
+        w2 = mu * mu / sigma2 - nu * nu / tau2 + np.log10((sigma2 * q * q) / (tau2 * p * p))
+
+        # If the next threshold would be imaginary, keep the current one
+        sqterm = w1 * w1 - w0 * w2
+        if sqterm < 0:
+            break
+
+        previous = threshold
+        temp = (w1 + np.sqrt(sqterm)) / w0
+        if not np.isnan(temp):
+            threshold = int(np.floor(temp))
+        if not 0 <= threshold < len(data):
+            return previous
+    return threshold
+
+
+def minimum(data):
+    histo = _smooth_until_bimodal(data)
+    if histo is None:
+        return -1
+
+    # The threshold is the first minimum between the two peaks
+    last = np.flatnonzero(data)[-1]
+    i = np.arange(1, last)
+    minima = i[(histo[i - 1] > histo[i]) & (histo[i + 1] >= histo[i])]
+    return int(minima[0]) if len(minima) > 0 else -1
+
+
+def moments(data):
+    histo = data / float(data.sum())
+    index = np.arange(len(data), dtype=np.float64)
+
+    # The first, second and third order moments (summed in order, as they
+    # are compared to the cumulative histogram)
+    m0 = 1.0
+    m1 = _ordered_sum(index * histo)
+    m2 = _ordered_sum(index * index * histo)
+    m3 = _ordered_sum(index * index * index * histo)
+
+    cd = m0 * m2 - m1 * m1
+    c0 = (-m2 * m2 + m1 * m3) / cd
+    c1 = (m0 * -m3 + m2 * m1) / cd
+    z0 = 0.5 * (-c1 - np.sqrt(c1 * c1 - 4.0 * c0))
+    z1 = 0.5 * (-c1 + np.sqrt(c1 * c1 - 4.0 * c0))
+
+    # The fraction of object pixels, and the gray level closest to that
+    # tile of the histogram
+    p0 = (z1 - m1) / (z1 - z0)
+    above = np.flatnonzero(np.cumsum(histo) > p0)
+    return int(above[0]) if len(above) > 0 else -1
+
+
+def otsu(data):
+    histo = (1.0 / data.sum()) * data
+    cnh   = np.cumsum(histo)
+    mean  = np.cumsum(np.arange(len(data)) * histo)
+
+    # The between-class variance of every gray level, rounded as in ImageJ
+    # so that the ties of symmetric histograms break the same way
+    bcv = mean[-1] * cnh - mean
+    bcv = bcv * (bcv / (cnh * (1.0 - cnh)))
+    bcv = np.where(np.isnan(bcv), -np.inf, bcv)
+    if not np.any(bcv > 0):
+        return -1
+    return int(np.argmax(bcv))
+
+
+def percentile(data, ptile=0.5):
+    # The bin closest to half of the pixels
+    distance = np.abs(np.cumsum(data) / float(data.sum()) - ptile)
+    return int(np.argmin(distance)) if np.min(distance) < 1.0 else -1
+
+
+def renyi_entropy(data):
+    norm_histo, p1, p2 = _normalized(data)
+    first_bin, last_bin = _nonzero_range(p1, p2)
+    it = np.arange(first_bin, last_bin + 1)
+
+    # alpha = 1 is the maximum entropy method
+    t_star2 = max_entropy(data)
+    t_star2 = 0 if t_star2 < 0 else t_star2
+
+    nonzero = np.flatnonzero(data)
+
+    def log_product(ent_back, ent_obj):
+        product = ent_back * ent_obj
+        return np.where(product > 0.0, np.log(np.where(product > 0.0, product, 1.0)), 0.0)
+
+    def exact_half(t):
+        back, obj = norm_histo[nonzero[nonzero <= t]], norm_histo[nonzero[nonzero > t]]
+        return 2.0 * log_product(_ordered_sum(np.sqrt(back / p1[t])), _ordered_sum(np.sqrt(obj / p2[t])))
+
+    def exact_two(t):
+        back, obj = norm_histo[nonzero[nonzero <= t]], norm_histo[nonzero[nonzero > t]]
+        return -1.0 * log_product(_ordered_sum(back * back / (p1[t] * p1[t])),
+                                  _ordered_sum(obj * obj / (p2[t] * p2[t])))
+
+    # alpha = 0.5, the first maximum above 0 (or 0)
+    root = np.cumsum(np.sqrt(norm_histo))
+    ent_back = root[it] / np.sqrt(p1[it])
+    ent_obj  = (root[-1] - root[it]) / np.sqrt(p2[it])
+    t_star1  = _first_max(data, it, 2.0 * log_product(ent_back, ent_obj), exact_half, 0.0, 0)
+
+    # alpha = 2
+    square = np.cumsum(norm_histo * norm_histo)
+    ent_back = square[it] / (p1[it] * p1[it])
+    ent_obj  = (square[-1] - square[it]) / (p2[it] * p2[it])
+    t_star3  = _first_max(data, it, -1.0 * log_product(ent_back, ent_obj), exact_two, 0.0, 0)
+
+    t_star1, t_star2, t_star3 = sorted((t_star1, t_star2, t_star3))
+
+    # Adjust the beta values
+    if abs(t_star1 - t_star2) <= 5:
+        beta = (1, 2, 1) if abs(t_star2 - t_star3) <= 5 else (0, 1, 3)
+    else:
+        beta = (3, 1, 0) if abs(t_star2 - t_star3) <= 5 else (1, 2, 1)
+
+    omega = p1[t_star3] - p1[t_star1]
+    return int(t_star1 * (p1[t_star1] + 0.25 * omega * beta[0]) +
+               0.25 * t_star2 * omega * beta[1] +
+               t_star3 * (p2[t_star3] + 0.25 * omega * beta[2]))
+
+
+def rosin(data):
+    # The bin furthest from the line between the histogram's peak and the
+    # end of its longer tail
+    peak = int(np.argmax(data))
+    nonzero = np.flatnonzero(data)
+    first_bin, last_bin = nonzero[0], nonzero[-1]
+
+    if last_bin - peak >= peak - first_bin:
+        end, i = last_bin, np.arange(peak, last_bin + 1)
+    else:
+        end, i = first_bin, np.arange(first_bin, peak + 1)
+    if end == peak:
+        return peak
+
+    # Perpendicular distance of every bin to the line
+    dx, dy = float(end - peak), float(data[end]) - float(data[peak])
+    distance = np.abs(dy * (i - peak) - dx * (data[i] - float(data[peak]))) / np.hypot(dx, dy)
+    return int(i[np.argmax(distance)])
+
+
+def shanbhag(data):
+    norm_histo, p1, p2 = _normalized(data)
+    first_bin, last_bin = _nonzero_range(p1, p2)
+
+    # The entropies only change at the nonempty bins, and only the nonempty
+    # bins add to them
+    nonzero = np.flatnonzero(data)
+    candidates = nonzero[(nonzero >= first_bin) & (nonzero <= last_bin)]
+    ih, p = nonzero, norm_histo[nonzero]
+    p1_below = p1[np.maximum(ih - 1, 0)]
+
+    tot_ent = np.empty(len(candidates))
+    for start, it in _blocks(candidates, len(nonzero)):
+        # Entropy of the background pixels
+        term = 0.5 / p1[it]
+        ent_back = -np.sum(np.where((ih >= 1) & (ih <= it), p * np.log(1.0 - term * p1_below), 0.0), axis=1)
+        ent_back *= term[:, 0]
+
+        # Entropy of the object pixels
+        term = 0.5 / p2[it]
+        ent_obj = -np.sum(np.where(ih > it, p * np.log(1.0 - term * p2[ih]), 0.0), axis=1)
+        ent_obj *= term[:, 0]
+
+        tot_ent[start:start + len(it)] = np.abs(ent_back - ent_obj)
+
+    # The first minimum (below ImageJ's Double.MAX_VALUE start)
+    valid = np.where(np.isnan(tot_ent), np.inf, tot_ent)
+    if not np.any(valid < np.inf):
+        return -1
+    return int(candidates[np.argmin(valid)])
+
+
+def triangle(data):
+    n = len(data)
+    nonzero = np.flatnonzero(data)
+
+    # The line goes to the empty bin next to the furthest side of the peak
+    low  = max(nonzero[0] - 1, 0)
+    high = min(nonzero[-1] + 1, n - 1)
+    peak = int(np.argmax(data))
+
+    inverted = (peak - low) < (high - peak)
+    if inverted:
+        data = data[::-1]
+        low, peak = n - 1 - high, n - 1 - peak
+    if low == peak:
+        return low
+
+    # Describe the line by nx * x + ny * y - d = 0
+    nx, ny = float(data[peak]), float(low - peak)
+    d = np.sqrt(nx * nx + ny * ny)
+    nx, ny = nx / d, ny / d
+    d = nx * low + ny * data[low]
+
+    # The split is the bin furthest from the line
+    i = np.arange(low + 1, peak + 1)
+    distance = nx * i + ny * data[i] - d
+    split = int(i[np.argmax(distance)]) if np.max(distance) > 0 else low
+    split -= 1
+
+    return n - 1 - split if inverted else split
+
+
+def yen(data):
+    norm_histo, p1, _ = _normalized(data)
+    p1_sq = np.cumsum(norm_histo * norm_histo)
+    p2_sq = np.concatenate((np.cumsum((norm_histo * norm_histo)[:0:-1])[::-1], [0.0]))
+
+    product = p1_sq * p2_sq
+    spread  = p1 * (1.0 - p1)
+    crit = (-1.0 * np.where(product > 0.0, np.log(np.where(product > 0.0, product, 1.0)), 0.0) +
+            2 * np.where(spread > 0.0, np.log(np.where(spread > 0.0, spread, 1.0)), 0.0))
+
+    if not np.any(crit > np.finfo(float).tiny):
+        return -1
+    return int(np.argmax(crit))
+
+
+# The methods of the Fiji macro, by their ops name
+METHODS = {
+    "huang"        : huang,
+    "ij1"          : ij1,
+    "intermodes"   : intermodes,
+    "isoData"      : iso_data,
+    "li"           : li,
+    "maxEntropy"   : max_entropy,
+    "maxLikelihood": max_likelihood,
+    "mean"         : mean,
+    "minError"     : min_error,
+    "minimum"      : minimum,
+    "moments"      : moments,
+    "otsu"         : otsu,
+    "percentile"   : percentile,
+    "renyiEntropy" : renyi_entropy,
+    "rosin"        : rosin,
+    "shanbhag"     : shanbhag,
+    "triangle"     : triangle,
+    "yen"          : yen,
+}
+
+
+def compute_thresholds(pixels, methods, nbins=256, mask=None):
+    '''
+    Thresholds an image with several methods from one histogram.
+
+    Returns the ImageHistogram of the image and a dict mapping every method
+    to its threshold bin, so the masks are histogram.binarize(bin) and the
+    thresholds histogram.threshold(bin).
+    '''
+    histogram = ImageHistogram(pixels, nbins, mask)
+    return histogram, dict((method, threshold_bin(method, histogram.counts)) for method in methods)
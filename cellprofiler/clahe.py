@@ -6,6 +6,9 @@
 #
 #################################
 
+import os
+import sys
+
 import numpy
 import scipy.ndimage
 from skimage.exposure import equalize_adapthist
@@ -14,6 +17,16 @@ import cellprofiler.image
 import cellprofiler.module
 import cellprofiler.setting
 
+#
+# The tiled CLAHE is shared with scripts/clahe_batch.py, in a module next to
+# this plugin
+#
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if PLUGIN_DIRECTORY not in sys.path:
+    sys.path.append(PLUGIN_DIRECTORY)
+
+from clahe_tiling import run_clahe
+
 __doc__ = """\
 CLAHE
 =============
@@ -23,7 +36,7 @@ CLAHE
 ============ ============ ===============
 Supports 2D? Supports 3D? Respects masks?
 ============ ============ ===============
-YES          NO           YES
+YES          YES          YES
 ============ ============ ===============
 See also
 ^^^^^^^^
@@ -36,8 +49,16 @@ What do I get as output?
 Outputs an image with localized contrast adjustments from CLAHE.
 Technical notes
 ^^^^^^^^^^^^^^^
-Implemented using SciKit-Image 
-(`link <https://scikit-image.org/docs/dev/api/skimage.exposure.html?highlight=clahe#skimage.exposure.equalize_adapthist>`__)
+Grayscale images and stacks are equalized by a tiled, multi-threaded
+reimplementation of SciKit-Image's CLAHE
+(`link <https://scikit-image.org/docs/dev/api/skimage.exposure.html?highlight=clahe#skimage.exposure.equalize_adapthist>`__),
+which gives the same result. The histograms of the contextual regions and
+the interpolation between them are computed in bands of tiles, one band per
+thread. Stacks are equalized in 3D, with cubic kernels, or plane by plane
+as a batch of frames that share the tiling and working buffers
+(``run_clahe_batch``). The tiled CLAHE lives in ``clahe_tiling.py``,
+next to this plugin, which ``scripts/clahe_batch.py`` also uses. Color
+images are passed to SciKit-Image as is.
 References
 ^^^^^^^^^^
 Put CLAHE citation here
@@ -54,6 +75,9 @@ Put CLAHE citation here
 KERNEL_SIZE = "Kernel size"
 CLIP_LIMIT  = "Clip limit"
 NUM_BINS    = "Number of bins for the histogram"
+NUM_THREADS = "Number of threads"
+FRAMES      = "Equalize each plane of a stack separately?"
+
 
 
 #
@@ -89,7 +113,7 @@ class CLAHE(cellprofiler.module.ImageProcessing):
     # by its superclass.
     #
     module_name = "CLAHE"
-    variable_revision_number = 1
+    variable_revision_number = 3
 
     #
     # "create_settings" is where you declare the user interface elements
@@ -156,6 +180,34 @@ The number of gray bins for the histogram (i.e. the data range)
 """
         )
 
+        self.threads = cellprofiler.setting.Integer(
+            text=NUM_THREADS,
+            value=4,
+            minval=1,
+            doc="""\
+Number of threads equalizing bands of tiles of the image at the same time.
+The result does not depend on it. Lower it if several CellProfiler workers
+run side by side on the same machine.
+"""
+        )
+
+        self.frames = cellprofiler.setting.Binary(
+            text=FRAMES,
+            value=False,
+            doc="""\
+*(Used only for 3D images)*
+
+Select "*{YES}*" to equalize every plane of a stack on its own, as a batch
+of 2D frames (i.e. the time points of a time-lapse). The planes share their
+tiling and buffers and are spread over the threads.
+
+Select "*{NO}*" to equalize the stack as a volume, with cubic kernels.
+""".format(**{
+                "YES": cellprofiler.setting.YES,
+                "NO": cellprofiler.setting.NO
+            })
+        )
+
 
     #
     # The "settings" method tells CellProfiler about the settings you
@@ -174,7 +226,9 @@ The number of gray bins for the histogram (i.e. the data range)
         return settings + [
             self.kernel_size,
             self.clip_limit,
-            self.nbins
+            self.nbins,
+            self.threads,
+            self.frames
         ]
 
     #
@@ -196,7 +250,9 @@ The number of gray bins for the histogram (i.e. the data range)
         visible_settings += [
             self.kernel_size,
             self.clip_limit,
-            self.nbins
+            self.nbins,
+            self.threads,
+            self.frames
         ]
 
         return visible_settings
@@ -218,17 +274,33 @@ The number of gray bins for the histogram (i.e. the data range)
         # the module settings as they are returned from "settings" (excluding
         # "self.y_data", or the output image).
         #
-        self.function = run_clahe
+        # Color images are equalized in HSV space by SciKit-Image itself
+        x = workspace.image_set.get_image(self.x_name.value)
+        self.function = run_clahe_color if x.multichannel else run_clahe
         super(CLAHE, self).run(workspace)
 
     #
     # "volumetric" indicates whether or not this module supports 3D images.
-    # The "gradient_image" function is inherently 2D, and we've noted this
-    # in the documentation for the module. Explicitly return False here
-    # to indicate that 3D images are not supported.
+    # Stacks are equalized with 3D contextual regions, so return True here.
     #
     def volumetric(self):
-        return False
+        return True
+
+    #
+    # "upgrade_settings" converts the settings of pipelines saved with an
+    # older revision of the module. Revision 2 added the number of threads
+    # and revision 3 the equalization of stacks plane by plane.
+    #
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            setting_values = setting_values + ["4"]
+            variable_revision_number = 2
+
+        if variable_revision_number == 2:
+            setting_values = setting_values + [cellprofiler.setting.NO]
+            variable_revision_number = 3
+
+        return setting_values, variable_revision_number, from_matlab
 
 #
 # This is the function that gets called during "run" to create the output image.
@@ -237,6 +309,8 @@ The number of gray bins for the histogram (i.e. the data range)
 #
 # This function must return the output image data (as a numpy array).
 #
-def run_clahe(pixels, kernel_size, clip_limit, nbins):
-    outimg = equalize_adapthist(pixels, kernel_size=kernel_size, clip_limit=clip_limit, nbins=nbins)
+# Grayscale images and stacks use "run_clahe", from clahe_tiling.
+#
+def run_clahe_color(pixels, kernel_size, clip_limit, nbins, threads=1, frames=False):
+    outimg = equalize_adapthist(pixels, kernel_size=kernel_size or None, clip_limit=clip_limit, nbins=nbins)
     return outimg
@@ -0,0 +1,337 @@
+# coding=utf-8
+
+"""
+Tiled, multi-threaded CLAHE, shared by the CLAHE plugin and
+scripts/clahe_batch.py.
+
+A reimplementation of SciKit-Image's equalize_adapthist for grayscale
+images and stacks, with the same result. It only needs NumPy and
+SciKit-Image, so it runs both in CellProfiler (Python 2) and in the scripts
+(Python 3) without importing either of them.
+"""
+
+import itertools
+import multiprocessing.pool
+import threading
+
+import numpy
+import skimage.util
+from skimage.exposure import rescale_intensity
+
+#
+# Number of gray levels the image is rescaled to before equalizing it, as in
+# SciKit-Image's implementation
+#
+NR_OF_GRAY = 2 ** 14
+
+
+def run_clahe(pixels, kernel_size, clip_limit, nbins, threads=1, frames=False):
+    """Equalizes a grayscale image or stack like equalize_adapthist, on
+    `threads` threads. Returns the equalized image as floats."""
+    #
+    # Stacks of independent frames (i.e. time-lapses) are equalized frame by
+    # frame with the batched function below.
+    #
+    if frames and pixels.ndim == 3:
+        return run_clahe_batch(pixels, kernel_size, clip_limit, nbins, threads)
+
+    #
+    # Like equalize_adapthist, the image is converted to 16 bits and
+    # rescaled to NR_OF_GRAY gray levels first. A kernel size of 0 uses
+    # SciKit-Image's default, 1/8 of the image along each axis.
+    #
+    image = _gray_levels(pixels)
+    tiling = Tiling(image.shape, _kernel_size(kernel_size, image.shape), nbins)
+    image = clahe(image, tiling, clip_limit, threads)
+
+    return rescale_intensity(image.astype(_float_dtype(pixels.dtype)))
+
+
+def run_clahe_batch(frames, kernel_size, clip_limit, nbins, threads=1, out=None):
+    """Equalizes every frame of an (N, H, W) array on its own, with the same
+    result as calling run_clahe on each.
+
+    The frames share one Tiling, whose index arrays are computed once, and
+    every thread reuses its buffers from frame to frame. Returns the
+    equalized frames as floats (in out, if given).
+    """
+    if out is None:
+        out = numpy.empty(frames.shape, _float_dtype(frames.dtype))
+
+    tiling = Tiling(frames.shape[1:], _kernel_size(kernel_size, frames.shape[1:]), nbins, cache=True)
+    whole = [(0, tiling.n_regions[0])], [(0, tiling.last[0] - tiling.first[0])]
+
+    def equalize(index):
+        image = clahe(_gray_levels(frames[index]), tiling, clip_limit, bands=whole)
+        out[index] = rescale_intensity(image.astype(out.dtype))
+
+    if threads > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            pool.map(equalize, range(len(frames)))
+        finally:
+            pool.close()
+    else:
+        for index in range(len(frames)):
+            equalize(index)
+
+    return out
+
+
+def _gray_levels(pixels):
+    image = skimage.util.img_as_uint(pixels)
+    return numpy.round(rescale_intensity(image, out_range=(0, NR_OF_GRAY - 1))).astype(numpy.uint16)
+
+
+def _kernel_size(kernel_size, shape):
+    if kernel_size > 0:
+        return [int(kernel_size)] * len(shape)
+    return [max(s // 8, 1) for s in shape]
+
+
+def _float_dtype(dtype):
+    return numpy.float32 if dtype in (numpy.float16, numpy.float32) else numpy.float64
+
+
+class Tiling(object):
+    """The tiles of CLAHE for one image shape and kernel size (per axis).
+
+    The image is padded by reflection to a whole number of kernels, with
+    half a kernel before it and at least half a kernel after it. The
+    contextual regions are the kernels of the padded image that start half
+    a kernel in, and every kernel overlapping the image is interpolated
+    between the mappings of the 2 (4 in 3D) regions around it.
+
+    Both are processed in bands along the first axis. With cache=True the
+    index arrays of every band are kept, so that equalizing more images of
+    the same shape only repeats the arithmetic, and every thread reuses its
+    working buffers.
+    """
+
+    def __init__(self, shape, kernel_size, nbins, cache=False):
+        self.shape = tuple(shape)
+        self.kernel_size = list(kernel_size)
+        self.nbins = nbins
+        self.bin_size = 1 + NR_OF_GRAY // nbins
+        self.kernel_elements = int(numpy.prod(kernel_size))
+
+        self.pad_start = [k // 2 for k in kernel_size]
+        self.pad_end = [(k - s % k) % k + (k + 1) // 2 for k, s in zip(kernel_size, shape)]
+        padded_shape = [a + s + b for a, s, b in zip(self.pad_start, shape, self.pad_end)]
+
+        self.n_regions = [s // k - 1 for s, k in zip(padded_shape, kernel_size)]
+        self.first = [p // k for p, k in zip(self.pad_start, kernel_size)]
+        self.last = [-(-(p + s) // k) for p, s, k in zip(self.pad_start, shape, kernel_size)]
+
+        # Strides of the mappings, once extended by one region on every side
+        sizes = [n + 2 for n in self.n_regions[1:]] + [nbins]
+        self.strides = [int(numpy.prod(sizes[axis:])) for axis in range(len(sizes))]
+
+        self.cache = {} if cache else None
+        self.local = threading.local()
+
+    def _cached(self, key, make):
+        if self.cache is None:
+            return make()
+        if key not in self.cache:
+            self.cache[key] = make()
+        return self.cache[key]
+
+    def _buffer(self, name, shape, dtype):
+        if self.cache is None:
+            return numpy.empty(shape, dtype)
+        buffers = self.local.__dict__
+        if name not in buffers or buffers[name].shape != shape:
+            buffers[name] = numpy.empty(shape, dtype)
+        return buffers[name]
+
+    def pad(self, image):
+        """Pads an image of this shape and maps its gray levels to the histogram bins."""
+        padded = numpy.pad(image, list(zip(self.pad_start, self.pad_end)), mode="reflect")
+        padded //= self.bin_size
+        return padded
+
+    def histograms(self, padded, band):
+        """Returns the histograms (rows) of the contextual regions in a band
+        (start, stop) of regions along the first axis."""
+        start, stop = band
+        k0 = self.kernel_size[0]
+        regions = (slice(k0 // 2 + start * k0, k0 // 2 + stop * k0),) + tuple(
+            slice(k // 2, k // 2 + n * k) for k, n in zip(self.kernel_size[1:], self.n_regions[1:])
+        )
+        counts = [stop - start] + self.n_regions[1:]
+
+        def region_index():
+            index = 0
+            for axis, (k, n) in enumerate(zip(self.kernel_size, counts)):
+                shape = [1] * len(counts)
+                shape[axis] = n * k
+                index = index * n + (numpy.arange(n * k) // k).reshape(shape)
+            return index * self.nbins
+
+        index = self._cached(("regions", band), region_index)
+        hist = numpy.bincount((index + padded[regions]).ravel(), minlength=int(numpy.prod(counts)) * self.nbins)
+        return hist.reshape(-1, self.nbins)
+
+    def interpolate(self, padded, mappings, band, result):
+        """Interpolates the kernels of a band (start, stop) of kernels along
+        the first axis, counted from the first one overlapping the image,
+        between the extended mappings (flattened), into result."""
+        start, stop = band
+        kernels = [slice((start + self.first[0]) * self.kernel_size[0], (stop + self.first[0]) * self.kernel_size[0])]
+        kernels += [slice(f * k, l * k) for f, l, k in zip(self.first[1:], self.last[1:], self.kernel_size[1:])]
+        gray = padded[tuple(kernels)]
+        ndim = gray.ndim
+
+        def edges():
+            #
+            # The offset of the mapping of each pixel for every corner
+            # (edge) of its kernel, and the weight of that mapping
+            #
+            blocks, weights = [], []
+            for axis, (k, kernel) in enumerate(zip(self.kernel_size, kernels)):
+                shape = [1] * ndim
+                shape[axis] = kernel.stop - kernel.start
+                position = numpy.arange(kernel.start, kernel.stop)
+                blocks.append((position // k).reshape(shape))
+                coefficient = (position % k) / float(k)
+                weights.append(((1 - coefficient).reshape(shape), coefficient.reshape(shape)))
+
+            offsets = []
+            for edge in itertools.product((0, 1), repeat=ndim):
+                weight = 1
+                for axis in reversed(range(ndim)):
+                    weight = weight * weights[axis][edge[axis]]
+                offset = sum((b + e) * s for b, e, s in zip(blocks, edge, self.strides))
+                offsets.append((numpy.broadcast_to(offset, gray.shape), numpy.broadcast_to(weight, gray.shape)))
+            return offsets
+
+        interpolated = self._buffer("interpolated", gray.shape, numpy.float32)
+        index = self._buffer("index", gray.shape, numpy.intp)
+        mapped = self._buffer("mapped", gray.shape, mappings.dtype)
+        product = self._buffer("product", gray.shape, numpy.float64)
+
+        interpolated[...] = 0
+        for offset, weight in self._cached(("edges", band), edges):
+            numpy.add(offset, gray, out=index)
+            mappings.take(index, out=mapped)
+            numpy.multiply(mapped, weight, out=product)
+            numpy.add(interpolated, product, out=interpolated, dtype=numpy.float32)
+
+        # Copy the part of the band that is inside the image
+        inside = tuple(
+            slice(max(p - kernel.start, 0), min(p + s, kernel.stop) - kernel.start)
+            for p, s, kernel in zip(self.pad_start, self.shape, kernels)
+        )
+        target = tuple(
+            slice(max(kernel.start - p, 0), min(kernel.stop - p, s))
+            for p, s, kernel in zip(self.pad_start, self.shape, kernels)
+        )
+        result[target] = interpolated[inside]
+
+
+def clahe(image, tiling, clip_limit, threads=1, bands=None):
+    """Equalizes a 2D or 3D image of NR_OF_GRAY gray levels (uint16) with
+    the given Tiling.
+
+    Returns the equalized uint16 image. The contextual regions and kernels
+    are processed in bands along the first axis (about 4 per thread unless
+    given as lists of (start, stop) pairs), each by one of `threads`
+    threads (NumPy releases the GIL for the heavy lifting).
+    """
+    if bands is None:
+        bands = _bands(tiling.n_regions[0], threads), _bands(tiling.last[0] - tiling.first[0], threads)
+    region_bands, kernel_bands = bands
+
+    pool = multiprocessing.pool.ThreadPool(threads) if threads > 1 else None
+    map_bands = pool.map if pool is not None else lambda f, bands: list(map(f, bands))
+
+    try:
+        padded = tiling.pad(image)
+
+        #
+        # The histograms of the contextual regions are clipped and turned
+        # into gray level mappings.
+        #
+        if clip_limit > 0:
+            clim = int(numpy.clip(clip_limit * tiling.kernel_elements, 1, None))
+        else:
+            clim = tiling.kernel_elements
+
+        def region_mappings(band):
+            hist = tiling.histograms(padded, band)
+            clip_histograms(hist, clim)
+            return map_histograms(hist, 0, NR_OF_GRAY - 1, tiling.kernel_elements)
+
+        mappings = numpy.concatenate(map_bands(region_mappings, region_bands))
+        mappings = mappings.reshape(tiling.n_regions + [tiling.nbins])
+
+        #
+        # The mappings are extended by one region on every side, so that
+        # every kernel overlapping the image lies between regions, and its
+        # pixels are interpolated by their distance to the regions' centers.
+        #
+        mappings = numpy.pad(mappings, [(1, 1)] * image.ndim + [(0, 0)], mode="edge").ravel()
+
+        result = numpy.empty(image.shape, image.dtype)
+        map_bands(lambda band: tiling.interpolate(padded, mappings, band, result), kernel_bands)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return result
+
+
+def clip_histograms(hist, clip_limit):
+    """Clips every histogram (row) of hist in place, redistributing the
+    excess counts evenly over the bins, as SciKit-Image does."""
+    nbins = hist.shape[1]
+
+    n_excess = numpy.maximum(hist - clip_limit, 0).sum(axis=1)
+    numpy.minimum(hist, clip_limit, out=hist)
+
+    # Add an even share of the excess to the bins that can take it
+    bin_incr = n_excess // nbins
+    upper = (clip_limit - bin_incr)[:, None]
+
+    low = hist < upper
+    n_excess -= low.sum(axis=1) * bin_incr
+    hist += low * bin_incr[:, None]
+
+    mid = (hist >= upper) & (hist < clip_limit)
+    n_excess += numpy.where(mid, hist - clip_limit, 0).sum(axis=1)
+    hist[mid] = clip_limit
+
+    # Spread what is left one count at a time, histogram by histogram
+    for row in numpy.flatnonzero(n_excess > 0):
+        _redistribute(hist[row], n_excess[row], clip_limit)
+
+
+def _redistribute(hist, n_excess, clip_limit):
+    while n_excess > 0:
+        prev_n_excess = n_excess
+        for index in range(hist.size):
+            under = hist < clip_limit
+            step_size = max(1, numpy.count_nonzero(under) // n_excess)
+            under = under[index::step_size]
+            hist[index::step_size][under] += 1
+            n_excess -= numpy.count_nonzero(under)
+            if n_excess <= 0:
+                break
+        if prev_n_excess == n_excess:
+            break
+
+
+def map_histograms(hist, min_val, max_val, n_pixels):
+    """Turns every clipped histogram (row) into a cumulative gray level mapping."""
+    out = numpy.cumsum(hist, axis=1).astype(float)
+    out *= (max_val - min_val) / float(n_pixels)
+    out += min_val
+    numpy.clip(out, None, max_val, out=out)
+    return out.astype(int)
+
+
+def _bands(n, threads):
+    """Splits range(n) into about 4 bands per thread, as (start, stop) pairs."""
+    size = max(1, -(-n // (4 * threads)))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
@@ -7,6 +7,7 @@
 #################################
 
 import numpy
+import skimage.draw
 
 import cellprofiler.image
 import cellprofiler.module
@@ -15,15 +16,15 @@ import cellprofiler.setting
 __doc__ = """\
 CoverRectangle
 =============
-**CoverRectangle** covers a defined rectangular space on
-a given batch of images, for covering up artifacts such
-as scale bars or annotations that consistently appear in
+**CoverRectangle** covers one or more rectangular or polygonal
+regions on a given batch of images, for covering up artifacts
+such as scale bars or annotations that consistently appear in
 a batch of images.
 |
 ============ ============ ===============
 Supports 2D? Supports 3D? Respects masks?
 ============ ============ ===============
-YES          NO           YES
+YES          YES          YES
 ============ ============ ===============
 See also
 ^^^^^^^^
@@ -33,9 +34,22 @@ What do I need as input?
 Image.
 What do I get as output?
 ^^^^^^^^^^^^^^^^^^^^^^^^
-Outputs an image where the specified rectangular region is set to zero.
+Outputs an image where the specified regions are set to the fill value.
 Technical notes
 ^^^^^^^^^^^^^^^
+The regions are drawn once into a boolean template of the image's size,
+which is reused for as long as the image size and the regions stay the
+same, and the template is filled in a single pass over the image. The
+same regions are covered on every plane of a stack and on every channel
+of a color image.
+
+The first coordinate of a corner or vertex is along the first (row) axis
+of the image and the second one along the second (column) axis. A
+rectangle spans from its first corner up to, but excluding, its second
+corner, whichever way round the corners are given.
+
+Unless the input image is modified in place, the output is a copy of the
+input image and the input image is left untouched.
 
 References
 ^^^^^^^^^^
@@ -55,6 +69,9 @@ CORNER_ONE = "First corner"
 CORNER_TWO = "Second corner"
 FILL_VAL   = "Fill value"
 
+SHAPE_RECTANGLE = "Rectangle"
+SHAPE_POLYGON   = "Polygon"
+
 #
 # The module class.
 #
@@ -88,7 +105,7 @@ class CoverRectangle(cellprofiler.module.ImageProcessing):
     # by its superclass.
     #
     module_name = "CoverRectangle"
-    variable_revision_number = 1
+    variable_revision_number = 2
 
     #
     # "create_settings" is where you declare the user interface elements
@@ -122,34 +139,91 @@ class CoverRectangle(cellprofiler.module.ImageProcessing):
         self.x_name.doc = """\
 This is the image that the module operates on. You can choose any image
 that is made available by a prior module.
-**CoverRectangle** will perform cover a specified rectangle space on the image.
+**CoverRectangle** will cover the specified regions on the image.
 """
 
-        self.first_corner = cellprofiler.setting.Coordinates(
-            text="First corner",
-            value=(0,0),
+        self.fill_value = cellprofiler.setting.Float(
+            text="Fill value",
+            value=0,
             doc="""\
-The coordiantes of the first corner of the covering rectangle on the image.
+The value to fill the regions with. If 0, it will fill black; if the maximum value of the image (i.e. 1),
+it will fill white.
 """
         )
 
-        self.second_corner = cellprofiler.setting.Coordinates(
-            text="Second corner",
-            value=(0,0),
+        self.in_place = cellprofiler.setting.Binary(
+            text="Modify the input image in place?",
+            value=False,
             doc="""\
-The coordiantes of the second corner (opposite of the first corner) of the covering rectangle on the image.
+Select "*Yes*" to cover the regions directly on the input image instead of on a copy of it. This saves
+copying the image, but the input image is then changed for every module that uses it, including the
+modules before this one. A read-only input image (such as a memory-mapped one) is still covered on a
+copy.
+
+Select "*No*" (the default) to leave the input image untouched. The output image is always a copy of
+the input image, even when no pixel is covered, so later modules can change it freely.
 """
         )
 
+        #
+        # Each region is a group of settings. "regions" holds the groups and
+        # "region_count" saves their number in the pipeline, so that
+        # "prepare_settings" can recreate them when the pipeline is loaded.
+        #
+        self.regions = []
+        self.region_count = cellprofiler.setting.HiddenCount(self.regions, "Region count")
+        self.add_region(can_remove=False)
+
+        self.add_region_button = cellprofiler.setting.DoSomething("", "Add another region", self.add_region)
 
-        self.fill_value = cellprofiler.setting.Float(
-            text="Fill value",
-            value=0,
+    #
+    # "add_region" adds the settings of one more region to cover.
+    #
+    def add_region(self, can_remove=True):
+        group = cellprofiler.setting.SettingsGroup()
+
+        if can_remove:
+            group.append("divider", cellprofiler.setting.Divider(line=False))
+
+        group.append("shape", cellprofiler.setting.Choice(
+            text="Shape of the region",
+            choices=[SHAPE_RECTANGLE, SHAPE_POLYGON],
+            value=SHAPE_RECTANGLE,
             doc="""\
-The value to fill the rectangle with. If 0, it will fill black; if the maximum value of the image (i.e. 1),
-it will fill white.
+Cover either a rectangle, given by two opposite corners, or a polygon, given by its vertices.
 """
-        )
+        ))
+
+        group.append("first_corner", cellprofiler.setting.Coordinates(
+            text=CORNER_ONE,
+            value=(0,0),
+            doc="""\
+The coordinates of the first corner of the covering rectangle on the image, as row,column.
+"""
+        ))
+
+        group.append("second_corner", cellprofiler.setting.Coordinates(
+            text=CORNER_TWO,
+            value=(0,0),
+            doc="""\
+The coordinates of the second corner (opposite of the first corner) of the covering rectangle on the image,
+as row,column.
+"""
+        ))
+
+        group.append("vertices", cellprofiler.setting.Text(
+            text="Vertices",
+            value="",
+            doc="""\
+The coordinates of the vertices of the covering polygon on the image, as row,column pairs separated
+by semicolons (i.e. "10,10; 10,60; 40,35"). At least three vertices are needed.
+"""
+        ))
+
+        if can_remove:
+            group.append("remover", cellprofiler.setting.RemoveSettingButton("", "Remove this region", self.regions, group))
+
+        self.regions.append(group)
 
     #
     # The "settings" method tells CellProfiler about the settings you
@@ -165,12 +239,29 @@ it will fill white.
         settings = super(CoverRectangle, self).settings()
 
         # Append additional settings here.
-        return settings + [
-            self.first_corner,
-            self.second_corner,
-            self.fill_value
+        settings += [
+            self.fill_value,
+            self.in_place,
+            self.region_count
         ]
 
+        for group in self.regions:
+            settings += [group.shape, group.first_corner, group.second_corner, group.vertices]
+
+        return settings
+
+    #
+    # "prepare_settings" is called before the settings of a pipeline are
+    # loaded, and adds or removes regions to match the number of regions
+    # saved in the pipeline.
+    #
+    def prepare_settings(self, setting_values):
+        count = int(setting_values[4])
+
+        del self.regions[count:]
+        while len(self.regions) < count:
+            self.add_region(can_remove=len(self.regions) > 0)
+
     #
     # "visible_settings" tells CellProfiler which settings should be
     # displayed and in what order.
@@ -188,13 +279,71 @@ it will fill white.
 
         # Configure the visibility of additional settings below.
         visible_settings += [
-            self.first_corner,
-            self.second_corner,
-            self.fill_value
+            self.fill_value,
+            self.in_place
         ]
 
+        for group in self.regions:
+            if hasattr(group, "divider"):
+                visible_settings += [group.divider]
+
+            visible_settings += [group.shape]
+
+            if group.shape == SHAPE_POLYGON:
+                visible_settings += [group.vertices]
+            else:
+                visible_settings += [group.first_corner, group.second_corner]
+
+            if hasattr(group, "remover"):
+                visible_settings += [group.remover]
+
+        visible_settings += [self.add_region_button]
+
         return visible_settings
 
+    #
+    # "validate_module" checks the vertices of the polygons before the
+    # pipeline runs.
+    #
+    def validate_module(self, pipeline):
+        for group in self.regions:
+            if group.shape != SHAPE_POLYGON:
+                continue
+
+            try:
+                parse_vertices(group.vertices.value)
+            except ValueError as e:
+                raise cellprofiler.setting.ValidationError(str(e), group.vertices)
+
+    #
+    # "get_template" returns the boolean template of the regions for images
+    # of a given shape. The template is only drawn again when the image
+    # shape or the regions change, so it is drawn once per run for a batch
+    # of same-size images.
+    #
+    def get_template(self, shape, multichannel):
+        rectangles = tuple(
+            (group.first_corner.value, group.second_corner.value)
+            for group in self.regions if group.shape == SHAPE_RECTANGLE
+        )
+        polygons = tuple(
+            parse_vertices(group.vertices.value)
+            for group in self.regions if group.shape == SHAPE_POLYGON
+        )
+
+        #
+        # Color images are covered on every channel (their last axis) and
+        # stacks on every plane (their first axis).
+        #
+        shape = shape[:2] if multichannel else shape[-2:]
+        key = (shape, multichannel, rectangles, polygons)
+
+        if getattr(self, "template_key", None) != key:
+            template = compile_template(shape, rectangles, polygons)
+            self.template = template[:, :, numpy.newaxis] if multichannel else template
+            self.template_key = key
+
+        return self.template
 
     #
     # CellProfiler calls "run" on each image set in your pipeline.
@@ -212,17 +361,89 @@ it will fill white.
         # the module settings as they are returned from "settings" (excluding
         # "self.y_data", or the output image).
         #
-        self.function = cover_rectangle
+        # The regions are passed to "cover" as their compiled template
+        # rather than as the settings of every region.
+        #
+        multichannel = workspace.image_set.get_image(self.x_name.value).multichannel
+
+        self.function = lambda pixels, fill_value, in_place, *args: cover(
+            pixels, self.get_template(pixels.shape, multichannel), fill_value, in_place
+        )
         super(CoverRectangle, self).run(workspace)
 
     #
     # "volumetric" indicates whether or not this module supports 3D images.
-    # The "gradient_image" function is inherently 2D, and we've noted this
-    # in the documentation for the module. Explicitly return False here
-    # to indicate that 3D images are not supported.
+    # The regions are covered on every plane of a stack.
     #
     def volumetric(self):
-        return False
+        return True
+
+    #
+    # "upgrade_settings" converts the settings of pipelines saved with an
+    # older revision of the module. Revision 2 replaced the single rectangle
+    # with a list of regions and added the in-place option.
+    #
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            x_name, y_name, first_corner, second_corner, fill_value = setting_values
+            setting_values = [
+                x_name, y_name, fill_value, cellprofiler.setting.NO, "1",
+                SHAPE_RECTANGLE, first_corner, second_corner, ""
+            ]
+            variable_revision_number = 2
+
+        return setting_values, variable_revision_number, from_matlab
+
+#
+# "parse_vertices" reads the vertices of a polygon, given as
+# "row,column; row,column; ...".
+#
+def parse_vertices(text):
+    vertices = []
+
+    for vertex in text.split(";"):
+        if not vertex.strip():
+            continue
+
+        try:
+            row, column = [int(round(float(c))) for c in vertex.split(",")]
+        except ValueError:
+            raise ValueError(
+                "\"%s\" is not a vertex, enter vertices as \"row,column; row,column; ...\"" % vertex.strip()
+            )
+        vertices.append((row, column))
+
+    if len(vertices) < 3:
+        raise ValueError("A polygon needs at least three vertices")
+
+    return tuple(vertices)
+
+#
+# "rectangle_slices" returns the slices of a rectangle spanning from its
+# first corner up to its second corner, in whichever order the corners are
+# given. Corners outside of the image are clipped to it.
+#
+def rectangle_slices(first_corner, second_corner):
+    return tuple(
+        slice(max(min(a, b), 0), max(a, b, 0))
+        for a, b in zip(first_corner, second_corner)
+    )
+
+#
+# "compile_template" draws the rectangles and polygons into a boolean
+# template of the given (2D) shape, which is True on the covered pixels.
+#
+def compile_template(shape, rectangles=(), polygons=()):
+    template = numpy.zeros(shape, dtype=bool)
+
+    for first_corner, second_corner in rectangles:
+        template[rectangle_slices(first_corner, second_corner)] = True
+
+    for vertices in polygons:
+        rows, columns = zip(*vertices)
+        template[skimage.draw.polygon(rows, columns, shape)] = True
+
+    return template
 
 #
 # This is the function that gets called during "run" to create the output image.
@@ -231,12 +452,24 @@ it will fill white.
 #
 # This function must return the output image data (as a numpy array).
 #
-def cover_rectangle(pixels, first_corner, second_corner, fill_value):
+# The template must broadcast against the image. The covered pixels are
+# filled in one pass, on a copy of the image unless "in_place" is set and
+# the image is writeable.
+#
+def cover(pixels, template, fill_value, in_place=False):
+    if not in_place or not pixels.flags.writeable:
+        pixels = pixels.copy()
+
+    numpy.copyto(pixels, fill_value, casting="unsafe", where=template)
 
-    x1, y1 = first_corner
-    x2, y2 = second_corner
+    return pixels
 
-    outimg = pixels
-    outimg[x1:x2, y1:y2] = fill_value
+#
+# "cover_rectangle" covers a single rectangle, on a copy of the image unless
+# "in_place" is set.
+#
+def cover_rectangle(pixels, first_corner, second_corner, fill_value, in_place=False):
+    outimg = pixels if in_place else pixels.copy()
+    outimg[rectangle_slices(first_corner, second_corner)] = fill_value
 
     return outimg
@@ -0,0 +1,169 @@
+'''
+Skeleton graph analysis shared by the MinaAnalysis plugin and the native
+engine of mcp_batch.
+
+A vectorized equivalent of Fiji's AnalyzeSkeleton for 2D (8-connected) and
+3D (26-connected) skeletons, with NumPy and SciPy only, so it runs both in
+CellProfiler (Python 2) and in the scripts (Python 3) without importing
+either of them.
+'''
+
+import itertools
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+# Skeleton pixel classes, by number of 8-connected (26 in 3D) neighbours
+ENDPOINT = 1 # 0 or 1 neighbours
+SLAB     = 2 # exactly 2 neighbours
+JUNCTION = 3 # 3 or more neighbours
+
+# Pixels per chunk when finding the neighbours of skeleton pixels
+CHUNK_PIXELS = 1 << 24
+
+
+def _half_neighbourhood(ndim):
+    '''
+    Returns the offsets to half of the (8- or 26-connected) neighbourhood of
+    a pixel, so that every pair of neighbours is only visited once. The
+    first nonzero coordinate of each offset is positive.
+    '''
+    return [offset for offset in itertools.product((-1, 0, 1), repeat=ndim)
+            if any(offset) and offset[np.flatnonzero(offset)[0]] > 0]
+
+
+def skeleton_graph(skeleton, spacing=None, chunk_pixels=CHUNK_PIXELS):
+    '''
+    Builds the pixel adjacency graph of a skeleton (its nonzero pixels), in
+    2D (8-connected) or 3D (26-connected).
+
+    Returns the flat indices of the skeleton pixels and, for every pair of
+    neighbours, the indices of both pixels (into that array) and the
+    distance between them, scaled by the pixel spacing. Each pair is listed
+    once.
+
+    The neighbours are found in chunks of about chunk_pixels pixels along
+    the first axis (z for volumes), each with one halo plane after it, so
+    the temporaries stay small however large the image is.
+    '''
+    skeleton = np.ascontiguousarray(skeleton)
+    pixels   = np.flatnonzero(skeleton)
+    strides  = np.array(skeleton.strides) // skeleton.itemsize
+    spacing  = np.ones(skeleton.ndim) if spacing is None else np.asarray(spacing[-skeleton.ndim:], dtype=float)
+
+    offsets = _half_neighbourhood(skeleton.ndim)
+    planes  = int(np.prod(skeleton.shape[1:]))
+    chunk   = max(1, chunk_pixels // max(1, planes))
+
+    heads, tails, lengths = [], [], []
+    for start in range(0, skeleton.shape[0], chunk):
+        stop  = min(start + chunk, skeleton.shape[0])
+        block = skeleton[start:stop + 1] != 0 # One halo plane
+
+        for offset in offsets:
+            # Pairs are only taken from heads within the chunk. Offsets never
+            # point backwards along the first axis, so the halo is enough.
+            here  = [slice(max(0, -d), n - max(0, d)) for n, d in zip(block.shape, offset)]
+            here[0] = slice(0, min(here[0].stop, stop - start))
+            there = [slice(h.start + d, h.stop + d) for h, d in zip(here, offset)]
+
+            coords = np.nonzero(block[tuple(here)] & block[tuple(there)])
+            if len(coords[0]) == 0:
+                continue
+            head = np.ravel_multi_index(
+                [c + h.start + (start if axis == 0 else 0) for axis, (c, h) in enumerate(zip(coords, here))],
+                skeleton.shape)
+
+            heads.append(head)
+            tails.append(head + np.dot(offset, strides))
+            lengths.append(np.full(len(head), np.sqrt(np.sum((np.array(offset) * spacing) ** 2))))
+
+    empty   = [np.empty(0, dtype=np.intp)]
+    heads   = np.searchsorted(pixels, np.concatenate(heads + empty))
+    tails   = np.searchsorted(pixels, np.concatenate(tails + empty))
+    lengths = np.concatenate(lengths + [np.empty(0)])
+
+    return pixels, heads, tails, lengths
+
+
+def _connected_components(n_nodes, heads, tails):
+    ''' Labels the connected components of an undirected graph given as an edge list. '''
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(heads), dtype=np.int8), (heads, tails)), shape=(n_nodes, n_nodes))
+    return scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+
+def analyze_skeleton(skeleton, spacing=None, labels=None):
+    '''
+    Vectorized equivalent of Fiji's AnalyzeSkeleton for a binary 2D or 3D
+    skeleton (with the pixel spacing, if given).
+
+    If a label image is given, pixels of different labels are not linked,
+    so every skeleton lies within one object (label 0 being the background).
+
+    Pixels are classified by their number of neighbours into end points,
+    slabs and junctions, and touching junction pixels are merged into one
+    vertex. Every run of slab pixels is a branch, as is every direct link
+    between two distinct vertices. Branch lengths include the step onto the
+    vertices at both ends.
+
+    Returns a dict with:
+        component_branches - number of branches of each skeleton (component)
+        component_lengths  - summed branch length of each skeleton
+        branch_lengths     - length of every branch
+        branch_components  - index of the skeleton every branch belongs to
+        component_labels   - label of each skeleton (with a label image only)
+    '''
+    pixels, heads, tails, lengths = skeleton_graph(skeleton, spacing)
+    n_pixels = len(pixels)
+
+    if labels is not None:
+        pixel_labels = np.ravel(labels)[pixels]
+        keep = pixel_labels[heads] == pixel_labels[tails]
+        heads, tails, lengths = heads[keep], tails[keep], lengths[keep]
+
+    n_components, components = _connected_components(n_pixels, heads, tails)
+
+    neighbours = np.bincount(np.concatenate((heads, tails)), minlength=n_pixels)
+    kind = np.full(n_pixels, SLAB, dtype=np.int8)
+    kind[neighbours < 2] = ENDPOINT
+    kind[neighbours > 2] = JUNCTION
+
+    # Group touching junction pixels into vertices and slab pixels into
+    # branches. End points are never merged, so each is its own element.
+    merge = (kind[heads] == kind[tails]) & (kind[heads] != ENDPOINT)
+    n_elements, elements = _connected_components(n_pixels, heads[merge], tails[merge])
+
+    element_kind = np.zeros(n_elements, dtype=np.int8)
+    element_kind[elements] = kind
+    element_components = np.zeros(n_elements, dtype=np.intp)
+    element_components[elements] = components
+
+    # Every link touching a slab adds to the length of that slab's branch
+    owner = np.where(kind[heads] == SLAB, elements[heads],
+                     np.where(kind[tails] == SLAB, elements[tails], -1))
+    slab_lengths = np.bincount(owner[owner >= 0], weights=lengths[owner >= 0],
+                               minlength=n_elements)
+    slabs = np.flatnonzero(element_kind == SLAB)
+
+    # Links between two different vertices are branches of their own
+    direct = (owner < 0) & (elements[heads] != elements[tails])
+
+    branch_lengths    = np.concatenate((slab_lengths[slabs], lengths[direct]))
+    branch_components = np.concatenate((element_components[slabs], components[heads[direct]]))
+
+    skeleton = {
+        "component_branches": np.bincount(branch_components, minlength=n_components),
+        "component_lengths" : np.bincount(branch_components, weights=branch_lengths,
+                                          minlength=n_components),
+        "branch_lengths"    : branch_lengths,
+        "branch_components" : branch_components,
+    }
+
+    if labels is not None:
+        component_labels = np.zeros(n_components, dtype=np.intp)
+        component_labels[components] = pixel_labels
+        skeleton["component_labels"] = component_labels
+
+    return skeleton
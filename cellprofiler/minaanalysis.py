@@ -7,24 +7,69 @@ MinaAnalysis
 ============ ============ ===============
 Supports 2D? Supports 3D? Respects masks?
 ============ ============ ===============
-YES          NO           NO
+YES          YES          NO
 ============ ============ ===============
 
 Designed for Cellprofiler 3.1.9.
 '''
 
 import os
+import sys
 import cellprofiler.image as cpi
+import cellprofiler.measurement as cpmeas
 import cellprofiler.module as cpm
 import cellprofiler.preferences as cpp
 import cellprofiler.setting as cps
 
 import numpy as np
 
+# The skeleton analysis is shared with the scripts, in a module next to
+# this plugin
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if PLUGIN_DIRECTORY not in sys.path:
+    sys.path.append(PLUGIN_DIRECTORY)
+
+from mina_skeleton import analyze_skeleton
+
+C_MINA = "Mina"
+
+F_PUNCTATE_COUNT        = "PunctateCount"
+F_ROD_COUNT             = "RodCount"
+F_NETWORK_COUNT         = "NetworkCount"
+F_BRANCH_LEN_MEAN       = "BranchLengthMean"
+F_BRANCH_LEN_MEDIAN     = "BranchLengthMedian"
+F_BRANCH_LEN_STDEVP     = "BranchLengthStdevp"
+F_SUMMED_LEN_MEAN       = "SummedBranchLengthsMean"
+F_SUMMED_LEN_MEDIAN     = "SummedBranchLengthsMedian"
+F_SUMMED_LEN_STDEVP     = "SummedBranchLengthsStdevp"
+F_NETWORK_BRANCH_MEAN   = "NetworkBranchesMean"
+F_NETWORK_BRANCH_MEDIAN = "NetworkBranchesMedian"
+F_NETWORK_BRANCH_STDEVP = "NetworkBranchesStdevp"
+F_FOOTPRINT             = "Footprint"
+
+# (feature, statistics table title, is a length)
+FEATURES = [
+    (F_PUNCTATE_COUNT,        "punctate count",               False),
+    (F_ROD_COUNT,             "rod count",                    False),
+    (F_NETWORK_COUNT,         "network count",                False),
+    (F_BRANCH_LEN_MEAN,       "branch length mean",           True),
+    (F_BRANCH_LEN_MEDIAN,     "branch length median",         True),
+    (F_BRANCH_LEN_STDEVP,     "branch length stdevp",         True),
+    (F_SUMMED_LEN_MEAN,       "summed branch lengths mean",   True),
+    (F_SUMMED_LEN_MEDIAN,     "summed branch lengths median", True),
+    (F_SUMMED_LEN_STDEVP,     "summed branch lengths stdevp", True),
+    (F_NETWORK_BRANCH_MEAN,   "network branches mean",        False),
+    (F_NETWORK_BRANCH_MEDIAN, "network branches median",      False),
+    (F_NETWORK_BRANCH_STDEVP, "network branches stdevp",      False),
+]
+
+# Measured when a threshold image is given (an area, or a volume in 3D)
+FOOTPRINT_FEATURE = (F_FOOTPRINT, "footprint", False)
+
 class MinaAnalysis(cpm.Module):
     category    = "Advanced"
     module_name = "MinaAnalysis"
-    variable_revision_number = 1
+    variable_revision_number = 2
 
     def create_settings(self):
         self.skel_image = cps.ImageNameSubscriber(
@@ -75,6 +120,22 @@ For example, if 1 micrometer is equivalent to 50 pixels in the image, the value
 in this box would be 50.
         """)
 
+        self.use_objects = cps.Binary(
+            text="Measure per object?",
+            value=False,
+            doc = """\
+If set to \"Yes\", the statistics are also measured for every object (i.e.
+cell) of a label image, in a single pass over the whole skeleton. Skeletons
+are cut at object borders and the parts outside any object are ignored.
+        """)
+
+        self.objects_name = cps.ObjectNameSubscriber(
+            text="Objects",
+            doc = """\
+The objects (i.e. cells from **IdentifyPrimaryObjects**) that the statistics
+are measured for.
+        """)
+
     def settings(self):
         ''' Returns all the settings available so CellProifler can track them. '''
         return [
@@ -83,7 +144,9 @@ in this box would be 50.
             self.threshold_image,
             self.use_custom_units,
             self.unit_name,
-            self.unit_ratio
+            self.unit_ratio,
+            self.use_objects,
+            self.objects_name
         ]
     
     def visible_settings(self):
@@ -98,64 +161,254 @@ in this box would be 50.
         if self.use_custom_units:
             visible_settings += [self.unit_name, self.unit_ratio]
 
+        visible_settings += [self.use_objects]
+
+        if self.use_objects:
+            visible_settings += [self.objects_name]
+
         return visible_settings
 
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            # Added the per-object measurements
+            setting_values = setting_values + [cps.NO, "None"]
+            variable_revision_number = 2
+
+        return setting_values, variable_revision_number, from_matlab
+
     def volumetric(self):
-        return False
+        return True
 
     def run(self, workspace):
         # Put the measurements made in the measurements object
         measurements = workspace.measurements
-        
-        # Record some statistics to be displayed later.
-        # We format them so that Matplotlib can display them in a table.
-        # The first row is a header that tells what the fields are.
-        statistics = [[
-            "high contrast",
-            "low contrast",
-            "line width",
-            "minimum line length",
-            "mitochondrial footprint",
-            "branch length mean",
-            "branch length median",
-            "branch length stdevp",
-            "summed branch lengths mean",
-            "summed branch lengths median",
-            "summed branch lengths stdevp",
-            "network branches mean",
-            "network branches median",
-            "network branches stdevp"
-        ]]
-
-        workspace.display_data.statistics = statistics # Put the statistics in the workspace 
-                                                       # display data so they can be plotted in MPL
 
         image_set = workspace.image_set
 
         skel_name   = self.skel_image.value
         skel_image  = image_set.get_image(skel_name, must_be_grayscale=True)
-        skel_pixels = skel_image.pixel_data # 2d numpy array
+        skel_pixels = skel_image.pixel_data # 2d or 3d numpy array
+
+        # Analyze the skeleton (its nonzero pixels)
+        skeleton = analyze_skeleton(skel_pixels, skel_image.spacing)
+        values   = summarize_skeleton(skeleton)
 
         # Get the mitochondrial footprint, if a threshold image was provided
         if self.use_threshold:
             thresh_name   = self.threshold_image.value
             thresh_image  = image_set.get_image(thresh_name, must_be_grayscale=True)
-            thresh_pixels = thresh_image.pixel_data # 2d numpy array
+            thresh_pixels = thresh_image.pixel_data
+
+            # Calculate the mitochondrial footprint over the whole image (or volume)
+            values[F_FOOTPRINT] = footprint(thresh_pixels, thresh_image.spacing)
+
+        self.scale_units(values, skel_pixels.ndim)
+
+        for feature, _, _ in self.get_features():
+            measurements.add_image_measurement(
+                self.get_feature_name(feature), values[feature])
+
+        # Measure every object at once, from the skeleton cut at the object borders
+        if self.use_objects:
+            objects = workspace.object_set.get_objects(self.objects_name.value)
+            labels  = objects.segmented
+
+            object_skeleton = analyze_skeleton(skel_pixels, skel_image.spacing, labels)
+            object_values   = summarize_objects(object_skeleton, objects.count)
+
+            if self.use_threshold:
+                object_values[F_FOOTPRINT] = footprint(
+                    thresh_pixels, thresh_image.spacing, labels, objects.count)
+
+            self.scale_units(object_values, skel_pixels.ndim)
+
+            for feature, _, _ in self.get_features():
+                measurements.add_measurement(
+                    self.objects_name.value, self.get_feature_name(feature), object_values[feature])
+
+        # Record some statistics to be displayed later.
+        # We format them so that Matplotlib can display them in a table.
+        # The first row is a header that tells what the fields are.
+        statistics = [
+            [title for _, title, _ in self.get_features()],
+            [values[feature] for feature, _, _ in self.get_features()]
+        ]
+
+        workspace.display_data.statistics = statistics # Put the statistics in the workspace 
+                                                       # display data so they can be plotted in MPL
+
+    def display(self, workspace, figure):
+        figure.set_subplots((1, 1))
+        figure.subplot_table(0, 0, workspace.display_data.statistics)
+
+    def scale_units(self, values, ndim):
+        ''' Converts the lengths (and the footprint) in values to the custom units, if used. '''
+        if not self.use_custom_units:
+            return
+
+        for feature, _, is_length in FEATURES:
+            if is_length:
+                values[feature] = values[feature] / self.unit_ratio.value
+
+        if F_FOOTPRINT in values:
+            values[F_FOOTPRINT] = values[F_FOOTPRINT] / self.unit_ratio.value ** ndim
+
+    def get_features(self):
+        ''' Returns the (feature, title, is a length) of every measurement made. '''
+        if self.use_threshold:
+            return FEATURES + [FOOTPRINT_FEATURE]
+        return FEATURES
+
+    def get_feature_name(self, feature):
+        ''' Returns the full measurement name of a feature for the skeleton image. '''
+        return "_".join((C_MINA, feature, self.skel_image.value))
+
+    def get_measured_objects(self):
+        ''' Returns the objects (the image and the per-object objects, if any) that are measured. '''
+        if self.use_objects:
+            return [cpmeas.IMAGE, self.objects_name.value]
+        return [cpmeas.IMAGE]
+
+    def get_measurement_columns(self, pipeline):
+        return [
+            (object_name, self.get_feature_name(feature), cpmeas.COLTYPE_FLOAT)
+            for object_name in self.get_measured_objects()
+            for feature, _, _ in self.get_features()
+        ]
+
+    def get_categories(self, pipeline, object_name):
+        if object_name in self.get_measured_objects():
+            return [C_MINA]
+        return []
+
+    def get_measurement_names(self, pipeline, object_name, category):
+        if object_name in self.get_measured_objects() and category == C_MINA:
+            return [feature for feature, _, _ in self.get_features()]
+        return []
+
+    def get_measurement_images(self, pipeline, object_name, category, measurement):
+        if measurement in self.get_measurement_names(pipeline, object_name, category):
+            return [self.skel_image.value]
+        return []
+
+
+def footprint(binary, spacing=None, labels=None, n_labels=0):
+    '''
+    Returns the area (2D) or volume (3D) of the foreground of a binary image.
+
+    The foreground is counted once over the whole image or volume and
+    scaled by the pixel (voxel) spacing, if given. With a label image, the
+    footprint of each of the labels 1 to n_labels is returned as an array.
+    '''
+    size = 1.0
+    if spacing is not None:
+        size = float(np.prod(spacing[-binary.ndim:]))
+
+    if labels is not None:
+        return np.bincount(labels[binary != 0], minlength=n_labels + 1)[1:n_labels + 1] * size
+    return np.count_nonzero(binary) * size
+
+
+def _mean_median_stdevp(values):
+    ''' Returns the mean, median and population standard deviation, or zeros if empty. '''
+    if len(values) == 0:
+        return 0.0, 0.0, 0.0
+    return float(np.mean(values)), float(np.median(values)), float(np.std(values))
+
+
+def _grouped_mean_median_stdevp(groups, values, n_groups):
+    '''
+    Returns the mean, median and population standard deviation of the values
+    of each group 1 to n_groups (zeros for empty groups) as arrays.
+    '''
+    if len(values) == 0:
+        return np.zeros(n_groups), np.zeros(n_groups), np.zeros(n_groups)
+
+    values = np.asarray(values, dtype=float)
+    counts = np.bincount(groups, minlength=n_groups + 1)
+    safe   = np.maximum(counts, 1)
+
+    means = np.bincount(groups, weights=values, minlength=n_groups + 1) / safe
+    sqdev = np.bincount(groups, weights=(values - means[groups]) ** 2, minlength=n_groups + 1)
+
+    # The median of each group is picked from the values sorted by group
+    ordered = values[np.lexsort((values, groups))]
+    starts  = np.cumsum(counts) - counts
+    last    = len(ordered) - 1
+    medians = (ordered[np.minimum(starts + (counts - 1) // 2, last)] +
+               ordered[np.minimum(starts + counts // 2, last)]) / 2.0
+    medians[counts == 0] = 0.0
+
+    groups = slice(1, n_groups + 1)
+    return means[groups], medians[groups], np.sqrt(sqdev / safe)[groups]
+
+
+def summarize_skeleton(skeleton):
+    '''
+    Computes the MiNA statistics of a skeleton analyzed with **analyze_skeleton**.
+
+    Skeletons without branches are punctate, skeletons with one branch are
+    rods and skeletons with more than one branch are networks.
+    '''
+    branches = skeleton["component_branches"]
+    summed   = skeleton["component_lengths"]
+    networks = branches[branches > 1]
+
+    values = {
+        F_PUNCTATE_COUNT: int(np.count_nonzero(branches == 0)),
+        F_ROD_COUNT     : int(np.count_nonzero(branches == 1)),
+        F_NETWORK_COUNT : len(networks),
+    }
+
+    (values[F_BRANCH_LEN_MEAN],
+     values[F_BRANCH_LEN_MEDIAN],
+     values[F_BRANCH_LEN_STDEVP]) = _mean_median_stdevp(skeleton["branch_lengths"])
+
+    (values[F_SUMMED_LEN_MEAN],
+     values[F_SUMMED_LEN_MEDIAN],
+     values[F_SUMMED_LEN_STDEVP]) = _mean_median_stdevp(summed[summed > 0])
+
+    (values[F_NETWORK_BRANCH_MEAN],
+     values[F_NETWORK_BRANCH_MEDIAN],
+     values[F_NETWORK_BRANCH_STDEVP]) = _mean_median_stdevp(networks)
+
+    return values
+
+
+def summarize_objects(skeleton, n_objects):
+    '''
+    Computes the MiNA statistics of every object (labels 1 to n_objects) of
+    a skeleton analyzed with **analyze_skeleton** and a label image.
+
+    Returns the statistics as arrays with one value per object.
+    '''
+    branches = skeleton["component_branches"]
+    summed   = skeleton["component_lengths"]
+    labels   = skeleton["component_labels"]
+    networks = branches > 1
 
-            # Calculate the mitochondrial footprint
-            footprint = np.count_nonzero(thresh_pixels)         # Number of nonzero pixels
-            
-            if self.use_custom_units:
-                footprint /= (self.unit_ratio.value ** 2)
-                print('Footprint (units^2):', footprint)
-            else:
-                print('Footprint (px):', footprint)
-            # TODO add footprint to values
+    def count(selected):
+        return np.bincount(labels[selected], minlength=n_objects + 1)[1:n_objects + 1]
 
-        # Analyze the skeleton
+    values = {
+        F_PUNCTATE_COUNT: count(branches == 0),
+        F_ROD_COUNT     : count(branches == 1),
+        F_NETWORK_COUNT : count(networks),
+    }
 
+    (values[F_BRANCH_LEN_MEAN],
+     values[F_BRANCH_LEN_MEDIAN],
+     values[F_BRANCH_LEN_STDEVP]) = _grouped_mean_median_stdevp(
+        labels[skeleton["branch_components"]], skeleton["branch_lengths"], n_objects)
 
-        
+    (values[F_SUMMED_LEN_MEAN],
+     values[F_SUMMED_LEN_MEDIAN],
+     values[F_SUMMED_LEN_STDEVP]) = _grouped_mean_median_stdevp(
+        labels[summed > 0], summed[summed > 0], n_objects)
 
-        
+    (values[F_NETWORK_BRANCH_MEAN],
+     values[F_NETWORK_BRANCH_MEDIAN],
+     values[F_NETWORK_BRANCH_STDEVP]) = _grouped_mean_median_stdevp(
+        labels[networks], branches[networks], n_objects)
 
+    return values
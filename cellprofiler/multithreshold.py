@@ -0,0 +1,235 @@
+'''
+MultiThreshold
+==========================
+
+**MultiThreshold** thresholds an image with any number of the automatic
+thresholding methods of the Fiji macro (ImageJ's Auto Threshold), from a
+single histogram of the image.
+
+The histogram is computed once per image, with the bin of every pixel, and
+every method picks its threshold bin from the same counts. Each method
+records its threshold as a measurement and can output its mask, so the
+methods can be compared in one run of the pipeline.
+
+============ ============ ===============
+Supports 2D? Supports 3D? Respects masks?
+============ ============ ===============
+YES          YES          YES
+============ ============ ===============
+
+What do I get as output?
+^^^^^^^^^^^^^^^^^^^^^^^^
+
+A binary image per method (optional), of the pixels in the bins above the
+method's threshold bin, like ImageJ's ``threshold`` ops.
+
+Measurements made by this module
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+-  *Threshold_<method>*: The threshold of the method, in the intensity units
+   of the image (the upper edge of its threshold bin).
+
+Technical notes
+^^^^^^^^^^^^^^^
+
+The histogram has *N* equal bins over the range of the (masked) pixels, as
+ImageJ's ops do for non 8-bit images. The methods are ports of ImageJ's
+``AutoThresholder`` (G. Landini) and of Antti Niemisto's HistThresh toolbox
+(maxLikelihood), with Rosin's unimodal method for rosin.
+scripts/check_auto_threshold.py checks them against line by line
+translations of the original loops.
+
+Designed for Cellprofiler 3.1.9.
+'''
+
+import os
+import sys
+
+import cellprofiler.image as cpi
+import cellprofiler.measurement as cpmeas
+import cellprofiler.module as cpm
+import cellprofiler.setting as cps
+
+# The thresholding methods are shared with scripts/check_auto_threshold.py,
+# in a module next to this plugin
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+if PLUGIN_DIRECTORY not in sys.path:
+    sys.path.append(PLUGIN_DIRECTORY)
+
+from auto_threshold import METHODS, ImageHistogram, threshold_bin
+
+C_THRESHOLD = "Threshold"
+
+
+class MultiThreshold(cpm.Module):
+    category    = "Image Processing"
+    module_name = "MultiThreshold"
+    variable_revision_number = 1
+
+    def create_settings(self):
+        self.image_name = cps.ImageNameSubscriber(
+            text="Select the input image",
+            doc = """\
+The grayscale image (or stack) to threshold. If it has a mask, only the
+pixels inside the mask make the histogram and the masks of the methods are
+empty outside of it.
+        """)
+
+        self.nbins = cps.Integer(
+            text="Number of bins",
+            value=256,
+            minval=2,
+            maxval=65536,
+            doc = """\
+The number of bins of the histogram the thresholds are computed from. The
+Fiji macro uses 256.
+
+*huang* and *shanbhag* compare every pair of nonempty bins, so their time
+grows with the square of the bins: under a second at 4096 bins, but most of
+a minute at 65536 bins of a 16-bit image that fills them.
+        """)
+
+        self.save_masks = cps.Binary(
+            text="Save the masks as images?",
+            value=True,
+            doc = """\
+If set to \"Yes\", the mask of every method is made available to later
+modules. Otherwise only the thresholds are measured.
+        """)
+
+        self.methods = []
+        self.method_count = cps.HiddenCount(self.methods, "Method count")
+        self.add_method(can_remove=False)
+
+        self.add_method_button = cps.DoSomething("", "Add another method", self.add_method)
+
+    def add_method(self, can_remove=True):
+        ''' Adds a thresholding method (and its output image) to the module. '''
+        group = cps.SettingsGroup()
+
+        if can_remove:
+            group.append("divider", cps.Divider(line=False))
+
+        group.append("method", cps.Choice(
+            text="Thresholding method",
+            choices=sorted(METHODS),
+            value="otsu",
+            doc = """\
+The thresholding method, named as in the Fiji macro (ImageJ's ``threshold``
+ops).
+        """))
+
+        group.append("output_name", cps.ImageNameProvider(
+            text="Name the output image",
+            value="Threshold%d" % (len(self.methods) + 1),
+            doc = """\
+The name of the mask of this method.
+        """))
+
+        if can_remove:
+            group.append("remover", cps.RemoveSettingButton("", "Remove this method", self.methods, group))
+
+        self.methods.append(group)
+
+    def settings(self):
+        ''' Returns all the settings available so CellProifler can track them. '''
+        settings = [self.image_name, self.nbins, self.save_masks, self.method_count]
+
+        for group in self.methods:
+            settings += [group.method, group.output_name]
+
+        return settings
+
+    def prepare_settings(self, setting_values):
+        ''' Adds or removes methods to match the number of methods saved in the pipeline. '''
+        count = int(setting_values[3])
+
+        del self.methods[count:]
+        while len(self.methods) < count:
+            self.add_method(can_remove=len(self.methods) > 0)
+
+    def visible_settings(self):
+        ''' Returns what settings should be displayed and in what order. '''
+        visible_settings = [self.image_name, self.nbins, self.save_masks]
+
+        for group in self.methods:
+            visible_settings += [group.method]
+
+            if self.save_masks:
+                visible_settings += [group.output_name]
+
+            if hasattr(group, "remover"):
+                visible_settings += [group.divider, group.remover]
+
+        visible_settings += [self.add_method_button]
+
+        return visible_settings
+
+    def validate_module(self, pipeline):
+        methods = set()
+        for group in self.methods:
+            if group.method.value in methods:
+                raise cps.ValidationError(
+                    "The %s method is used more than once" % group.method.value, group.method)
+            methods.add(group.method.value)
+
+    def volumetric(self):
+        return True
+
+    def run(self, workspace):
+        measurements = workspace.measurements
+
+        image  = workspace.image_set.get_image(self.image_name.value, must_be_grayscale=True)
+        pixels = image.pixel_data
+
+        # One pass over the image for all the methods
+        histogram = ImageHistogram(pixels, self.nbins.value, image.mask if image.has_mask else None)
+
+        statistics = [["Method", "Threshold"]]
+
+        for group in self.methods:
+            method    = group.method.value
+            bin       = threshold_bin(method, histogram.counts)
+            threshold = histogram.threshold(bin)
+
+            measurements.add_image_measurement(self.get_feature_name(method), threshold)
+            statistics.append([method, threshold])
+
+            if self.save_masks:
+                output = cpi.Image(
+                    image=histogram.binarize(bin),
+                    parent_image=image,
+                    dimensions=image.dimensions,
+                    convert=False)
+                workspace.image_set.add(group.output_name.value, output)
+
+        workspace.display_data.statistics = statistics
+
+    def display(self, workspace, figure):
+        figure.set_subplots((1, 1))
+        figure.subplot_table(0, 0, workspace.display_data.statistics)
+
+    def get_feature_name(self, method):
+        ''' Returns the full measurement name of a method's threshold. '''
+        return "_".join((C_THRESHOLD, method, self.image_name.value))
+
+    def get_measurement_columns(self, pipeline):
+        return [
+            (cpmeas.IMAGE, self.get_feature_name(group.method.value), cpmeas.COLTYPE_FLOAT)
+            for group in self.methods
+        ]
+
+    def get_categories(self, pipeline, object_name):
+        if object_name == cpmeas.IMAGE:
+            return [C_THRESHOLD]
+        return []
+
+    def get_measurement_names(self, pipeline, object_name, category):
+        if object_name == cpmeas.IMAGE and category == C_THRESHOLD:
+            return [group.method.value for group in self.methods]
+        return []
+
+    def get_measurement_images(self, pipeline, object_name, category, measurement):
+        if measurement in self.get_measurement_names(pipeline, object_name, category):
+            return [self.image_name.value]
+        return []
@@ -12,6 +12,9 @@ The filename for an exported image is formatted as "{object name}_{label index}.
 is the name of the exported objects, *label index* is the integer label of the object exported in the image (starting
 from 1).
 
+With the hdf5 file format, all the objects of an image set are saved to a single
+"{file name}.h5" file instead, cropped to their bounding boxes and indexed by label.
+
 |
 
 ============ ============ ===============
@@ -22,12 +25,20 @@ YES          NO           YES
 
 """
 
+import atexit
+import h5py
 import numpy
 import os.path
+import scipy.ndimage
 import skimage.io
-import skimage.measure
+import threading
 import time
 
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
 import cellprofiler.module
 import cellprofiler.setting
 
@@ -40,6 +51,10 @@ SEQUENTIAL_NUMBER_TEXT = "Enter file prefix"
 
 FF_PNG  = "png"
 FF_TIFF = "tiff"
+FF_HDF5 = "hdf5 (one file per image set)"
+
+# Bytes per chunk of the crops in HDF5 containers
+CONTAINER_CHUNK_SIZE = 1 << 16
 
 PC_WITH_IMAGE = "Same folder as image"
 
@@ -49,18 +64,23 @@ WS_LAST_CYCLE = "Last cycle"
 
 SAVE_PER_OBJECT = "Images"
 SAVE_MASK = "Masks"
+SAVE_CROPPED_MASK = "Cropped masks"
+
+WAIT_EVERY_CYCLE = "End of every cycle"
+WAIT_END_OF_RUN  = "End of the run"
 
 class SaveCroppedObjectsPlusPlus(cellprofiler.module.Module):
 	module_name = "SaveCroppedObjects++"
 	category = "File Processing"
-	variable_revision_number = 3
+	variable_revision_number = 5
 
 	def create_settings(self):
 		self.export_option = cellprofiler.setting.Choice(
 			"Do you want to save cropped images or object masks?",
 			[
 				SAVE_PER_OBJECT,
-				SAVE_MASK
+				SAVE_MASK,
+				SAVE_CROPPED_MASK
 			],
 			doc="""\
 Choose the way you want the per-object crops to be exported.
@@ -69,9 +89,14 @@ The choices are:
 
 -  *{SAVE_PER_OBJECT}*: Save a per-object crop from the original image
    based on the object's bounding box.
--  *{SAVE_MASK}*: Export a per-object mask.""".format(
+-  *{SAVE_MASK}*: Export a per-object mask.
+-  *{SAVE_CROPPED_MASK}*: Export a per-object mask of the object's bounding
+   box only. The position of the box in the image is appended to the file
+   name, i.e. "..._7_y120_x64.tiff" ("..._7_z3_y120_x64.tiff" in 3D), so
+   the full mask can be rebuilt.""".format(
 				SAVE_PER_OBJECT=SAVE_PER_OBJECT,
-				SAVE_MASK=SAVE_MASK
+				SAVE_MASK=SAVE_MASK,
+				SAVE_CROPPED_MASK=SAVE_CROPPED_MASK
 			)
 		)
 
@@ -208,13 +233,22 @@ automatically.
 			"Saved file format",
 			[
 				FF_PNG,
-				FF_TIFF
+				FF_TIFF,
+				FF_HDF5
 			],
 			value=FF_TIFF,
 			doc="""\
-*{FF_PNG}* files do not support 3D. *{FF_TIFF}* files use zlib compression level 6.""".format(**{
+*{FF_PNG}* files do not support 3D. *{FF_TIFF}* files use zlib compression level 6.
+
+*{FF_HDF5}* saves all the objects of an image set in a single
+"{{file name}}.h5" file instead of one file per object. Each object is
+cropped to its bounding box (masks included) and the crops are stored in
+one chunked dataset with gzip compression level 6, next to an index of
+the label, offset, bounding box and shape of every object. Single objects
+can then be read without reading the whole file.""".format(**{
 				"FF_PNG": FF_PNG,
-				"FF_TIFF": FF_TIFF
+				"FF_TIFF": FF_TIFF,
+				"FF_HDF5": FF_HDF5
 			})
 		)
 
@@ -267,6 +301,53 @@ prompt.""".format(**{
 			})
 		)
 
+		self.writer_threads = cellprofiler.setting.Integer(
+			"Number of writer threads",
+			4,
+			minval=0,
+			doc="""\
+Number of background threads that compress and write the files, so the
+module does not wait on each file in turn. Enter 0 to write every file
+before moving on to the next object."""
+		)
+
+		self.wait_for_writes = cellprofiler.setting.Choice(
+			"Wait for the files to be written at the",
+			[
+				WAIT_EVERY_CYCLE,
+				WAIT_END_OF_RUN
+			],
+			WAIT_EVERY_CYCLE,
+			doc="""\
+*(Used only when writing in the background)*
+
+-  *{WAIT_EVERY_CYCLE}*: The module returns once all the files of the cycle
+   are written, so any write error stops the cycle that caused it.
+-  *{WAIT_END_OF_RUN}*: The files are written while the next modules and
+   cycles run. Write errors are reported by the next cycle, and the run
+   waits for the remaining files at the end of each group of image sets
+   (or of the run, without groups).""".format(**{
+				"WAIT_EVERY_CYCLE": WAIT_EVERY_CYCLE,
+				"WAIT_END_OF_RUN": WAIT_END_OF_RUN
+			})
+		)
+
+		self.pack_masks = cellprofiler.setting.Binary(
+			"Bit-pack the masks?",
+			False,
+			doc="""\
+*(Used only when saving masks to {FF_HDF5} files)*
+
+Select "*{YES}*" to store the masks with 8 pixels per byte (see
+numpy.packbits) instead of one byte per pixel. **read_crop** unpacks
+them.""".format(**{
+				"FF_HDF5": FF_HDF5,
+				"YES": cellprofiler.setting.YES
+			})
+		)
+
+		self.writer = None
+
 	def display(self, workspace, figure):
 		figure.set_subplots((1, 1))
 		figure.subplot_table(0, 0, [["\n".join(workspace.display_data.filenames)]])
@@ -343,40 +424,94 @@ prompt.""".format(**{
 	def run(self, workspace):
 		objects       = workspace.object_set.get_objects(self.objects_name.value)
 		labels        = objects.segmented
-		unique_labels = numpy.unique(labels)
 
-		if unique_labels[0] == 0:
-			unique_labels = unique_labels[1:]
+		# Bounding box of every label, found in a single pass over the label image
+		bounding_boxes = scipy.ndimage.find_objects(labels)
+
+		if self.export_option == SAVE_PER_OBJECT:
+			pixel_data = workspace.image_set.get_image(self.image_name.value).pixel_data
 
 		filenames = []
 		filename_base = self.get_filename_base(workspace)
 		timestamp = str(int(time.time() * 1000))
 
-		for label in unique_labels:
-			if self.export_option == SAVE_MASK:
-				mask = labels == label
+		writer = self.get_writer()
+
+		# Containers hold all the crops of the image set
+		container = self.file_format.value == FF_HDF5
+		crops     = []
+
+		for index, bounding_box in enumerate(bounding_boxes):
+			if bounding_box is None:
+				continue # Label not in use
+			label = index + 1
+
+			# The object's pixels within its bounding box
+			object_mask = labels[bounding_box] == label
+
+			if self.export_option == SAVE_CROPPED_MASK or (self.export_option == SAVE_MASK and container):
+				mask = object_mask # The bounding box goes in the file name (or index)
+
+			elif self.export_option == SAVE_MASK:
+				mask = numpy.zeros(labels.shape, dtype=bool)
+				mask[bounding_box] = object_mask
 
 			elif self.export_option == SAVE_PER_OBJECT:
-				mask_in = labels == label
-				images = workspace.image_set
-				x = images.get_image(self.image_name.value)
-				properties = skimage.measure.regionprops(mask_in.astype(int), intensity_image=x.pixel_data)
-				mask = properties[0].intensity_image
+				# Crop of the image with the pixels of other objects set to 0
+				crop = pixel_data[bounding_box]
+				if crop.ndim > object_mask.ndim:
+					object_mask = object_mask[..., numpy.newaxis] # Color channels
+				mask = numpy.where(object_mask, crop, 0).astype(crop.dtype)
 
-				print("FILE FORMAT: ", self.file_format)
+			if container:
+				crops.append((label, bounding_box, mask))
+				continue
+
+			name = filename_base + "_" + str(label)
+			if self.export_option == SAVE_CROPPED_MASK:
+				name += bounding_box_suffix(bounding_box)
 
 			if self.file_format.value == FF_PNG:
-				filename = filename_base + "_" + str(label) + ".png"
-				skimage.io.imsave(filename, skimage.img_as_ubyte(mask))
+				filename = name + ".png"
+				writer.write(filename, mask)
 			elif self.file_format.value == FF_TIFF:
-				filename = filename_base + "_" + str(label) + ".tiff"
-				skimage.io.imsave(filename, skimage.img_as_ubyte(mask), compress=6)
+				filename = name + ".tiff"
+				writer.write(filename, mask, compress=6)
+
+			filenames.append(filename)
 
+		if container:
+			filename = filename_base + ".h5"
+			packed = self.pack_masks.value and self.export_option != SAVE_PER_OBJECT
+			writer.write_container(filename, crops, packed)
 			filenames.append(filename)
 
+		if self.wait_for_writes == WAIT_EVERY_CYCLE:
+			writer.flush()
+
 		if self.show_window:
 			workspace.display_data.filenames = filenames
 
+	def get_writer(self):
+		""" Returns the writer of this run, starting it on the first cycle. """
+		if self.writer is None:
+			self.writer = CropWriter(self.writer_threads.value)
+		return self.writer
+
+	def close_writer(self):
+		""" Waits for the files still being written and reports their errors. """
+		if self.writer is not None:
+			writer, self.writer = self.writer, None
+			writer.close()
+
+	def post_group(self, workspace, grouping):
+		# Runs in the worker that wrote the group's files (post_run runs in
+		# the main process, which has no writer of its own)
+		self.close_writer()
+
+	def post_run(self, workspace):
+		self.close_writer()
+
 	def settings(self):
 		settings = [
 			self.objects_name,
@@ -391,7 +526,10 @@ prompt.""".format(**{
 			self.pathname,
 			self.export_option,
 			self.overwrite,
-			self.create_subdirectories
+			self.create_subdirectories,
+			self.writer_threads,
+			self.wait_for_writes,
+			self.pack_masks
 		]
 
 		return settings
@@ -421,19 +559,36 @@ prompt.""".format(**{
 		else:
 			raise NotImplementedError("Unhandled file name method: %s" % self.file_name_method)
 		result.append(self.file_format)
+		if self.file_format.value == FF_HDF5 and self.export_option.value != SAVE_PER_OBJECT:
+			result.append(self.pack_masks)
 		result.append(self.pathname)
 		result.append(self.overwrite)
 		if self.file_name_method == FN_FROM_IMAGE:
 			result.append(self.create_subdirectories)
 			if self.create_subdirectories:
 				result.append(self.root_dir)
-
+		result.append(self.writer_threads)
+		if self.writer_threads.value > 0:
+			result.append(self.wait_for_writes)
 
 		return result
 
 	def volumetric(self):
 		return True
 
+	def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+		if variable_revision_number == 3:
+			# Added the background writer
+			setting_values = setting_values + ["4", WAIT_EVERY_CYCLE]
+			variable_revision_number = 4
+
+		if variable_revision_number == 4:
+			# Added the bit-packing of masks in containers
+			setting_values = setting_values + [cellprofiler.setting.NO]
+			variable_revision_number = 5
+
+		return setting_values, variable_revision_number, from_matlab
+
 	def check_overwrite(self, filename, workspace):
 		'''Check to see if it's legal to overwrite a file
 
@@ -462,6 +617,171 @@ prompt.""".format(**{
 		'''The file name measurement for the exemplar disk image'''
 		return '_'.join((cellprofiler.measurement.C_FILE_NAME, self.file_image_name.value))
 
+# Writers with threads that are not closed yet; the files they still have
+# queued when the process exits are written before it does
+OPEN_WRITERS = set()
+
+def close_open_writers():
+	for writer in list(OPEN_WRITERS):
+		writer.close()
+
+atexit.register(close_open_writers)
+
+class CropWriter(object):
+	"""
+	Converts images to 8 bits and saves them on a pool of background threads.
+
+	At most two files per thread wait in the queue, so write() blocks when
+	the disk falls behind. Errors raised by the threads are re-raised by the
+	next call to write(), flush() or close(). Without threads, write()
+	saves the file right away.
+
+	The threads are daemons, so a writer that is never closed does not keep
+	its process alive, but the queued files are still written at exit.
+	"""
+
+	def __init__(self, n_threads):
+		self.queue   = queue.Queue(max(1, 2 * n_threads))
+		self.errors  = []
+		self.lock    = threading.Lock()
+		self.threads = []
+		for _ in range(n_threads):
+			thread = threading.Thread(target=self.work)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+		if self.threads:
+			OPEN_WRITERS.add(self)
+
+	def work(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					return
+				filename, save, args = item
+				try:
+					save(*args)
+				except Exception as e:
+					with self.lock:
+						self.errors.append((filename, e))
+			finally:
+				self.queue.task_done()
+
+	def raise_errors(self):
+		with self.lock:
+			errors, self.errors = self.errors, []
+		if errors:
+			filename, error = errors[0]
+			raise IOError("Could not write %s (and %d more files): %s" % (filename, len(errors) - 1, error))
+
+	def submit(self, filename, save, *args):
+		""" Calls save(*args) to write filename, in the background if possible. """
+		self.raise_errors()
+		if self.threads:
+			self.queue.put((filename, save, args))
+		else:
+			save(*args)
+
+	def write(self, filename, image, **kwargs):
+		""" Saves image to filename (with the imsave keyword arguments). """
+		self.submit(filename, save_image, filename, image, kwargs)
+
+	def write_container(self, filename, crops, packed=False):
+		""" Saves the (label, bounding box, image) crops to an HDF5 container. """
+		self.submit(filename, save_container, filename, crops, packed)
+
+	def flush(self):
+		""" Waits until every queued file is written. """
+		self.queue.join()
+		self.raise_errors()
+
+	def close(self):
+		""" Writes the queued files and stops the threads. """
+		for _ in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		OPEN_WRITERS.discard(self)
+		self.raise_errors()
+
+def bounding_box_suffix(bounding_box):
+	""" Returns the file name suffix with the position of a bounding box, i.e. "_y120_x64". """
+	axes = "zyx"[-len(bounding_box):]
+	return "".join("_%s%d" % (axis, box.start) for axis, box in zip(axes, bounding_box))
+
+def save_image(filename, image, kwargs):
+	skimage.io.imsave(filename, skimage.img_as_ubyte(image), **kwargs)
+
+def save_container(filename, crops, packed=False):
+	"""
+	Saves the (label, bounding box, image) crops of an image set in one HDF5 file.
+
+	The images are converted to 8 bits (or, if packed, binary masks are
+	packed 8 pixels per byte), flattened and concatenated into the "crops"
+	dataset. The "index" dataset has one row per crop, by label, with its
+	offset and size in "crops", its bounding box (start and stop of each
+	axis) and its shape. See read_crop.
+	"""
+	if packed:
+		images = [numpy.packbits(image.ravel() != 0) for _, _, image in crops]
+	else:
+		images = [skimage.img_as_ubyte(image) for _, _, image in crops]
+	sizes   = numpy.array([image.size for image in images], dtype=numpy.int64)
+	offsets = numpy.cumsum(sizes) - sizes
+
+	ndim       = len(crops[0][1]) if crops else 2
+	shape_ndim = crops[0][2].ndim if crops else 2
+	index = numpy.zeros(len(crops), dtype=[
+		("label",  numpy.int32),
+		("offset", numpy.int64),
+		("size",   numpy.int64),
+		("start",  numpy.int64, (ndim,)),
+		("stop",   numpy.int64, (ndim,)),
+		("shape",  numpy.int64, (shape_ndim,))
+	])
+	for row, (label, bounding_box, crop), image, offset in zip(index, crops, images, offsets):
+		row["label"]  = label
+		row["offset"] = offset
+		row["size"]   = image.size
+		row["start"]  = [axis.start for axis in bounding_box]
+		row["stop"]   = [axis.stop for axis in bounding_box]
+		row["shape"]  = crop.shape
+
+	data = numpy.concatenate([image.ravel() for image in images]) if images else numpy.zeros(0, numpy.uint8)
+	with h5py.File(filename, "w") as f:
+		if len(data) > 0:
+			f.create_dataset("crops", data=data, chunks=(min(len(data), CONTAINER_CHUNK_SIZE),),
+							 compression="gzip", compression_opts=6)
+		else:
+			f.create_dataset("crops", data=data)
+		f.create_dataset("index", data=index)
+		f.attrs["packed"] = packed
+
+def read_crop(filename, label):
+	"""
+	Reads the crop of one label from a container written by save_container.
+
+	Returns the image (a boolean mask if bit-packed) and its bounding box (a
+	tuple of slices into the original image). Only the chunks holding the
+	crop are read.
+	"""
+	with h5py.File(filename, "r") as f:
+		index = f["index"][...]
+		found = numpy.flatnonzero(index["label"] == label)
+		if len(found) == 0:
+			raise KeyError("No object with label %d in %s" % (label, filename))
+		row = index[found[0]]
+
+		image = f["crops"][row["offset"]:row["offset"] + row["size"]]
+		if f.attrs.get("packed", False):
+			image = numpy.unpackbits(image)[:numpy.prod(row["shape"])].astype(bool)
+		image = image.reshape(row["shape"])
+		bounding_box = tuple(slice(start, stop) for start, stop in zip(row["start"], row["stop"]))
+		return image, bounding_box
+
 class SaveImagesDirectoryPath(cellprofiler.setting.DirectoryPath):
 	'''A specialized version of DirectoryPath to handle saving in the image dir'''
 
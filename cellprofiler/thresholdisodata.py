@@ -8,7 +8,6 @@
 
 import numpy as np
 import scipy.ndimage
-from skimage.filters import threshold_isodata
 
 import cellprofiler.image
 import cellprofiler.module
@@ -23,7 +22,7 @@ using the ISODATA method.
 ============ ============ ===============
 Supports 2D? Supports 3D? Respects masks?
 ============ ============ ===============
-YES          NO           YES
+YES          YES          YES
 ============ ============ ===============
 See also
 ^^^^^^^^
@@ -33,11 +32,29 @@ What do I need as input?
 Image.
 What do I get as output?
 ^^^^^^^^^^^^^^^^^^^^^^^^
-Outputs a thresholded image using the ISODATA method.
+Outputs a binary image of the pixels at or above the ISODATA threshold.
+The threshold is either that of each image, or one threshold for all the
+images of a group (i.e. a plate), so that dim images are not thresholded
+on their own background.
 Technical notes
 ^^^^^^^^^^^^^^^
-Implemented using SciKit-Image 
-(`link <https://scikit-image.org/docs/dev/api/skimage.filters.html#skimage.filters.threshold_isodata>`__)
+The threshold is the same as SciKit-Image's
+(`link <https://scikit-image.org/docs/dev/api/skimage.filters.html#skimage.filters.threshold_isodata>`__),
+but is solved from a histogram that can be computed separately
+(``isodata_histogram``) and reused. The output is a boolean mask rather
+than a float image, 8 times smaller, and can be written into an existing
+bool or uint8 array or bit-packed when ``run_isodata`` is called directly.
+
+The threshold of a group is computed before its first image set is run:
+the images (or every Nth of them) are produced by the modules upstream,
+binned on a fixed histogram over [0, 1] (``StreamingHistogram``) and
+discarded. Merging histograms only adds their bins, so the cost of that
+pass is one histogram per image however many images there are. The
+histogram has 2^16 bins, one per gray level of a 16-bit image, whatever
+the number of bins set for single images: its bins cannot follow the
+range of each image, and a dim image (i.e. a 12-bit image stored in 16
+bits, which only reaches about 0.06) would fall in a few of 256 bins over
+[0, 1]. The group's threshold is thus within 1/65536 of the exact one.
 References
 ^^^^^^^^^^
 - Ridler TW, Calvard S (1978) “Picture thresholding using an iterative selection method.” 
@@ -59,6 +76,21 @@ References
 # Also, you can't misspell it by accident.
 NUM_BINS    = "Number of bins for the histogram"
 
+SCOPE_EACH  = "Each image"
+SCOPE_ALL   = "All images in the group"
+
+#
+# Key of the group's threshold in the module dictionary
+#
+THRESHOLD   = "Threshold"
+
+#
+# Number of bins of the group's histogram over [0, 1]: one per gray level of
+# a 16-bit image, so dim images (i.e. 12-bit camera images stored in 16 bits,
+# which only reach about 0.06) are binned as finely as they were recorded
+#
+GROUP_BINS  = 2 ** 16
+
 
 #
 # The module class.
@@ -93,7 +125,7 @@ class ThresholdISODATA(cellprofiler.module.ImageProcessing):
     # by its superclass.
     #
     module_name = "ThresholdISODATA"
-    variable_revision_number = 1
+    variable_revision_number = 2
 
     #
     # "create_settings" is where you declare the user interface elements
@@ -135,7 +167,37 @@ that is made available by a prior module.
             value=256,
             minval=0,
             doc="""\
-The number of gray bins for the histogram.
+The number of gray bins for the histogram of each image, over the range of
+its intensities. The histogram of a group (when thresholding all images in
+the group) always has 65536 bins over [0, 1], one per 16-bit gray level.
+"""
+        )
+
+        self.threshold_scope = cellprofiler.setting.Choice(
+            text="Threshold images",
+            choices=[SCOPE_EACH, SCOPE_ALL],
+            value=SCOPE_EACH,
+            doc="""\
+-  *{SCOPE_EACH}*: Every image is thresholded at its own ISODATA threshold.
+-  *{SCOPE_ALL}*: One threshold is computed from the histogram of all the
+   images of the group, before the group is run, and every image is
+   thresholded at it. The histogram has 65536 fixed bins over [0, 1], one
+   per 16-bit gray level.
+""".format(**{
+                "SCOPE_EACH": SCOPE_EACH,
+                "SCOPE_ALL": SCOPE_ALL
+            })
+        )
+
+        self.sample_every = cellprofiler.setting.Integer(
+            text="Sample every Nth image set",
+            value=1,
+            minval=1,
+            doc="""\
+*(Used only when thresholding all images in the group)*
+
+Only every Nth image set of the group contributes to the histogram of the
+group. Larger values shorten the pass over the group that precedes the run.
 """
         )
 
@@ -155,7 +217,9 @@ The number of gray bins for the histogram.
 
         # Append additional settings here.
         return settings + [
-            self.nbins
+            self.nbins,
+            self.threshold_scope,
+            self.sample_every
         ]
 
     #
@@ -175,9 +239,15 @@ The number of gray bins for the histogram.
 
         # Configure the visibility of additional settings below.
         visible_settings += [
-            self.nbins
+            self.nbins,
+            self.threshold_scope
         ]
 
+        if self.threshold_scope == SCOPE_ALL:
+            visible_settings += [
+                self.sample_every
+            ]
+
         return visible_settings
 
 
@@ -197,17 +267,66 @@ The number of gray bins for the histogram.
         # the module settings as they are returned from "settings" (excluding
         # "self.y_data", or the output image).
         #
-        self.function = run_isodata
+        # The extra arguments are the scope settings, which run_isodata
+        # does not take.
+        #
+        if self.threshold_scope == SCOPE_ALL:
+            threshold = self.get_dictionary(workspace.image_set_list)[THRESHOLD]
+            self.function = lambda pixels, *args: threshold_mask(pixels, threshold)
+        else:
+            self.function = lambda pixels, nbins, *args: run_isodata(pixels, nbins)
         super(ThresholdISODATA, self).run(workspace)
 
+    #
+    # "prepare_group" is called before the image sets of a group are run.
+    # When all images are thresholded together, the group's images are
+    # produced here by running the modules upstream of the input image,
+    # and their histograms are merged into the group's threshold.
+    #
+    def prepare_group(self, workspace, grouping, image_numbers):
+        if self.threshold_scope != SCOPE_ALL or len(image_numbers) == 0:
+            return True
+
+        pipeline = workspace.pipeline
+        title = "#%d: ThresholdISODATA for %s" % (self.module_num, self.x_name.value)
+        sampled = image_numbers[::self.sample_every.value]
+        message = "ThresholdISODATA is binning %d images while preparing for run" % len(sampled)
+
+        #
+        # Find the module after the one that provides the image we need
+        #
+        providers = pipeline.get_provider_dictionary(self.x_name.group, self)
+        src_module, _ = providers[self.x_name.value][-1]
+        modules = list(pipeline.modules())
+        last_module = modules[modules.index(src_module) + 1]
+
+        histogram = StreamingHistogram(GROUP_BINS)
+        for w in pipeline.run_group_with_yield(workspace, grouping, sampled, last_module, title, message):
+            histogram.add(w.image_set.get_image(self.x_name.value, cache=False).pixel_data)
+            w.image_set.clear_cache()
+
+        self.get_dictionary(workspace.image_set_list)[THRESHOLD] = float(histogram.threshold())
+
+        return True
+
     #
     # "volumetric" indicates whether or not this module supports 3D images.
-    # The "gradient_image" function is inherently 2D, and we've noted this
-    # in the documentation for the module. Explicitly return False here
-    # to indicate that 3D images are not supported.
+    # The threshold only depends on the histogram of the image, so stacks
+    # are thresholded as a whole. Return True here.
     #
     def volumetric(self):
-        return False
+        return True
+
+    #
+    # "upgrade_settings" converts the settings of pipelines saved with an
+    # older revision of the module. Revision 2 added the threshold scope.
+    #
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            setting_values = setting_values + [SCOPE_EACH, "1"]
+            variable_revision_number = 2
+
+        return setting_values, variable_revision_number, from_matlab
 
 #
 # This is the function that gets called during "run" to create the output image.
@@ -216,7 +335,111 @@ The number of gray bins for the histogram.
 #
 # This function must return the output image data (as a numpy array).
 #
-def run_isodata(pixels, nbins):
-    threshold = threshold_isodata(pixels, nbins=nbins)
-    outimg    = np.where(pixels >= threshold, 1.0, 0.0)
-    return outimg
+def run_isodata(pixels, nbins, out=None, packed=False, hist=None):
+    #
+    # The mask is written straight into "out" (a bool or uint8 array of the
+    # image's shape) if one is given, so the caller can reuse one buffer for
+    # every frame. A precomputed histogram (from "isodata_histogram") can be
+    # passed as "hist" to skip that pass over the image.
+    #
+    if hist is None:
+        hist = isodata_histogram(pixels, nbins)
+    threshold = isodata_threshold(*hist)
+
+    return threshold_mask(pixels, threshold, out, packed)
+
+
+def isodata_histogram(pixels, nbins):
+    """Returns the counts and bin centers of the image's histogram, binned
+    like SciKit-Image does: one bin per value for integer images, nbins
+    bins over the image's range otherwise."""
+    if np.issubdtype(pixels.dtype, np.integer):
+        low, high = int(pixels.min()), int(pixels.max())
+        counts = np.bincount((pixels.ravel() - low).astype(np.intp), minlength=high - low + 1)
+        return counts, np.arange(low, high + 1)
+
+    # The edges are computed in the image's precision, as SciKit-Image does
+    low, high = pixels.min(), pixels.max()
+    if low == high:
+        return np.array([pixels.size]), np.array([low])
+
+    counts, edges = np.histogram(pixels, bins=nbins, range=(low, high))
+    return counts, (edges[:-1] + edges[1:]) / 2.0
+
+
+def isodata_threshold(counts, bin_centers):
+    """Solves the ISODATA threshold from a histogram.
+
+    Returns the first bin center t for which t = (l + h) / 2, within one bin
+    width, where l and h are the mean intensities of the pixels up to and
+    above t.
+    """
+    # Empty bins at both ends do not change the threshold
+    nonzero = np.flatnonzero(counts)
+    counts = np.asarray(counts[nonzero[0]:nonzero[-1] + 1], dtype=np.float32)
+    bin_centers = bin_centers[nonzero[0]:nonzero[-1] + 1]
+
+    if len(bin_centers) == 1:
+        return bin_centers[0]
+
+    csuml = np.cumsum(counts)
+    csumh = csuml[-1] - csuml
+
+    csum_intensity = np.cumsum(counts * bin_centers)
+    lower = csum_intensity[:-1] / csuml[:-1]
+    higher = (csum_intensity[-1] - csum_intensity[:-1]) / csumh[:-1]
+
+    all_mean = (lower + higher) / 2.0
+    bin_width = bin_centers[1] - bin_centers[0]
+
+    distances = all_mean - bin_centers[:-1]
+    return bin_centers[:-1][(distances >= 0) & (distances < bin_width)][0]
+
+
+def threshold_mask(pixels, threshold, out=None, packed=False):
+    """Returns the mask of the pixels at or above threshold, as a bool array
+    (or in out, a bool or uint8 array), or bit-packed along the last axis
+    with np.packbits if packed is True."""
+    mask = np.greater_equal(pixels, threshold, out=out)
+    if packed:
+        return np.packbits(mask, axis=-1)
+    return mask
+
+
+class StreamingHistogram(object):
+    """A histogram with nbins fixed bins over [low, high], accumulated one
+    image at a time.
+
+    Values outside of the range are counted in the end bins. Adding an
+    image costs one pass over its pixels and merging two histograms only
+    adds their bins, so the threshold of any number of images is solved
+    from nbins counts.
+    """
+
+    def __init__(self, nbins, low=0.0, high=1.0):
+        self.nbins = nbins
+        self.low = low
+        self.high = high
+        self.counts = np.zeros(nbins, np.int64)
+
+    @property
+    def bin_centers(self):
+        width = (self.high - self.low) / float(self.nbins)
+        return self.low + (np.arange(self.nbins) + 0.5) * width
+
+    def add(self, pixels):
+        scale = self.nbins / float(self.high - self.low)
+        bins = ((np.asarray(pixels, np.float64).ravel() - self.low) * scale).astype(np.intp)
+        np.clip(bins, 0, self.nbins - 1, out=bins)
+        self.counts += np.bincount(bins, minlength=self.nbins)
+
+    def merge(self, other):
+        if (other.nbins, other.low, other.high) != (self.nbins, self.low, self.high):
+            raise ValueError("Cannot merge histograms with different bins")
+        self.counts += other.counts
+
+    def threshold(self):
+        """Returns the ISODATA threshold of everything added so far."""
+        if not self.counts.any():
+            raise ValueError("The histogram is empty")
+        return isodata_threshold(self.counts, self.bin_centers)
@@ -0,0 +1,785 @@
+'''
+Checks the thresholding methods of the MultiThreshold plugin against
+literal translations of the code they port.
+
+Every method of cellprofiler/auto_threshold.py is vectorized with NumPy.
+This script translates the loops of ImageJ's AutoThresholder (and of the
+HistThresh toolbox for maxLikelihood, and Rosin's unimodal method for
+rosin) line by line, with Java's double and int arithmetic, and compares
+the threshold bins of both on random and degenerate histograms: binary
+images, 2 bins, sparse bright spots, histograms with gaps. Any mismatch is
+printed, and the exit status is the number of methods that mismatched.
+
+Where ImageJ throws or loops forever, the translations follow the plugin's
+conventions, which are noted where they apply.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cellprofiler'))
+import auto_threshold
+
+# Java doubles, so that a division by zero is infinite (or NaN) as in Java
+D = np.float64
+
+# Double.MIN_VALUE and Double.MAX_VALUE
+MIN_VALUE = 4.9e-324
+MAX_VALUE = sys.float_info.max
+
+# DBL_EPSILON, ImageJ's zero
+EPSILON = 2.220446049250313e-16
+
+
+def java_int(value):
+    '''Java's (int) cast of a double: truncates, NaN is 0 and the
+    infinities saturate.'''
+    if np.isnan(value):
+        return 0
+    if value >= 2 ** 31 - 1:
+        return 2 ** 31 - 1
+    if value <= -2 ** 31:
+        return -2 ** 31
+    return int(value)
+
+
+def java_round(value):
+    '''Java's (int) Math.round of a double.'''
+    return java_int(np.floor(value + D(0.5)))
+
+
+# Helpers of AutoThresholder...................................................
+def partial_sum(y, j):
+    x = D(0)
+    for i in range(j + 1):
+        x += y[i]
+    return x
+
+
+def A(y, j):
+    x = D(0)
+    for i in range(j + 1):
+        x += y[i]
+    return x
+
+
+def B(y, j):
+    x = D(0)
+    for i in range(j + 1):
+        x += i * y[i]
+    return x
+
+
+def C(y, j):
+    x = D(0)
+    for i in range(j + 1):
+        x += i * i * y[i]
+    return x
+
+
+def bimodal_test(y):
+    modes = 0
+    for k in range(1, len(y) - 1):
+        if y[k - 1] < y[k] and y[k + 1] < y[k]:
+            modes += 1
+            if modes > 2:
+                return False
+    return modes == 2
+
+
+def smooth(histo):
+    '''One pass of the 3 point running mean, 0 outside.'''
+    n = len(histo)
+    smoothed = [D(0)] * n
+    for i in range(1, n - 1):
+        smoothed[i] = (histo[i - 1] + histo[i] + histo[i + 1]) / 3
+    smoothed[0] = (histo[0] + histo[1]) / 3
+    smoothed[n - 1] = (histo[n - 2] + histo[n - 1]) / 3
+    return smoothed
+
+
+def normalized(data):
+    '''norm_histo, P1, P2, first_bin and last_bin of the entropy methods.'''
+    n = len(data)
+    total = sum(data)
+    norm_histo = [D(data[ih]) / total for ih in range(n)]
+    p1 = [D(0)] * n
+    p2 = [D(0)] * n
+    p1[0] = norm_histo[0]
+    p2[0] = 1.0 - p1[0]
+    for ih in range(1, n):
+        p1[ih] = p1[ih - 1] + norm_histo[ih]
+        p2[ih] = 1.0 - p1[ih]
+
+    first_bin = 0
+    for ih in range(n):
+        if not abs(p1[ih]) < EPSILON:
+            first_bin = ih
+            break
+    last_bin = n - 1
+    for ih in range(n - 1, first_bin - 1, -1):
+        if not abs(p2[ih]) < EPSILON:
+            last_bin = ih
+            break
+    return norm_histo, p1, p2, first_bin, last_bin
+
+
+# Methods.......................................................................
+def huang(data):
+    n = len(data)
+    first_bin = 0
+    for ih in range(n):
+        if data[ih] != 0:
+            first_bin = ih
+            break
+    last_bin = n - 1
+    for ih in range(n - 1, first_bin - 1, -1):
+        if data[ih] != 0:
+            last_bin = ih
+            break
+    term = 1.0 / D(last_bin - first_bin)
+
+    mu_0 = [D(0)] * n
+    sum_pix = num_pix = D(0)
+    for ih in range(first_bin, n):
+        sum_pix += D(ih) * data[ih]
+        num_pix += data[ih]
+        mu_0[ih] = sum_pix / num_pix
+
+    mu_1 = [D(0)] * n
+    sum_pix = num_pix = D(0)
+    for ih in range(last_bin, 0, -1):
+        sum_pix += D(ih) * data[ih]
+        num_pix += data[ih]
+        mu_1[ih - 1] = sum_pix / num_pix
+
+    threshold, min_ent = -1, MAX_VALUE
+    for it in range(n):
+        ent = D(0)
+        for ih in range(it + 1):
+            mu_x = 1.0 / (1.0 + term * abs(ih - mu_0[it]))
+            if not (mu_x < 1e-06 or mu_x > 0.999999):
+                ent += data[ih] * (-mu_x * np.log(mu_x) - (1.0 - mu_x) * np.log(1.0 - mu_x))
+        for ih in range(it + 1, n):
+            mu_x = 1.0 / (1.0 + term * abs(ih - mu_1[it]))
+            if not (mu_x < 1e-06 or mu_x > 0.999999):
+                ent += data[ih] * (-mu_x * np.log(mu_x) - (1.0 - mu_x) * np.log(1.0 - mu_x))
+        if ent < min_ent:
+            min_ent, threshold = ent, it
+    return threshold
+
+
+def ij1(data):
+    data = list(data)
+    max_value = len(data) - 1
+    data[0] = data[max_value] = 0
+
+    low = 0
+    while data[low] == 0 and low < max_value:
+        low += 1
+    high = max_value
+    while data[high] == 0 and high > 0:
+        high -= 1
+    if low >= high:
+        return len(data) // 2
+
+    moving_index = low
+    while True:
+        sum1 = sum2 = sum3 = sum4 = D(0)
+        for i in range(low, moving_index + 1):
+            sum1 += D(i) * data[i]
+            sum2 += data[i]
+        for i in range(moving_index + 1, high + 1):
+            sum3 += D(i) * data[i]
+            sum4 += data[i]
+        result = (sum1 / sum2 + sum3 / sum4) / 2.0
+        moving_index += 1
+        if not ((moving_index + 1) <= result and moving_index < high - 1):
+            break
+    return java_round(result)
+
+
+def intermodes(data):
+    histo = [D(x) for x in data]
+    iterations = 0
+    while not bimodal_test(histo):
+        histo = smooth(histo)
+        iterations += 1
+        if iterations > 10000:
+            return -1
+
+    # The mean between the two peaks
+    tt = 0
+    for i in range(1, len(data) - 1):
+        if histo[i - 1] < histo[i] and histo[i + 1] < histo[i]:
+            tt += i
+    return java_int(np.floor(tt / 2.0))
+
+
+def iso_data(data):
+    n = len(data)
+    g = 0
+    for i in range(1, n):
+        if data[i] > 0:
+            g = i + 1
+            break
+
+    while True:
+        # ImageJ throws an ArrayIndexOutOfBoundsException when g starts past
+        # the histogram, the plugin finds no threshold
+        if g > n - 1:
+            return -1
+        l = totl = 0
+        for i in range(g + 1):
+            totl += data[i]
+            l += data[i] * i
+        h = toth = 0
+        for i in range(g + 1, n):
+            toth += data[i]
+            h += data[i] * i
+        if totl > 0 and toth > 0:
+            l //= totl
+            h //= toth
+            if g == java_round((l + h) / 2.0):
+                break
+        g += 1
+        if g > n - 2:
+            return -1
+    return g
+
+
+def li(data):
+    n = len(data)
+    num_pixels = D(0)
+    for ih in range(n):
+        num_pixels += data[ih]
+    mean = D(0)
+    for ih in range(1, n):
+        mean += D(ih) * data[ih]
+    mean /= num_pixels
+
+    # ImageJ loops until the threshold settles, the plugin gives up after
+    # MAX_ITERATIONS
+    new_thresh = mean
+    for _ in range(auto_threshold.MAX_ITERATIONS):
+        old_thresh = new_thresh
+        threshold = java_int(old_thresh + 0.5)
+
+        sum_back = num_back = D(0)
+        for ih in range(threshold + 1):
+            sum_back += D(ih) * data[ih]
+            num_back += data[ih]
+        mean_back = D(0) if num_back == 0 else sum_back / num_back
+
+        sum_obj = num_obj = D(0)
+        for ih in range(threshold + 1, n):
+            sum_obj += D(ih) * data[ih]
+            num_obj += data[ih]
+        mean_obj = D(0) if num_obj == 0 else sum_obj / num_obj
+
+        temp = (mean_back - mean_obj) / (np.log(mean_back) - np.log(mean_obj))
+        new_thresh = D(java_int(temp - 0.5) if temp < -EPSILON else java_int(temp + 0.5))
+
+        if not abs(new_thresh - old_thresh) > 0.5:
+            break
+    return threshold
+
+
+def max_entropy(data, start=MIN_VALUE):
+    n = len(data)
+    norm_histo, p1, p2, first_bin, last_bin = normalized(data)
+
+    threshold, max_ent = -1, start
+    for it in range(first_bin, last_bin + 1):
+        ent_back = D(0)
+        for ih in range(it + 1):
+            if data[ih] != 0:
+                ent_back -= (norm_histo[ih] / p1[it]) * np.log(norm_histo[ih] / p1[it])
+        ent_obj = D(0)
+        for ih in range(it + 1, n):
+            if data[ih] != 0:
+                ent_obj -= (norm_histo[ih] / p2[it]) * np.log(norm_histo[ih] / p2[it])
+        tot_ent = ent_back + ent_obj
+        if max_ent < tot_ent:
+            max_ent, threshold = tot_ent, it
+    return threshold
+
+
+def max_likelihood(data):
+    # HistThresh's th_maxlik, with the plugin's guards
+    y = [D(x) for x in data]
+    n = len(y) - 1
+
+    t = minimum(data)
+    if t < 0:
+        return -1
+
+    mu = B(y, t) / A(y, t)
+    nu = (B(y, n) - B(y, t)) / (A(y, n) - A(y, t))
+    p = A(y, t) / A(y, n)
+    q = (A(y, n) - A(y, t)) / A(y, n)
+    sigma2 = C(y, t) / A(y, t) - mu * mu
+    tau2 = (C(y, n) - C(y, t)) / (A(y, n) - A(y, t)) - nu * nu
+    if sigma2 == 0 or tau2 == 0:
+        return -1
+
+    previous = None
+    for _ in range(auto_threshold.MAX_ITERATIONS):
+        phi = [D(0)] * (n + 1)
+        for i in range(n + 1):
+            back = p * np.exp(-((i - mu) ** 2) / (2 * sigma2)) / np.sqrt(sigma2)
+            obj = q * np.exp(-((i - nu) ** 2) / (2 * tau2)) / np.sqrt(tau2)
+            phi[i] = back / (back + obj)
+        gamma = [1 - phi[i] for i in range(n + 1)]
+
+        f = g = D(0)
+        for i in range(n + 1):
+            f += phi[i] * y[i]
+            g += gamma[i] * y[i]
+        p = f / A(y, n)
+        q = g / A(y, n)
+
+        mu = nu = sigma2 = tau2 = D(0)
+        for i in range(n + 1):
+            mu += i * phi[i] * y[i]
+            nu += i * gamma[i] * y[i]
+            sigma2 += i * i * phi[i] * y[i]
+            tau2 += i * i * gamma[i] * y[i]
+        mu /= f
+        nu /= g
+        sigma2 = sigma2 / f - mu * mu
+        tau2 = tau2 / g - nu * nu
+
+        current = (mu, nu, p, q, sigma2, tau2)
+        if previous is not None and all(abs(a - b) <= 1e-7 for a, b in zip(current, previous)):
+            break
+        previous = current
+
+    w0 = 1 / sigma2 - 1 / tau2
+    w1 = mu / sigma2 - nu / tau2
+    w2 = mu * mu / sigma2 - nu * nu / tau2 + np.log10((sigma2 * q * q) / (tau2 * p * p))
+    sqterm = w1 * w1 - w0 * w2
+    if sqterm < 0:
+        return 0
+    return java_int(np.floor((w1 + np.sqrt(sqterm)) / w0))
+
+
+def mean(data):
+    tot = D(0)
+    for i in range(len(data)):
+        tot += D(i) * data[i]
+    return java_int(np.floor(tot / sum(data)))
+
+
+def min_error(data):
+    n = len(data) - 1
+    threshold, previous = mean(data), -2
+
+    # ImageJ loops until the threshold settles, the plugin gives up after
+    # MAX_ITERATIONS
+    for _ in range(auto_threshold.MAX_ITERATIONS):
+        if threshold == previous:
+            break
+        t = threshold
+        mu = B(data, t) / A(data, t)
+        nu = (B(data, n) - B(data, t)) / (A(data, n) - A(data, t))
+        p = A(data, t) / A(data, n)
+        q = (A(data, n) - A(data, t)) / A(data, n)
+        sigma2 = C(data, t) / A(data, t) - mu * mu
+        tau2 = (C(data, n) - C(data, t)) / (A(data, n) - A(data, t)) - nu * nu
+
+        w0 = 1.0 / sigma2 - 1.0 / tau2
+        w1 = mu / sigma2 - nu / tau2
+        w2 = mu * mu / sigma2 - nu * nu / tau2 + np.log10((sigma2 * q * q) / (tau2 * p * p))
+
+        sqterm = w1 * w1 - w0 * w2
+        if sqterm < 0:
+            break
+
+        previous = threshold
+        temp = (w1 + np.sqrt(sqterm)) / w0
+        if not np.isnan(temp):
+            threshold = java_int(np.floor(temp))
+
+        # ImageJ indexes past the histogram with the next threshold, the
+        # plugin keeps the last one
+        if not 0 <= threshold <= n:
+            return previous
+    return threshold
+
+
+def minimum(data):
+    n = len(data)
+    histo = [D(x) for x in data]
+    last = -1
+    for i in range(n):
+        if data[i] > 0:
+            last = i
+
+    iterations = 0
+    while not bimodal_test(histo):
+        histo = smooth(histo)
+        iterations += 1
+        if iterations > 10000:
+            return -1
+
+    # The first minimum between the two peaks
+    for i in range(1, last):
+        if histo[i - 1] > histo[i] and histo[i + 1] >= histo[i]:
+            return i
+    return -1
+
+
+def moments(data):
+    n = len(data)
+    total = D(sum(data))
+    histo = [data[i] / total for i in range(n)]
+
+    m0, m1, m2, m3 = D(1), D(0), D(0), D(0)
+    for i in range(n):
+        di = D(i)
+        m1 += di * histo[i]
+        m2 += di * di * histo[i]
+        m3 += di * di * di * histo[i]
+
+    cd = m0 * m2 - m1 * m1
+    c0 = (-m2 * m2 + m1 * m3) / cd
+    c1 = (m0 * -m3 + m2 * m1) / cd
+    z0 = 0.5 * (-c1 - np.sqrt(c1 * c1 - 4.0 * c0))
+    z1 = 0.5 * (-c1 + np.sqrt(c1 * c1 - 4.0 * c0))
+    p0 = (z1 - m1) / (z1 - z0)
+
+    total = D(0)
+    for i in range(n):
+        total += histo[i]
+        if total > p0:
+            return i
+    return -1
+
+
+def otsu(data):
+    n = len(data)
+    num_pixels = sum(data)
+    term = 1.0 / D(num_pixels)
+    histo = [term * data[ih] for ih in range(n)]
+
+    cnh = [D(0)] * n
+    mean = [D(0)] * n
+    cnh[0] = histo[0]
+    for ih in range(1, n):
+        cnh[ih] = cnh[ih - 1] + histo[ih]
+        mean[ih] = mean[ih - 1] + ih * histo[ih]
+    total_mean = mean[n - 1]
+
+    # ImageJ starts from Integer.MIN_VALUE, which the plugin clamps to -1
+    threshold, max_bcv = -1, D(0)
+    for ih in range(n):
+        bcv = total_mean * cnh[ih] - mean[ih]
+        bcv *= bcv / (cnh[ih] * (1.0 - cnh[ih]))
+        if max_bcv < bcv:
+            max_bcv, threshold = bcv, ih
+    return threshold
+
+
+def percentile(data, ptile=0.5):
+    total = partial_sum(data, len(data) - 1)
+    threshold, temp = -1, D(1)
+    for i in range(len(data)):
+        distance = abs(partial_sum(data, i) / total - ptile)
+        if distance < temp:
+            temp, threshold = distance, i
+    return threshold
+
+
+def renyi_entropy(data):
+    n = len(data)
+    norm_histo, p1, p2, first_bin, last_bin = normalized(data)
+
+    # alpha = 1, from 0
+    t_star2 = max_entropy(data, start=D(0))
+    t_star2 = 0 if t_star2 < 0 else t_star2
+
+    # alpha = 0.5
+    threshold, max_ent = 0, D(0)
+    for it in range(first_bin, last_bin + 1):
+        ent_back = D(0)
+        for ih in range(it + 1):
+            ent_back += np.sqrt(norm_histo[ih] / p1[it])
+        ent_obj = D(0)
+        for ih in range(it + 1, n):
+            ent_obj += np.sqrt(norm_histo[ih] / p2[it])
+        product = ent_back * ent_obj
+        tot_ent = 2.0 * (np.log(product) if product > 0.0 else 0.0)
+        if tot_ent > max_ent:
+            max_ent, threshold = tot_ent, it
+    t_star1 = threshold
+
+    # alpha = 2
+    threshold, max_ent = 0, D(0)
+    for it in range(first_bin, last_bin + 1):
+        ent_back = D(0)
+        for ih in range(it + 1):
+            ent_back += (norm_histo[ih] * norm_histo[ih]) / (p1[it] * p1[it])
+        ent_obj = D(0)
+        for ih in range(it + 1, n):
+            ent_obj += (norm_histo[ih] * norm_histo[ih]) / (p2[it] * p2[it])
+        product = ent_back * ent_obj
+        tot_ent = -1.0 * (np.log(product) if product > 0.0 else 0.0)
+        if tot_ent > max_ent:
+            max_ent, threshold = tot_ent, it
+    t_star3 = threshold
+
+    t_star1, t_star2, t_star3 = sorted((t_star1, t_star2, t_star3))
+    if abs(t_star1 - t_star2) <= 5:
+        beta1, beta2, beta3 = (1, 2, 1) if abs(t_star2 - t_star3) <= 5 else (0, 1, 3)
+    else:
+        beta1, beta2, beta3 = (3, 1, 0) if abs(t_star2 - t_star3) <= 5 else (1, 2, 1)
+
+    omega = p1[t_star3] - p1[t_star1]
+    return java_int(t_star1 * (p1[t_star1] + 0.25 * omega * beta1) +
+                    0.25 * t_star2 * omega * beta2 +
+                    t_star3 * (p2[t_star3] + 0.25 * omega * beta3))
+
+
+def rosin(data):
+    # Rosin's unimodal method: the bin furthest from the line between the
+    # peak and the end of the longer tail
+    n = len(data)
+    peak = 0
+    for i in range(1, n):
+        if data[i] > data[peak]:
+            peak = i
+    first_bin = last_bin = -1
+    for i in range(n):
+        if data[i] > 0:
+            if first_bin < 0:
+                first_bin = i
+            last_bin = i
+
+    if last_bin - peak >= peak - first_bin:
+        end, bins = last_bin, range(peak, last_bin + 1)
+    else:
+        end, bins = first_bin, range(first_bin, peak + 1)
+    if end == peak:
+        return peak
+
+    dx, dy = D(end - peak), D(data[end]) - D(data[peak])
+    norm = np.sqrt(dx * dx + dy * dy)
+    threshold, max_distance = -1, D(-1)
+    for i in bins:
+        distance = abs(dy * (i - peak) - dx * (data[i] - D(data[peak]))) / norm
+        if distance > max_distance:
+            max_distance, threshold = distance, i
+    return threshold
+
+
+def shanbhag(data):
+    n = len(data)
+    norm_histo, p1, p2, first_bin, last_bin = normalized(data)
+
+    threshold, min_ent = -1, MAX_VALUE
+    for it in range(first_bin, last_bin + 1):
+        ent_back = D(0)
+        term = 0.5 / p1[it]
+        for ih in range(1, it + 1):
+            ent_back -= norm_histo[ih] * np.log(1.0 - term * p1[ih - 1])
+        ent_back *= term
+
+        ent_obj = D(0)
+        term = 0.5 / p2[it]
+        for ih in range(it + 1, n):
+            ent_obj -= norm_histo[ih] * np.log(1.0 - term * p2[ih])
+        ent_obj *= term
+
+        tot_ent = abs(ent_back - ent_obj)
+        if tot_ent < min_ent:
+            min_ent, threshold = tot_ent, it
+    return threshold
+
+
+def triangle(data):
+    data = list(data)
+    n = len(data)
+    low = high = peak = dmax = 0
+    for i in range(n):
+        if data[i] > 0:
+            low = i
+            break
+    if low > 0:
+        low -= 1
+    for i in range(n - 1, 0, -1):
+        if data[i] > 0:
+            high = i
+            break
+    if high < n - 1:
+        high += 1
+    for i in range(n):
+        if data[i] > dmax:
+            peak, dmax = i, data[i]
+
+    inverted = False
+    if (peak - low) < (high - peak):
+        inverted = True
+        data.reverse()
+        low, peak = n - 1 - high, n - 1 - peak
+    if low == peak:
+        return low
+
+    nx, ny = D(data[peak]), D(low - peak)
+    d = np.sqrt(nx * nx + ny * ny)
+    nx, ny = nx / d, ny / d
+    d = nx * low + ny * data[low]
+
+    split, split_distance = low, D(0)
+    for i in range(low + 1, peak + 1):
+        distance = nx * i + ny * data[i] - d
+        if distance > split_distance:
+            split, split_distance = i, distance
+    split -= 1
+    return n - 1 - split if inverted else split
+
+
+def yen(data):
+    n = len(data)
+    norm_histo, p1, _, _, _ = normalized(data)
+
+    p1_sq = [D(0)] * n
+    p1_sq[0] = norm_histo[0] * norm_histo[0]
+    for ih in range(1, n):
+        p1_sq[ih] = p1_sq[ih - 1] + norm_histo[ih] * norm_histo[ih]
+    p2_sq = [D(0)] * n
+    for ih in range(n - 2, -1, -1):
+        p2_sq[ih] = p2_sq[ih + 1] + norm_histo[ih + 1] * norm_histo[ih + 1]
+
+    threshold, max_crit = -1, MIN_VALUE
+    for it in range(n):
+        product = p1_sq[it] * p2_sq[it]
+        spread = p1[it] * (1.0 - p1[it])
+        crit = (-1.0 * (np.log(product) if product > 0.0 else 0.0) +
+                2 * (np.log(spread) if spread > 0.0 else 0.0))
+        if crit > max_crit:
+            max_crit, threshold = crit, it
+    return threshold
+
+
+REFERENCES = {
+    "huang"        : huang,
+    "ij1"          : ij1,
+    "intermodes"   : intermodes,
+    "isoData"      : iso_data,
+    "li"           : li,
+    "maxEntropy"   : max_entropy,
+    "maxLikelihood": max_likelihood,
+    "mean"         : mean,
+    "minError"     : min_error,
+    "minimum"      : minimum,
+    "moments"      : moments,
+    "otsu"         : otsu,
+    "percentile"   : percentile,
+    "renyiEntropy" : renyi_entropy,
+    "rosin"        : rosin,
+    "shanbhag"     : shanbhag,
+    "triangle"     : triangle,
+    "yen"          : yen,
+}
+
+
+def reference_bin(method, counts):
+    '''The threshold bin of the literal translation of a method, with the
+    conventions of threshold_bin: a single nonempty bin is its own
+    threshold, and the bin is clamped to [-1, N - 1].'''
+    data = [int(x) for x in counts]
+    nonzero = [i for i in range(len(data)) if data[i] > 0]
+    if len(nonzero) < 2:
+        return nonzero[0] if nonzero else -1
+
+    with np.errstate(all='ignore'):
+        bin = REFERENCES[method](data)
+    return min(max(bin, -1), len(data) - 1)
+
+
+# Histograms....................................................................
+def edge_cases():
+    '''Yields (name, counts) of the histograms the methods broke on.'''
+    binary = np.zeros(256, np.int64)
+    binary[0], binary[255] = 900, 100
+    yield 'binary image, 256 bins', binary
+    yield 'binary image, 2 bins', np.array([5, 7])
+    yield 'last bins, 3 bins', np.array([0, 5, 7])
+    yield 'triangle past the end', np.array([1, 1, 0])
+    yield 'triangle past the end, 5 bins', np.array([0, 0, 2, 1, 0])
+
+    spots = np.zeros(256, np.int64)
+    spots[:4] = [40000, 30000, 20000, 10000]
+    spots[[180, 220, 255]] = [3, 1, 2]
+    yield 'sparse bright spots', spots
+
+
+def random_cases(rng, trials):
+    '''Yields (name, counts) of random histograms of various shapes and sizes.'''
+    for trial in range(trials):
+        nbins = int(rng.choice([2, 3, 5, 16, 64, 256]))
+        kind = trial % 5
+        if kind == 0:
+            name = 'two gaussians'
+            x = np.concatenate([rng.normal(rng.uniform(0.1, 0.4), 0.05, 3000),
+                                rng.normal(rng.uniform(0.5, 0.9), 0.1, int(rng.integers(200, 3000)))])
+        elif kind == 1:
+            name = 'exponential'
+            x = rng.exponential(0.1, 5000)
+        elif kind == 2:
+            name = 'skewed'
+            x = rng.random(2000) ** 3
+        elif kind == 3:
+            name = 'dim background with bright spots'
+            x = np.concatenate([rng.normal(0.05, 0.02, 20000), rng.uniform(0.5, 1.0, int(rng.integers(1, 30)))])
+        else:
+            name = 'with gaps'
+            x = rng.integers(0, 5, nbins) * (rng.random(nbins) < 0.3)
+            yield '%s, %d bins' % (name, nbins), x.astype(np.int64)
+            continue
+        yield '%s, %d bins' % (name, nbins), np.histogram(x, nbins)[0].astype(np.int64)
+
+
+def run(trials, seed):
+    rng = np.random.default_rng(seed)
+    cases = list(edge_cases()) + list(random_cases(rng, trials))
+    print('Checking', len(auto_threshold.METHODS), 'methods on', len(cases), 'histograms')
+
+    mismatches = {}
+    for name, counts in cases:
+        for method in sorted(auto_threshold.METHODS):
+            try:
+                vectorized = auto_threshold.threshold_bin(method, counts)
+            except Exception as e:
+                vectorized = '%s: %s' % (type(e).__name__, e)
+            try:
+                reference = reference_bin(method, counts)
+            except Exception as e:
+                reference = '%s: %s' % (type(e).__name__, e)
+            if vectorized != reference:
+                mismatches.setdefault(method, []).append((name, vectorized, reference))
+
+    for method in sorted(auto_threshold.METHODS):
+        found = mismatches.get(method, [])
+        print('%-14s %s' % (method, 'ok' if not found else '%d mismatches' % len(found)))
+        for name, vectorized, reference in found[:5]:
+            print('    %s: plugin %s, reference %s' % (name, vectorized, reference))
+    return len(mismatches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the MultiThreshold methods against literal translations')
+    parser.add_argument('-n', '--trials', required=False, type=int,
+                        help='Number of random histograms', default=100)
+    parser.add_argument('-s', '--seed', required=False, type=int,
+                        help='Seed of the random histograms', default=0)
+    args = parser.parse_args()
+
+    start = time.time()
+    failed = run(args.trials, args.seed)
+    print('Done in %.1f s' % (time.time() - start))
+    sys.exit(failed)
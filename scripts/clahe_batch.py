@@ -0,0 +1,143 @@
+'''
+Headless CLAHE over many same-shape frames, outside of CellProfiler.
+
+Equalizes every 2D image (and every plane of every stack) under a
+directory with the CLAHE plugin's batched function: frames of the same
+shape are equalized together in batches, sharing their tiling and working
+buffers, and the throughput is reported in frames/second. The equalized
+images are saved as 32-bit float TIFFs with the same names and relative
+paths in the output directory. Color images are skipped.
+
+It uses the tiled CLAHE of the CLAHE plugin (cellprofiler/clahe_tiling.py),
+which does not need CellProfiler.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import skimage.io
+import skimage.util
+
+import mcp_scan
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cellprofiler'))
+import clahe_tiling
+
+# Number of frames equalized per call
+BATCH_SIZE = 64
+
+
+def is_color(image):
+    '''Returns whether a 3D image is a color image rather than a stack,
+    like scikit-image guesses it: the last axis has 3 or 4 channels and is
+    shorter than the first.'''
+    return image.ndim == 3 and image.shape[-1] in (3, 4) and image.shape[-1] < image.shape[0]
+
+
+def iter_batches(image_paths, batch_size):
+    '''Reads the images and yields batches of same-shape frames as (frames,
+    owners). Each owner (path, first frame, number of frames, frames of the
+    image) tells which frames of the batch came from which image. A stack
+    is cut into as many batches as it needs.'''
+    pending = {} # shape -> ([frames], [owners], number of frames)
+
+    for ipath in image_paths:
+        try:
+            image = skimage.io.imread(ipath)
+        except (IOError, ValueError) as e:
+            print('Could not read', ipath, ':', e)
+            continue
+
+        # The last axis of a color image holds its (RGB or RGBA) channels
+        if image.ndim not in (2, 3) or is_color(image):
+            print('Skipping', ipath, ': not a grayscale image or stack', image.shape)
+            continue
+        stack = skimage.util.img_as_float32(image.reshape((-1,) + image.shape[-2:]))
+
+        start = 0
+        while start < len(stack):
+            frames, owners, n_frames = pending.pop(stack.shape[1:], ([], [], 0))
+            part = stack[start:start + batch_size - n_frames]
+            frames.append(part)
+            owners.append((ipath, start, len(part), len(stack)))
+            start += len(part)
+
+            if n_frames + len(part) == batch_size:
+                yield np.concatenate(frames), owners
+            else:
+                pending[stack.shape[1:]] = frames, owners, n_frames + len(part)
+
+    for frames, owners, _ in pending.values():
+        yield np.concatenate(frames), owners
+
+
+def main(root_path, output_path, regex, kernel_size, clip_limit, nbins, threads, batch_size):
+    image_paths = mcp_scan.find_files(root_path, regex)
+    print(f'Found {len(image_paths)} images')
+    os.makedirs(output_path, exist_ok=True)
+
+    parts   = {} # path -> {first frame: equalized frames}, until the image is complete
+    n_total = 0
+    elapsed = 0.0
+
+    for frames, owners in iter_batches(image_paths, batch_size):
+        started   = time.perf_counter()
+        equalized = clahe_tiling.run_clahe_batch(frames, kernel_size, clip_limit, nbins, threads,
+                                          out=np.empty(frames.shape, np.float32))
+        elapsed += time.perf_counter() - started
+        n_total += len(frames)
+
+        offset = 0
+        for ipath, first, count, n_frames in owners:
+            image_parts = parts.setdefault(ipath, {})
+            image_parts[first] = equalized[offset:offset + count]
+            offset += count
+
+            # Save an image once all of its frames are equalized, at the same
+            # path relative to the output as the input's to the root
+            if sum(len(p) for p in image_parts.values()) == n_frames:
+                image    = np.concatenate([image_parts[k] for k in sorted(image_parts)])
+                out_path = os.path.join(output_path, os.path.relpath(ipath, root_path))
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                skimage.io.imsave(out_path, image if n_frames > 1 else image[0], check_contrast=False)
+                del parts[ipath]
+
+        print(f'{n_total} frames, {n_total / elapsed:.1f} frames/s')
+
+    if n_total > 0:
+        print(f'Equalized {n_total} frames in {elapsed:.2f} s ({n_total / elapsed:.1f} frames/s)')
+
+
+'''
+Program execution starts here.
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched CLAHE of same-shape frames')
+
+    parser.add_argument('-d', '--dir', required=True, type=str,
+                        help='Root directory with images (i.e. "/home/user/Documents/frames")')
+    parser.add_argument('-o', '--output', required=True, type=str,
+                        help='Output directory of the equalized images')
+    parser.add_argument('-r', '--regex', required=False, type=str,
+                        help='Regex of the image file names', default=r'.*\.tiff?$')
+    parser.add_argument('-k', '--kernel-size', required=False, type=int,
+                        help='Kernel size in pixels (0 for 1/8 of the frame)', default=50)
+    parser.add_argument('-c', '--clip-limit', required=False, type=float,
+                        help='Clip limit, between 0 and 1', default=0.01)
+    parser.add_argument('-n', '--nbins', required=False, type=int,
+                        help='Number of histogram bins', default=256)
+    parser.add_argument('-t', '--threads', required=False, type=int,
+                        help='Number of threads equalizing frames', default=os.cpu_count())
+    parser.add_argument('-b', '--batch-size', required=False, type=int,
+                        help='Number of frames equalized per call', default=BATCH_SIZE)
+
+    args = vars(parser.parse_args())
+
+    for key in ('threads', 'batch_size', 'nbins'):
+        if args[key] < 1:
+            parser.error(f'--{key.replace("_", "-")} must be at least 1')
+
+    main(args['dir'], args['output'], args['regex'], args['kernel_size'], args['clip_limit'],
+         args['nbins'], args['threads'], args['batch_size'])
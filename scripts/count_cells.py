@@ -1,45 +1,114 @@
 import os
 import re
-import string
+import argparse
 import pandas as pd
 
-ROOT_DIR = '/home/mitocab/Documents/Box-05282020'
+import mcp_scan
 
-manual_re = re.compile('.*_skel_cell[0-9]*_ps.*')
-cp_re     = re.compile('.*_cp_skel_[0-9]*.*')
+# File names of the manually traced and the CellProfiler skeletons. The
+# "cell" group is the cell index the two are paired on, within the same
+# directory and "image" (the part of the name before the suffix).
+MANUAL_REGEX = r'(?P<image>.*)_skel_cell(?P<cell>[0-9]*)_ps.*'
+CP_REGEX     = r'(?P<image>.*)_cp_skel_(?P<cell>[0-9]*).*'
 
-manual_cnt = 0
-cp_cnt     = 0
+MANUAL = 0
+CP     = 1
 
-man_counts = {}
-cp_counts  = {}
+PAIRING_COLUMNS = ['subdir', 'image', 'cell', 'status', 'manual_path', 'cp_path']
 
 
-for subdir, dirs, files in os.walk(ROOT_DIR):
-    subdir_key = subdir.replace(ROOT_DIR + '/', '')
-    if subdir_key not in man_counts:
-        man_counts[subdir_key] = 0
-        cp_counts[subdir_key] = 0
+def pair_cells(root_path, manual_regex=MANUAL_REGEX, cp_regex=CP_REGEX, manifest_path=None, threads=1):
+    '''Pairs the manual and CellProfiler skeletons under root_path by cell.
 
-    for file in files:
-        if manual_re.match(file):
-            man_counts[subdir_key] += 1
-        elif cp_re.match(file):
-            cp_counts[subdir_key] += 1
+    Both kinds of files are hashed on (subdirectory, image, cell index) in
+    one pass over the tree. Returns the pairs as a dict mapping each key to
+    [manual path, CP path] (None where that skeleton is missing), the
+    number of files that repeat a key (only the first one is paired), and
+    the subdirectories that were visited.
+    '''
+    patterns = [re.compile(manual_regex), re.compile(cp_regex)]
+    pairs    = {}
+    repeated = 0
+    subdirs  = []
 
-differences = {}
-for key in man_counts:
-    differences[key] = cp_counts[key] - man_counts[key]
-    #if differences[key] == 50:
-    #   print(key)
+    for dir_path, files in mcp_scan.walk(root_path, manifest_path, threads):
+        subdir = os.path.relpath(dir_path, root_path)
+        subdirs.append(subdir)
 
-# print(differences)
+        for name, _, _ in files:
+            for kind, rgx in enumerate(patterns):
+                match = rgx.match(name)
+                if match is None:
+                    continue
 
-diff_frame = pd.DataFrame(differences.values())
-print(diff_frame.describe())
+                groups = match.groupdict()
+                cell   = int(groups['cell']) if groups.get('cell') else -1
+                pair   = pairs.setdefault((subdir, groups.get('image') or '', cell), [None, None])
+                if pair[kind] is None:
+                    pair[kind] = os.path.join(dir_path, name)
+                else:
+                    repeated += 1
+                break # A file is either manual or CP, like the original counts
 
-#print('Manual', man_counts)
-#print('CellProfiler', cp_counts)
+    return pairs, repeated, subdirs
 
-print('Manual totals', sum(man_counts.values()))
-print('CellProfiler totals', sum(cp_counts.values()))
\ No newline at end of file
+
+def pairing_table(pairs):
+    '''Builds the per-cell pairing DataFrame, sorted by subdirectory, image and cell.'''
+    status = {(True, True): 'matched', (True, False): 'manual_only', (False, True): 'cp_only'}
+    rows   = [(subdir, image, cell, status[manual is not None, cp is not None], manual, cp)
+              for (subdir, image, cell), (manual, cp) in pairs.items()]
+
+    df = pd.DataFrame.from_records(rows, columns=PAIRING_COLUMNS)
+    return df.sort_values(['subdir', 'image', 'cell'], kind='mergesort').reset_index(drop=True)
+
+
+def main(root_path, output_path=None, manual_regex=MANUAL_REGEX, cp_regex=CP_REGEX, manifest_path=None, threads=1):
+    pairs, repeated, subdirs = pair_cells(root_path, manual_regex, cp_regex, manifest_path, threads)
+    df = pairing_table(pairs)
+
+    # Per subdirectory difference between the CellProfiler and manual counts
+    counts = df.groupby('subdir')[['manual_path', 'cp_path']].count()
+    counts = counts.reindex(sorted(subdirs), fill_value=0)
+    print((counts['cp_path'] - counts['manual_path']).describe())
+
+    print('Manual totals', int(counts['manual_path'].sum()))
+    print('CellProfiler totals', int(counts['cp_path'].sum()))
+    for status, count in df['status'].value_counts().reindex(['matched', 'manual_only', 'cp_only'], fill_value=0).items():
+        print(f'{status:<12}', count)
+    if repeated > 0:
+        print(f'{repeated} files repeat the cell of another file and were not paired')
+
+    if output_path:
+        df.to_csv(output_path, index=False)
+        print(f'Wrote {len(df)} cells to {output_path}')
+
+
+'''
+Program execution starts here.
+'''
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pairs the manual and CellProfiler skeletons by cell')
+
+    parser.add_argument('-d', '--dir', required=True, type=str,
+                        help='Root directory with skeletons (i.e. "/home/user/Documents/skels")')
+    parser.add_argument('-o', '--output', required=False, type=str,
+                        help='Pairing table .csv file path, with the status of every cell (matched, manual_only or cp_only)', default=None)
+    parser.add_argument('--manual-regex', required=False, type=str,
+                        help='Regex of the manual skeletons, with a "cell" (and optional "image") group', default=MANUAL_REGEX)
+    parser.add_argument('--cp-regex', required=False, type=str,
+                        help='Regex of the CellProfiler skeletons, with a "cell" (and optional "image") group', default=CP_REGEX)
+    parser.add_argument('-m', '--manifest', required=False, type=str,
+                        help='Directory listing cache (i.e. "/home/user/Documents/skels.manifest"), so reruns only list changed directories', default=None)
+    parser.add_argument('-t', '--scan-threads', required=False, type=int,
+                        help='Number of threads listing directories (i.e. 8 on a network share)', default=1)
+
+    args = vars(parser.parse_args())
+
+    if args['scan_threads'] < 1:
+        parser.error('-t/--scan-threads must be at least 1')
+    for key in ('manual_regex', 'cp_regex'):
+        if 'cell' not in re.compile(args[key]).groupindex:
+            parser.error(f'--{key.replace("_", "-")} needs a "cell" group')
+
+    main(args['dir'], args['output'], args['manual_regex'], args['cp_regex'], args['manifest'], args['scan_threads'])
@@ -1,9 +1,30 @@
-import sys, os, re, argparse
-import imagej
+import sys, os, argparse, struct, tempfile
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
+import mcp_cache
+import mcp_output
+import mcp_scan
+
 MACRO_PATH  = os.path.join(os.getcwd(), 'mcp_fiji_analysis.py')
 
+# Analysis parameters the per-image results depend on (the ridge detection
+# settings are the macro's defaults). Part of the result cache key.
+ANALYSIS_PARAMS = {
+    'threshold_method'   : 'otsu',
+    'use_ridge_detection': False,
+    'rd_max'   : 75,
+    'rd_min'   : 5,
+    'rd_width' : 1,
+    'rd_length': 3,
+}
+
+# Number of images analyzed (and committed to the output) at a time
+CHUNK_SIZE = 8
+
 OUTPUT_ORDER = [
     'image_title',
     'thresholding_op',
@@ -46,9 +67,9 @@ OUTPUT_ORDER = [
 # Outputs that represent lengths (to convert to scale value)
 # TODO can standard deviaiton be converted linearly?
 LENGTH_OUTPUTS = [
-    'rod_len_mean',
-    'rod_len_med',
-    'rod_len_stdevp',
+    'rod_lens_mean',
+    'rod_lens_med',
+    'rod_lens_stdevp',
 
     'network_branch_lens_mean',
     'network_lens_mean',
@@ -136,77 +157,345 @@ OUTPUT_TITLES = [
 ]
 
 
-def main(fiji_exec_path, root_path, regex_str, output_path, pix_to_um_scale=1.0):
-    ij = imagej.init(fiji_exec_path) # /home/mitocab/Fiji.app
-    print(ij.getApp().getInfo(True))
-
-    # Load mcp_analysis macro
-    print('Current directory:')
-    print(f'    {os.getcwd()}')
-    print('Reading MitoCellPhe macro file at:')
-    print(f'    {MACRO_PATH}')
+def find_skeletons(root_path, regex_str, manifest_path=None):
+    '''Returns the sorted paths of the files under root_path whose name matches regex_str.
+
+    With a manifest_path, the directory listing is cached there (see mcp_scan).
+    '''
+    return mcp_scan.find_files(root_path, regex_str, manifest_path)
+
+
+def decode_modified_utf8(raw):
+    '''Decodes a string written by Java's DataOutputStream.writeUTF. It is
+    modified UTF-8: NUL is written as C0 80, and characters outside of the
+    BMP as a UTF-16 surrogate pair of 3-byte sequences each.'''
+    text = raw.replace(b'\xc0\x80', b'\x00').decode('utf-8', 'surrogatepass')
+    return text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le')
+
+
+def read_result_table(path):
+    '''Reads the typed binary result table written by the macro's ResultTableWriter.
+
+    Returns a dict with the image paths and titles (lists of strings), one
+    NumPy array (int64 or float64) per numeric column, and the branch count
+    of every skeleton and the lengths of their branches (lists per image).
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, n_columns = struct.unpack_from('>4sii', data, 0)
+    if magic != b'MCPT' or version != 2:
+        raise ValueError(f'{path} is not a MitoCellPhe result table')
+    offset = 12
+
+    def read_utf(offset):
+        length, = struct.unpack_from('>H', data, offset)
+        return decode_modified_utf8(data[offset + 2:offset + 2 + length]), offset + 2 + length
+
+    fields = []
+    for _ in range(n_columns):
+        name, offset = read_utf(offset)
+        kind = chr(data[offset])
+        fields.append((name, '>i8' if kind == 'i' else '>f8'))
+        offset += 1
+
+    # Records are two strings followed by a fixed-size block of values, so
+    # the strings are sliced out and the value blocks decoded in one go.
+    record = np.dtype(fields)
+    paths, titles, blocks = [], [], []
+    component_branches, branch_lengths = [], []
+    while offset < len(data):
+        ipath, offset = read_utf(offset)
+        title, offset = read_utf(offset)
+        paths.append(ipath)
+        titles.append(title)
+        blocks.append(data[offset:offset + record.itemsize])
+        offset += record.itemsize
+
+        n_components, = struct.unpack_from('>i', data, offset)
+        counts = np.frombuffer(data, dtype='>i4', count=n_components, offset=offset + 4)
+        offset += 4 + 4 * n_components
+        lengths = np.frombuffer(data, dtype='>f8', count=int(counts.sum()), offset=offset)
+        offset += 8 * len(lengths)
+        component_branches.append(counts.tolist())
+        branch_lengths.append(lengths.tolist())
+
+    values  = np.frombuffer(b''.join(blocks), dtype=record)
+    outputs = {'image_path': paths, 'image_title': titles,
+               'component_branches': component_branches, 'branch_lengths': branch_lengths}
+    for name, _ in fields:
+        outputs[name] = values[name].astype(values.dtype[name].newbyteorder('='))
+
+    return outputs
+
+
+class FijiEngine:
+    '''Runs the MitoCellPhe macro in one Fiji (JVM) instance, which is
+    started once and reused for every batch of images.'''
+
+    def __init__(self, fiji_exec_path, params):
+        import imagej
+
+        self.params = params
+        self.ij     = imagej.init(fiji_exec_path) # /home/mitocab/Fiji.app
+        print(self.ij.getApp().getInfo(True))
+
+        # Load mcp_analysis macro
+        print('Current directory:')
+        print(f'    {os.getcwd()}')
+        print('Reading MitoCellPhe macro file at:')
+        print(f'    {MACRO_PATH}')
+
+        with open(MACRO_PATH, 'r') as f:
+            self.mcp_macro = f.read()
+
+    def run(self, image_paths):
+        '''Runs the macro on image_paths and returns its outputs as a dict of columns.'''
+        # Hand the images to the macro as a file list, so it analyzes exactly
+        # these paths (in this order) instead of walking the tree itself.
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(image_paths))
+            list_path = f.name
+
+        # The macro writes its numeric outputs to a typed binary table, which
+        # is read back directly instead of parsing its String outputs.
+        with tempfile.NamedTemporaryFile(suffix='.mcpt', delete=False) as f:
+            table_path = f.name
+
+        mcp_args = {
+            'root_directory': '',
+            'regex_string'  : '.*',
+            'file_list'     : list_path,
+            'result_table'  : table_path,
+            'threshold_method'   : self.params['threshold_method'],
+            'use_ridge_detection': self.params['use_ridge_detection'],
+            'verbose': False
+        }
+
+        try:
+            self.ij.py.run_script('py', self.mcp_macro, mcp_args) # Run MitoCellPhe on the IJ module
+            return read_result_table(table_path)
+        finally:
+            os.remove(list_path)
+            os.remove(table_path)
+
+
+class NativeEngine:
+    '''Analyzes the images with the NumPy/SciPy engine, without a JVM.'''
+
+    def __init__(self, params):
+        import mcp_native_analysis
+
+        self.analysis = mcp_native_analysis
+        self.params   = params
+
+    def run(self, image_paths):
+        '''Analyzes image_paths and returns the outputs as a dict of lists.'''
+        return self.analysis.run(image_paths, self.params['threshold_method'])
+
+
+def create_engine(engine, fiji_exec_path, params):
+    if engine == 'native':
+        return NativeEngine(params)
+    return FijiEngine(fiji_exec_path, params)
+
+
+# Engine of a worker process, created once by init_worker
+_worker_engine = None
+
+def init_worker(engine, fiji_exec_path, params):
+    global _worker_engine
+    _worker_engine = create_engine(engine, fiji_exec_path, params)
+
+def run_worker(image_paths):
+    return _worker_engine.run(image_paths) if image_paths else {}
+
+
+def to_rows(outputs):
+    '''Splits a dict of columns into one dict per image.'''
+    keys    = list(outputs)
+    columns = [v.tolist() if isinstance(v, np.ndarray) else v for v in outputs.values()]
+    return [dict(zip(keys, values)) for values in zip(*columns)]
 
-    with open(MACRO_PATH, 'r') as f:
-        mcp_macro = f.read()
 
-    mcp_args = {
-        'root_directory': str(root_path),
-        'regex_string'  : str(regex_str),
-        'use_ridge_detection': False,
-        'verbose': False
-    }
+def from_rows(rows):
+    '''Joins one dict per image back into a dict of lists.'''
+    outputs = {}
+    for row in rows:
+        for k, v in row.items():
+            outputs.setdefault(k, []).append(v)
+    return outputs
 
-    # Print the number of matches with the regex you provided.
-    rgx       = re.compile(regex_str)
-    match_cnt = 0
-    for subdir, dirs, files in os.walk(root_path):
-        for file in files:
-            if rgx.match(file):
-                match_cnt += 1
 
-    print('Calling MitoCellPhe macro with args...')
-    print('    Root directory   :', root_path)
-    print('    Regex string     :', regex_str)
-    print('    Number of matches:', match_cnt)
-    result = ij.py.run_script('py', mcp_macro, mcp_args) # Run MitoCellPhe on the IJ module
-    ij_out = ij.py.from_java(result.getOutputs())         # Get the outputs
-    py_out = {} # Have to manually copy the IJ dictionary to Python, even though
-                # it is already Python-ated (because it is a JavaMap and not a dict)
-                # because Pandas won't take the raw Pyimagej casting of the dict.
+def iter_chunks(paths, chunk_size):
+    '''Groups an iterable of paths into lists of chunk_size paths (the last one may be shorter).'''
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_outputs(outputs, pix_to_um_scale, first_index=0):
+    '''Builds the output DataFrame (filtered, titled and scaled columns) of a dict of columns.'''
+    py_out = {}
     
-    # Filter and sort the IJ output dictionary so that only
+    # Filter and sort the output dictionary so that only
     # the columns we want are presented, and in the proper order.
-    filtered_kvs  = list([kv for kv in ij_out.items() if kv[0] in OUTPUT_FILTER])     # key/value pairs
-    sorted_kvs    = sorted(filtered_kvs, key = lambda kv: OUTPUT_FILTER.index(kv[0])) # sorted key/value pairs       
-
-    for k, v in sorted_kvs:
-        # Format the items so that they are save-able into the CSV
-        # (and to potentially re-cast them to their proper types)
-        if k in OUTPUT_FILTER:
-            idx   = OUTPUT_FILTER.index(k)
-            title = OUTPUT_TITLES[idx]
-            v = v.strip('[]').split(', ')
-            for i in range(len(v)):
-                if v[i].startswith("u'") or v[i].startswith('u"'):
-                    v[i] = v[i][2:]
-                v[i] = v[i].strip('\'\"')
-
-            if k in LENGTH_OUTPUTS:
-                print('K,v length before ', k, v)
-                for i, _ in enumerate(v):
-                    v[i] = float(v[i]) / pix_to_um_scale
-                print('K,v length after ', k,v)
-            elif k in AREA_OUTPUTS:
-                print('K,v area before ', k, v)
-                for i, _ in enumerate(v):
-                    v[i] = float(v[i]) / (pix_to_um_scale**2)
-                print('K,v area after ', k,v)
-            
-            py_out[title] = v
-            print(title, ':\n', py_out[title])
+    for k, title in zip(OUTPUT_FILTER, OUTPUT_TITLES):
+        if k not in outputs:
+            continue
+
+        # Scale lengths and areas as whole columns
+        v = outputs[k]
+        if k in LENGTH_OUTPUTS:
+            v = np.asarray(v, dtype=np.float64) / pix_to_um_scale
+        elif k in AREA_OUTPUTS:
+            v = np.asarray(v, dtype=np.float64) / (pix_to_um_scale**2)
+        
+        py_out[title] = v
 
     df = pd.DataFrame.from_dict(py_out)
-    df.to_csv(output_path)
+    df.index += first_index
+    return df
+
+
+def main(fiji_exec_path, root_path, regex_str, output_path, pix_to_um_scale=1.0, engine='fiji', jobs=1,
+         cache_path=None, chunk_size=CHUNK_SIZE, export_components=False, manifest_path=None, scan_threads=1):
+    print(f'Calling MitoCellPhe ({engine} engine) with args...')
+    print('    Root directory   :', root_path)
+    print('    Regex string     :', regex_str)
+    if scan_threads > 1:
+        # Stream the matches, so the analysis starts while the tree is walked.
+        # They come in sorted order, so the rows are in the same order as
+        # with a single scan thread.
+        image_paths = mcp_scan.iter_files(root_path, regex_str, manifest_path, scan_threads)
+        print('    Scan threads     :', scan_threads)
+    else:
+        # Print the number of matches with the regex you provided.
+        image_paths = find_skeletons(root_path, regex_str, manifest_path)
+        print('    Number of matches:', len(image_paths))
+    print('    Worker processes :', jobs)
+
+    params = dict(ANALYSIS_PARAMS, engine=engine)
+
+    # Rows are appended to the output as each chunk of images completes. If
+    # a previous run with the same settings was interrupted, resume after
+    # its last committed row.
+    run_info = dict(params, root_path=root_path, regex_str=regex_str, pix_to_um_scale=pix_to_um_scale,
+                    export_components=export_components)
+    writer   = mcp_output.JournaledCSVWriter(output_path, run_info)
+    if writer.completed:
+        print(f'Resuming after {writer.rows} committed rows ({len(writer.completed)} images)')
+
+    # Per-skeleton table written next to the CSV, i.e. skels.csv -> skels.components.npz
+    components = None
+    if export_components:
+        components_path = os.path.splitext(output_path)[0] + '.components.npz'
+        components = mcp_output.ComponentTableWriter(components_path, writer.chunks)
+
+    pending = (path for path in image_paths if path not in writer.completed)
+    chunks  = iter_chunks(pending, chunk_size)
+
+    # Reuse the cached rows of images that were already analyzed with these
+    # parameters. Rows are cached before scaling, so the scale is not part
+    # of the key and changing it does not invalidate the cache.
+    cache   = mcp_cache.ResultCache(cache_path, params) if cache_path else None
+    cached  = {} # Cached result row of each image path
+    digests = {} # Content digest of each image path
+
+    # Rows cached before the component table existed lack the skeletons
+    required = ('component_branches', 'branch_lengths') if components is not None else ()
+
+    def lookup(chunk):
+        '''Returns the paths of a chunk that are not cached.'''
+        if cache is None:
+            return chunk
+        for path in chunk:
+            digests[path] = mcp_cache.file_digest(path)
+            row = cache.get(digests[path], required)
+            if row is not None:
+                # Identical contents may have been cached under another name
+                row['image_path']  = path
+                row['image_title'] = os.path.basename(path)
+                cached[path] = row
+        return [path for path in chunk if path not in cached]
+
+    # Engines are only started once there is an image to analyze
+    executor, futures = None, collections.deque()
+    instance = None
+    def results():
+        '''Yields each chunk with its outputs, in chunk order.'''
+        nonlocal executor, instance
+        for chunk in chunks:
+            todo = lookup(chunk)
+            if jobs > 1:
+                if todo and executor is None:
+                    # Spawn (rather than fork) the workers, so each one starts
+                    # its own engine (and JVM) cleanly.
+                    context  = multiprocessing.get_context('spawn')
+                    executor = ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                                   initializer=init_worker,
+                                                   initargs=(engine, fiji_exec_path, params))
+                futures.append((chunk, executor.submit(run_worker, todo) if todo else None))
+
+                # Keep a couple of chunks queued per worker
+                while len(futures) > 2 * jobs:
+                    done, future = futures.popleft()
+                    yield done, future.result() if future is not None else {}
+            else:
+                if todo and instance is None:
+                    instance = create_engine(engine, fiji_exec_path, params)
+                yield chunk, instance.run(todo) if todo else {}
+
+        while futures:
+            done, future = futures.popleft()
+            yield done, future.result() if future is not None else {}
+
+    try:
+        for chunk, outputs in results():
+            rows = {row['image_path']: row for row in to_rows(outputs)}
+            if cache is not None:
+                for path, row in rows.items():
+                    cache.put(digests[path], row)
+                for path in chunk:
+                    digests.pop(path)
+            rows.update((path, cached.pop(path)) for path in chunk if path in cached)
+
+            # Images that could not be opened (or analyzed) have no row
+            for path in chunk:
+                if path not in rows:
+                    print('Warning: no result for', path, '- it is left out of the output')
+            chunk_rows = from_rows([rows[path] for path in chunk if path in rows])
+            if components is not None:
+                components.write(writer.chunks, chunk_rows, writer.rows, pix_to_um_scale)
+            writer.write(format_outputs(chunk_rows, pix_to_um_scale, writer.rows), chunk)
+
+            # Commit the analyzed rows with the chunk, so a killed run keeps them
+            if cache is not None:
+                cache.commit()
+    finally:
+        if executor is not None:
+            for _, future in futures:
+                if future is not None:
+                    future.cancel()
+            executor.shutdown()
+        if cache is not None:
+            cache.close()
+        writer.close()
+
+    if components is not None:
+        components.finish()
+        print(f'Wrote the skeletons of {writer.rows} rows to {components_path}')
+
+    writer.finish()
+    print(f'Wrote {writer.rows} rows to {output_path}')
+
+    if cache is not None:
+        cache.report()
 
 
 
@@ -216,8 +505,8 @@ Program execution starts here.
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='MitoCellPhe batch processing')
 
-    parser.add_argument('-f', '--fiji', required=True, type=str, 
-                        help='Fiji install directory (i.e. "/home/user/Fiji.app")')
+    parser.add_argument('-f', '--fiji', required=False, type=str, 
+                        help='Fiji install directory (i.e. "/home/user/Fiji.app"), required by the fiji engine')
     parser.add_argument('-d', '--dir', required=True, type=str, 
                         help='Root directory with skeletons (i.e. "/home/user/Documents/skels"')
     parser.add_argument('-o', '--output', required=True, type=str, 
@@ -226,7 +515,32 @@ if __name__ == '__main__':
                         help='Regex to find skeleton files (i.e ".*_cp_skel_[0-9]*.*")', default='.*')
     parser.add_argument('-s', '--scale', required=False, type=float, 
                         help='1 pixel = ? micrometers scale (i.e. "4.61" pixels = 1 um)', default=1.0)
+    parser.add_argument('-e', '--engine', required=False, type=str, choices=['fiji', 'native'],
+                        help='Analysis engine: "fiji" runs the macro in Fiji, "native" runs in NumPy/SciPy without a JVM, '
+                             'with ports of the same thresholding ops', default='fiji')
+    parser.add_argument('-j', '--jobs', required=False, type=int,
+                        help='Number of worker processes, each running its own engine instance', default=1)
+    parser.add_argument('-c', '--cache', required=False, type=str,
+                        help='Result cache file (i.e. "/home/user/Documents/skels.cache"), so reruns only analyze new or changed images', default=None)
+    parser.add_argument('--chunk-size', required=False, type=int,
+                        help='Number of images analyzed and committed to the output at a time', default=CHUNK_SIZE)
+    parser.add_argument('--components', required=False, action='store_true',
+                        help='Also write the per-skeleton branch table next to the output (i.e. "skelsout.components.npz")')
+    parser.add_argument('-t', '--scan-threads', required=False, type=int,
+                        help='Number of threads listing directories; with more than 1, images are analyzed as they are found', default=1)
+    parser.add_argument('-m', '--manifest', required=False, type=str,
+                        help='Directory listing cache (i.e. "/home/user/Documents/skels.manifest"), so reruns only list changed directories', default=None)
 
     args = vars(parser.parse_args())
 
-    main(args['fiji'], args['dir'], args['regex'], args['output'], args['scale'])
+    if args['engine'] == 'fiji' and not args['fiji']:
+        parser.error('the fiji engine requires -f/--fiji')
+    if args['jobs'] < 1:
+        parser.error('-j/--jobs must be at least 1')
+    if args['scan_threads'] < 1:
+        parser.error('-t/--scan-threads must be at least 1')
+    if args['chunk_size'] < 1:
+        parser.error('--chunk-size must be at least 1')
+
+    main(args['fiji'], args['dir'], args['regex'], args['output'], args['scale'], args['engine'], args['jobs'],
+         args['cache'], args['chunk_size'], args['components'], args['manifest'], args['scan_threads'])
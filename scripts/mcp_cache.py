@@ -0,0 +1,90 @@
+'''
+Persistent, content-addressed cache of per-image MitoCellPhe results.
+
+Rows are keyed by the SHA-256 of the image file contents together with a
+hash of the analysis parameters, so a rerun only has to analyze images
+that are new or changed (or were analyzed with other settings). The cache
+is a single SQLite file that can live anywhere, i.e. next to the output.
+'''
+
+import hashlib
+import json
+import sqlite3
+
+# Seconds to wait for another run sharing the cache file to release its lock
+BUSY_TIMEOUT = 60.0
+
+
+def file_digest(path, block_size=1 << 20):
+    '''Returns the SHA-256 hex digest of a file's contents.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''On-disk cache mapping (image content, analysis parameters) to a result row.
+
+    Stored rows are only durable once commit is called, which mcp_batch
+    does for every chunk it commits to the output. Several runs can share a
+    cache file.
+
+    Parameters:
+        path:   string
+            - Path of the SQLite cache file (created if it does not exist).
+        params: dict
+            - The analysis parameters the cached rows depend on. Rows stored
+              with other parameters are kept but never returned.
+    '''
+
+    def __init__(self, path, params):
+        self.path   = path
+        self.params = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        self.hits   = 0
+        self.misses = 0
+        self.stored = 0
+
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        '    content_hash TEXT NOT NULL,'
+                        '    params_hash  TEXT NOT NULL,'
+                        '    row          TEXT NOT NULL,'
+                        '    PRIMARY KEY (content_hash, params_hash))')
+
+    def get(self, content_hash, required=()):
+        '''Returns the cached row for an image digest, or None if it has not
+        been analyzed or its row lacks any of the required keys.'''
+        found = self.db.execute('SELECT row FROM results WHERE content_hash = ? AND params_hash = ?',
+                                (content_hash, self.params)).fetchone()
+        row = json.loads(found[0]) if found is not None else None
+        if row is None or any(key not in row for key in required):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row
+
+    def put(self, content_hash, row):
+        '''Stores the result row of an image digest.'''
+        self.db.execute('INSERT OR REPLACE INTO results (content_hash, params_hash, row) VALUES (?, ?, ?)',
+                        (content_hash, self.params, json.dumps(row)))
+        self.stored += 1
+
+    def commit(self):
+        '''Makes the rows stored so far durable, and visible to other runs.'''
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def report(self):
+        '''Prints the hit/miss statistics of this run.'''
+        lookups  = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups > 0 else 0.0
+        print('Result cache:', self.path)
+        print(f'    Hits    : {self.hits} ({hit_rate:.1f}%)')
+        print(f'    Misses  : {self.misses}')
+        print(f'    Stored  : {self.stored}')
@@ -1,6 +1,10 @@
 '''
 #@ String  (label="Root directory: ", value="") root_directory
 #@ String  (label="Regex: ", value="a^") regex_string
+#@ String  (label="File list or manifest (optional): ", value="", required=False) file_list
+#@ Integer (label="Images to read ahead:", value=2, required=False) prefetch
+#@ Integer (label="Directory listing threads:", value=1, required=False) scan_threads
+#@ String  (label="Result table file (optional): ", value="", required=False) result_table
 #@ String  (label = "Thresholding Op:", value="otsu", choices={"huang", "ij1", "intermodes", "isoData", "li", "maxEntropy", "maxLikelihood", "mean", "minError", "minimum", "moments", "otsu", "percentile", "renyiEntropy", "rosin", "shanbhag", "triangle", "yen"}) threshold_method
 #@ Boolean (label="Use ridge detection (2D only):", value=False) use_ridge_detection
 #@ BigInteger (label="High contrast:", value=75, required=False) rd_max
@@ -11,6 +15,7 @@
 #@ Boolean (label="Verbose:", value=False) verbose
 #@ OpService ops
 
+#@output String image_path
 #@output String image_title
 #@output String thresholding_op
 #@output String use_ridge_detection
@@ -58,22 +63,31 @@ PyImageJ when it comes to returning arrays. This is probably because
 the underlying structure of String is an array to begin with.
 
 This looks weird but actually works when the script is run in headless mode.
+
+When a result_table path is given, the numeric outputs are also written
+there as a typed binary table (see ResultTableWriter), which is what
+mcp_batch reads instead of re-parsing the Strings.
 '''
 
+import json
 import os
 import re
+import threading
 
 from math import sqrt
+from Queue import Queue
 from ij import IJ
 from ij import ImagePlus
 from ij import WindowManager
 from ij.io import LogStream
 from ij.gui import ImageRoi
 from ij.gui import Overlay
-from ij.measure import ResultsTable, Measurements
+from ij.measure import ResultsTable
 from ij.plugin import Duplicator
 from ij.process import ImageStatistics
+from ij.process import StackStatistics
 from java.io import File
+from java.io import BufferedOutputStream, DataOutputStream, FileOutputStream
 
 from net.imglib2.img.display.imagej import ImageJFunctions
 from net.imglib2.type.numeric.integer import UnsignedByteType
@@ -85,6 +99,12 @@ from sc.fiji.analyzeSkeleton import AnalyzeSkeleton_
 from org.scijava.vecmath import Point3f
 from org.scijava.vecmath import Color3f
 
+# mcp_scan lists directories modified within 2 s of a scan again on the next
+# one, so a directory changed since its manifest was written has moved its
+# mtime by more than that. An mtime within a second of the manifest's (ns)
+# is unchanged, however coarse the mtimes Jython reads are.
+MTIME_TOLERANCE = 10**9
+
 # Helper functions..............................................................
 def ridge_detect(imp, rd_max, rd_min, rd_width, rd_length):
     title = imp.getTitle()
@@ -96,48 +116,331 @@ def ridge_detect(imp, rd_max, rd_min, rd_width, rd_length):
     skel.hide()
     return(skel)
 
-def average(num_list, divide_by=None):
-    if divide_by is None:
-        return sum(num_list)/len(num_list)
-    else:
-        return sum(num_list)/divide_by
+class LengthStats(object):
+    '''
+    Accumulates values for their mean, population standard deviation and
+    median in a single pass.
+
+    The mean and variance are updated with Welford's algorithm as values
+    are added, and the median is found by partition-based selection
+    instead of sorting. All statistics are 0 when no values were added.
+    '''
+    def __init__(self):
+        self.count  = 0
+        self.total  = 0.0
+        self.mean   = 0.0
+        self.m2     = 0.0 # Sum of squared differences from the mean
+        self.values = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta       = value - self.mean
+        self.mean  += delta / self.count
+        self.m2    += delta * (value - self.mean)
+        self.values.append(value)
+
+    def average(self):
+        return self.mean if self.count > 0 else 0
+
+    def pstdev(self):
+        return sqrt(self.m2 / self.count) if self.count > 0 else 0
+
+    def median(self):
+        if self.count == 0:
+            return 0
+        index = (self.count - 1) // 2
+        lower = select(self.values, index)
+        if self.count % 2:
+            return lower
+        # Everything after the selected index is >= it after partitioning
+        return (lower + min(self.values[index + 1:])) / 2.0
+
+def select(values, k):
+    '''
+    Returns the k-th smallest value (Hoare's selection), partially
+    reordering values in place so that values[k] holds it.
+    '''
+    left, right = 0, len(values) - 1
+    while left < right:
+        pivot = values[(left + right) // 2]
+        i, j  = left, right
+        while i <= j:
+            while values[i] < pivot:
+                i += 1
+            while values[j] > pivot:
+                j -= 1
+            if i <= j:
+                values[i], values[j] = values[j], values[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            right = j
+        elif k >= i:
+            left = i
+        else:
+            break
+    return values[k]
+
+def footprint(binary, calibration):
+    '''
+    Returns the calibrated area (or volume, for stacks) of the foreground
+    of a binary image. The foreground pixels of every slice are counted
+    from one histogram of the whole stack, and scaled by the pixel area
+    (and depth).
+    '''
+    stats = StackStatistics(binary)
+
+    # Bin 0 holds the background, unless there is none
+    background = stats.histogram[0] if stats.min == 0 else 0
+    foreground = stats.longPixelCount - background
+
+    size = calibration.pixelWidth * calibration.pixelHeight
+    if binary.getNSlices() > 1:
+        size *= calibration.pixelDepth
+    return foreground * size
+
+def batch_load(root_dir, regex_str, list_path=None, prefetch=2, scan_threads=1):
+    rgx    = re.compile(regex_str)
+    image_paths = []
 
-def median(num_list):
-    sorted_list = sorted(num_list)
-    length      = len(num_list)
-    index = (length - 1) // 2
+    if list_path:
+        with open(list_path, 'r') as f:
+            lines = [line.rstrip('\r\n') for line in f if line.strip()]
 
-    if (length % 2):
-        return sorted_list[index]
+        if lines and lines[0].startswith('{') and json.loads(lines[0]).get('format') == 'mcp-manifest':
+            # Directory listing cached by mcp_scan, one directory per line
+            image_paths = manifest_images(lines, rgx)
+        else:
+            # Explicit list of images, one path per line (i.e. a shard from mcp_batch)
+            image_paths = lines
+    elif scan_threads is not None and scan_threads > 1:
+        # Analyze the images as they are found (in no particular order)
+        image_paths = find_images(root_dir, rgx, scan_threads)
     else:
-        return (sorted_list[index] + sorted_list[index + 1])/2.0
+        for subdir, dirs, files in os.walk(root_dir):
+            for file in files:
+                if rgx.match(file):
+                    image_paths.append(os.path.join(root_dir, subdir, file))
 
-def pstdev(num_list):
-    var = 0 # Variance
-    avg = average(num_list)
-    for num in num_list:
-        var = var + (num - avg)**2
-    var = var / len(num_list)
-    return sqrt(var)
+        image_paths = sorted(set(image_paths))
 
-def batch_load(root_dir, regex_str):
-    rgx    = re.compile(regex_str)
-    image_paths = []
-    images      = []
+    return prefetch_images(image_paths, prefetch)
+
+def manifest_images(lines, rgx):
+    '''
+    Returns the sorted paths whose file name matches rgx in the tree that a
+    manifest of mcp_scan (its lines) lists, as the tree is now.
 
-    for subdir, dirs, files in os.walk(root_dir):
-        for file in files:
-            if rgx.match(file):
-                image_paths.append(os.path.join(root_dir, subdir, file))
+    The tree is walked from the manifest's root like mcp_scan does: a
+    directory whose mtime is unchanged is taken from the manifest (one stat)
+    and the others, including new ones, are listed again. The manifest is
+    not rewritten; mcp_batch and count_cells keep it up to date.
+    '''
+    root_dir = json.loads(lines[0])['root']
+    manifest = dict((entry[0], entry) for entry in map(json.loads, lines[1:]))
 
-    image_paths = set(image_paths)
-    
-    for ipath in image_paths:
-        imp = IJ.openImage(ipath)
-        if imp:
-            images.append(imp)
+    image_paths = []
+    dirs = [root_dir]
+    while dirs:
+        subdir = dirs.pop()
+        try:
+            mtime = os.stat(subdir).st_mtime * 1e9
+        except (IOError, OSError):
+            continue
+
+        entry = manifest.get(subdir)
+        if entry is not None and entry[1] >= 0 and abs(entry[1] - mtime) < MTIME_TOLERANCE:
+            subdirs, names = entry[2], [name for name, size, file_mtime in entry[3]]
+        else:
+            subdirs, names = [], []
+            try:
+                for name in os.listdir(subdir):
+                    path = os.path.join(subdir, name)
+                    if os.path.isdir(path):
+                        if not os.path.islink(path): # Like os.walk
+                            subdirs.append(name)
+                    else:
+                        names.append(name)
+            except (IOError, OSError) as e:
+                IJ.log("Could not list " + subdir + ": " + str(e))
+
+        image_paths += [os.path.join(subdir, name) for name in names if rgx.match(name)]
+        dirs += [os.path.join(subdir, name) for name in subdirs]
+
+    return sorted(image_paths)
+
+def find_images(root_dir, rgx, threads):
+    '''
+    Yields the paths under root_dir whose file name matches rgx while
+    `threads` threads list the directories in parallel, so the first
+    images can be opened before the whole tree has been walked.
+    '''
+    dirs    = Queue()
+    found   = Queue()
+    done    = object() # Marks the end of the walk
+    lock    = threading.Lock()
+    pending = [1]      # Directories queued or being listed
+
+    def lister():
+        while True:
+            subdir = dirs.get()
+            if subdir is done:
+                return
+            try:
+                for name in os.listdir(subdir):
+                    path = os.path.join(subdir, name)
+                    if os.path.isdir(path):
+                        if not os.path.islink(path): # Like os.walk
+                            with lock:
+                                pending[0] += 1
+                            dirs.put(path)
+                    elif rgx.match(name):
+                        found.put(path)
+            except (IOError, OSError) as e:
+                IJ.log("Could not list " + subdir + ": " + str(e))
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    finished = pending[0] == 0
+                if finished:
+                    for _ in range(threads):
+                        dirs.put(done)
+                    found.put(done)
+
+    dirs.put(root_dir)
+    for _ in range(threads):
+        thread = threading.Thread(target=lister)
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        path = found.get()
+        if path is done:
+            return
+        yield path
+
+def prefetch_images(image_paths, prefetch):
+    '''
+    Lazily opens the images, yielding each (path, image) pair as soon as
+    the image is read.
+
+    A background thread reads at most `prefetch` images ahead of the
+    consumer, so only O(prefetch) images are held in memory at once.
+    '''
+    if prefetch is None or prefetch < 1:
+        for ipath in image_paths:
+            imp = IJ.openImage(ipath)
+            if imp:
+                yield ipath, imp
+        return
+
+    queue  = Queue(prefetch)
+    done   = object() # Marks the end of the batch
+    errors = []       # Re-raised in the consumer
+
+    def reader():
+        try:
+            for ipath in image_paths:
+                imp = IJ.openImage(ipath)
+                if imp:
+                    queue.put((ipath, imp))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue.put(done)
+
+    thread = threading.Thread(target=reader, name="mcp-prefetch")
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item = queue.get()
+        if item is done:
+            break
+        yield item
+
+    if errors:
+        raise errors[0]
+
+# Numeric outputs stored in the result table, with their type
+# ('i' = 64-bit integer, 'd' = 64-bit float).
+TABLE_COLUMNS = [
+    ('high_contrast', 'i'),
+    ('low_contrast', 'i'),
+    ('line_width', 'i'),
+    ('min_line_length', 'i'),
+    ('mitochondrial_footprint', 'd'),
+
+    ('punctate_count', 'i'),
+    ('rod_count', 'i'),
+    ('network_count', 'i'),
+
+    ('punctate_pct', 'd'),
+    ('rod_pct', 'd'),
+    ('network_pct', 'd'),
+
+    ('rod_lens_mean', 'd'),
+    ('rod_lens_med', 'd'),
+    ('rod_lens_stdevp', 'd'),
+
+    ('network_num_branches_count', 'i'),
+    ('network_num_branches_mean', 'd'),
+    ('network_branch_lens_mean', 'd'),
+    ('network_lens_mean', 'd'),
+    ('network_lens_median', 'd'),
+    ('network_lens_stdevp', 'd'),
+
+    ('all_branches', 'i'),
+    ('all_branches_lens_mean', 'd'),
+    ('all_branches_lens_med', 'd'),
+    ('all_branches_lens_stdevp', 'd'),
+
+    ('summed_branches_lens_mean', 'd'),
+    ('summed_branches_lens_med', 'd'),
+    ('summed_branches_lens_stdevp', 'd'),
+]
+
+class ResultTableWriter(object):
+    '''
+    Writes the results as a typed binary table, one record per image.
+
+    Everything is big-endian (Java's DataOutputStream). The header is the
+    magic "MCPT", the format version and the column count (ints), then
+    each column's name (UTF) and type code (byte). Each record is the
+    image path and title (UTF) followed by the column values, as longs or
+    doubles according to their type, and then the image's skeletons: their
+    count (int), the branch count of each skeleton (ints) and the length
+    of every branch, grouped by skeleton (doubles).
+    '''
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.stream  = DataOutputStream(BufferedOutputStream(FileOutputStream(path)))
+        self.stream.writeBytes("MCPT")
+        self.stream.writeInt(2)
+        self.stream.writeInt(len(columns))
+        for name, kind in columns:
+            self.stream.writeUTF(name)
+            self.stream.writeByte(ord(kind))
+
+    def write(self, outputs, component_branches, branch_lengths):
+        ''' Writes the last (current) image in outputs and its skeletons as a record. '''
+        self.stream.writeUTF(outputs["image_path"][-1])
+        self.stream.writeUTF(outputs["image_title"][-1])
+        for name, kind in self.columns:
+            if kind == 'i':
+                self.stream.writeLong(int(outputs[name][-1]))
+            else:
+                self.stream.writeDouble(float(outputs[name][-1]))
 
-    return images
+        self.stream.writeInt(len(component_branches))
+        for count in component_branches:
+            self.stream.writeInt(count)
+        for length in branch_lengths:
+            self.stream.writeDouble(length)
+
+    def close(self):
+        self.stream.close()
 
 # The run function..............................................................
 def run():
@@ -145,6 +448,7 @@ def run():
     outputs = {}
 
     output_order = [
+        'image_path',
         'image_title',
         'thresholding_op',
         'use_ridge_detection',
@@ -186,12 +490,14 @@ def run():
     # TODO remove when you get globals working
     # root_directory = '/home/mitocab/Documents/Box-05282020'
     # regex_string   = '.*_cp_skel_[0-9]*.*'
-    imps = batch_load(root_directory, regex_string)
+    imps = batch_load(root_directory, regex_string, file_list, prefetch, scan_threads)
 
     for o in output_order:
         outputs[o] = []
+
+    table = ResultTableWriter(result_table, TABLE_COLUMNS) if result_table else None
    
-    for imp in imps:
+    for ipath, imp in imps:
         # Reserve spots for the next image's output data
         for k, _ in outputs.items():
             outputs[k].append(None)
@@ -212,6 +518,7 @@ def run():
         imp_title = imp.getTitle()
         slices = imp.getNSlices()
         frames = imp.getNFrames()
+        outputs["image_path"][-1]  = ipath
         outputs["image_title"][-1] = imp_title
         imp_calibration = imp.getCalibration()
         imp_channel = Duplicator().run(imp, imp.getChannel(), imp.getChannel(), 1, slices, 1, frames)
@@ -224,20 +531,7 @@ def run():
         binary.setDimensions(1, slices, 1)
 
         # Get the total area (i.e. footprint)
-        # TODO is this borked? The code in the MiNA paper (ijm code) is incorrect
-        # as it fundamentally calculates the wrong thing.
-        if binary.getNSlices() == 1:
-            area = binary.getStatistics(Measurements.AREA).area
-            area_fraction = binary.getStatistics(Measurements.AREA_FRACTION).areaFraction
-            outputs["mitochondrial_footprint"][-1] =  area * area_fraction / 100.0
-        else:
-            mito_footprint = 0.0
-            for slice in range(binary.getNSlices()):
-                    binary.setSliceWithoutUpdate(slice)
-                    area = binary.getStatistics(Measurements.AREA).area
-                    area_fraction = binary.getStatistics(Measurements.AREA_FRACTION).areaFraction
-                    mito_footprint += area * area_fraction / 100.0
-            outputs["mitochondrial_footprint"][-1] = mito_footprint * imp_calibration.pixelDepth
+        outputs["mitochondrial_footprint"][-1] = footprint(binary, imp_calibration)
 
         # Generate skeleton from masked binary ...
         # Generate ridges first if using Ridge Detection
@@ -262,7 +556,7 @@ def run():
         avg_branch_lens = skel_result.getAverageBranchLength()
 
         punctates, rods, networks, network_branches = 0, 0, 0, 0
-        rod_lens, network_lens = [], [] # TODO track indicies instead of copying vals to new lists
+        rod_lens, network_lens = LengthStats(), LengthStats()
 
         if branch_counts is not None:
             for i in range(len(branch_counts)):
@@ -270,26 +564,26 @@ def run():
                     punctates += 1
                 elif branch_counts[i] == 1:
                     rods += 1
-                    rod_lens.append(avg_branch_lens[i])
+                    rod_lens.add(avg_branch_lens[i])
                 else:
                     networks += 1
-                    network_lens.append(avg_branch_lens[i] * branch_counts[i])
+                    network_lens.add(avg_branch_lens[i] * branch_counts[i])
                     network_branches += branch_counts[i]
 
         outputs['punctate_count'][-1] = punctates
 
         outputs['rod_count'][-1]       = rods
-        outputs['rod_lens_mean'][-1]   = average(rod_lens) if rods > 0 else 0
-        outputs['rod_lens_med'][-1]    = median(rod_lens)  if rods > 0 else 0
-        outputs['rod_lens_stdevp'][-1] = pstdev(rod_lens)  if rods > 0 else 0
+        outputs['rod_lens_mean'][-1]   = rod_lens.average()
+        outputs['rod_lens_med'][-1]    = rod_lens.median()
+        outputs['rod_lens_stdevp'][-1] = rod_lens.pstdev()
 
         outputs['network_count'][-1]    = networks
         outputs['network_num_branches_count'][-1] = network_branches
         outputs['network_num_branches_mean'][-1]  = float(network_branches) / float(networks) if networks > 0 else 0
-        outputs['network_branch_lens_mean'][-1]   = average(network_lens, network_branches) if network_branches > 0 else 0
-        outputs['network_lens_mean'][-1]   = average(network_lens) if networks > 0 else 0
-        outputs['network_lens_median'][-1] = median(network_lens) if networks > 0 else 0
-        outputs['network_lens_stdevp'][-1] = pstdev(network_lens) if networks > 0 else 0
+        outputs['network_branch_lens_mean'][-1]   = network_lens.total / network_branches if network_branches > 0 else 0
+        outputs['network_lens_mean'][-1]   = network_lens.average()
+        outputs['network_lens_median'][-1] = network_lens.median()
+        outputs['network_lens_stdevp'][-1] = network_lens.pstdev()
 
         # Caluculate percentage paramters
         outputs['punctate_pct'][-1] = 100.0 * punctates / (punctates + rods + networks)
@@ -298,9 +592,12 @@ def run():
 
         if verbose:
             IJ.log("Computing graph based parameters...")
-        branch_lengths = []
-        summed_lengths = []
-        
+        branch_lengths = LengthStats()
+        summed_lengths = LengthStats()
+
+        # Per-skeleton branch counts and lengths, for the component table
+        component_branches = []
+        component_lengths  = []
         
         graphs = skel_result.getGraph()
         total_num_branches = 0.0
@@ -308,23 +605,25 @@ def run():
             for graph in graphs:
                 summed_length = 0.0
                 edges = graph.getEdges()
+                component_branches.append(len(edges))
                 for edge in edges:
                     total_num_branches += 1
                     length = edge.getLength()
-                    branch_lengths.append(length)
+                    branch_lengths.add(length)
+                    component_lengths.append(length)
                     summed_length += length
                 if summed_length > 0.0: # Eliminate punctates
-                    summed_lengths.append(summed_length)
+                    summed_lengths.add(summed_length)
 
 
         outputs["all_branches"][-1] = total_num_branches
-        outputs["all_branches_lens_mean"][-1]   = average(branch_lengths) if len(branch_lengths) > 0 else 0
-        outputs["all_branches_lens_med"][-1]    = median(branch_lengths) if len(branch_lengths) > 0 else 0
-        outputs["all_branches_lens_stdevp"][-1] = pstdev(branch_lengths) if len(branch_lengths) > 0 else 0
+        outputs["all_branches_lens_mean"][-1]   = branch_lengths.average()
+        outputs["all_branches_lens_med"][-1]    = branch_lengths.median()
+        outputs["all_branches_lens_stdevp"][-1] = branch_lengths.pstdev()
 
-        outputs["summed_branches_lens_mean"][-1]   = average(summed_lengths) if len(summed_lengths) > 0 else 0
-        outputs["summed_branches_lens_med"][-1]    = median(summed_lengths) if len(summed_lengths) > 0 else 0
-        outputs["summed_branches_lens_stdevp"][-1] = pstdev(summed_lengths) if len(summed_lengths) > 0 else 0
+        outputs["summed_branches_lens_mean"][-1]   = summed_lengths.average()
+        outputs["summed_branches_lens_med"][-1]    = summed_lengths.median()
+        outputs["summed_branches_lens_stdevp"][-1] = summed_lengths.pstdev()
 
         # Create/append results to a ResultsTable...
         if verbose:
@@ -350,6 +649,9 @@ def run():
 
         # rt.show("Mito Morphology") # Do not show in headless mode
 
+        if table is not None:
+            table.write(outputs, component_branches, component_lengths)
+
         # Delete to save memory
         del graphs
         del skeleton
@@ -362,6 +664,7 @@ def run():
         del imp_channel
         del imp_title
         del img
+        imp.flush() # Release the pixels now that the image is analyzed
 
         
 
@@ -431,6 +734,9 @@ def run():
         if verbose:
             IJ.log("Done analysis!")
 
+    if table is not None:
+        table.close()
+
     return outputs
 
 # Run the script...
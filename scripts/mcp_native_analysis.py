@@ -0,0 +1,186 @@
+'''
+Native (JVM-free) counterpart of mcp_fiji_analysis.py.
+
+Reads the skeleton images with scikit-image, thresholds and skeletonizes
+them and analyzes the skeleton graph with NumPy/SciPy, with the skeleton
+analysis of the MinaAnalysis plugin (cellprofiler/mina_skeleton.py). The
+images are thresholded with the ports of ImageJ's methods of the
+MultiThreshold plugin (cellprofiler/auto_threshold.py), so every
+thresholding op of the macro gives the same binary image. The outputs use
+the same names as the Fiji macro so mcp_batch can treat both engines
+alike.
+'''
+
+import os
+import sys
+
+import numpy as np
+import skimage.io
+from skimage.morphology import skeletonize
+
+try:
+    import tifffile
+except ImportError:
+    try:
+        from skimage.external import tifffile # Bundled with scikit-image < 0.17
+    except ImportError:
+        tifffile = None
+
+# The skeleton analysis and the thresholding methods are shared with the
+# MinaAnalysis and MultiThreshold plugins
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cellprofiler'))
+from mina_skeleton import analyze_skeleton
+from auto_threshold import METHODS as THRESHOLD_METHODS, ImageHistogram, threshold_bin
+
+# Bins of the histogram of ImageJ's threshold ops, over the range of the image
+THRESHOLD_BINS = 256
+
+
+# Helper functions..............................................................
+def average(values):
+    return float(np.mean(values)) if len(values) > 0 else 0.0
+
+def median(values):
+    return float(np.median(values)) if len(values) > 0 else 0.0
+
+def pstdev(values):
+    return float(np.std(values)) if len(values) > 0 else 0.0
+
+def threshold(image, threshold_method):
+    '''Binarizes an image like one of the macro's thresholding ops: the
+    pixels above the method's threshold bin.'''
+    if threshold_method not in THRESHOLD_METHODS:
+        raise ValueError('Unknown thresholding op "%s" (choose from %s)'
+                         % (threshold_method, ', '.join(sorted(THRESHOLD_METHODS))))
+    histogram = ImageHistogram(image, THRESHOLD_BINS)
+    return histogram.binarize(threshold_bin(threshold_method, histogram.counts))
+
+def read_spacing(ipath):
+    '''Returns the (z, y, x) pixel spacing of an image calibrated in ImageJ,
+    or None if it is not calibrated.
+
+    Like Fiji, the spacing is read from the resolution tags of the TIFF and
+    the unit and z spacing ImageJ saves in its description. Images without
+    an ImageJ unit (or that are not TIFFs) are measured in pixels.
+    '''
+    if tifffile is None:
+        return None
+
+    try:
+        with tifffile.TiffFile(ipath) as tif:
+            metadata = tif.imagej_metadata or {}
+            tags     = tif.pages[0].tags
+            if metadata.get('unit') in (None, '', 'pixel', 'pixels') or 'XResolution' not in tags:
+                return None
+
+            x_num, x_den = tags['XResolution'].value
+            y_num, y_den = tags['YResolution'].value if 'YResolution' in tags else (x_num, x_den)
+            if x_num == 0 or y_num == 0:
+                return None
+            return float(metadata.get('spacing', 1.0)), float(y_den) / y_num, float(x_den) / x_num
+    except Exception:
+        return None
+
+def analyze_image(image, threshold_method='otsu', spacing=None):
+    '''Computes the MiNA outputs of a single image (2D, or a 3D stack).
+
+    With the (z, y, x) pixel spacing, lengths and the footprint are
+    calibrated like Fiji does for calibrated images, otherwise they are in
+    pixels.
+    '''
+    outputs = {}
+
+    binary = threshold(image, threshold_method)
+    size   = float(np.prod(spacing[-binary.ndim:])) if spacing is not None else 1.0
+    outputs['mitochondrial_footprint'] = float(np.count_nonzero(binary) * size)
+
+    # Stacks are skeletonized and analyzed as volumes, like the macro does
+    skel = analyze_skeleton(skeletonize(binary, method='lee'), spacing)
+
+    branch_counts  = skel['component_branches']
+    summed_lengths = skel['component_lengths']
+    branch_lengths = skel['branch_lengths']
+
+    rods     = branch_counts == 1
+    networks = branch_counts > 1
+
+    rod_lens         = summed_lengths[rods]
+    network_lens     = summed_lengths[networks]
+    network_branches = int(branch_counts[networks].sum())
+
+    punctates, n_rods, n_networks = int(np.count_nonzero(branch_counts == 0)), len(rod_lens), len(network_lens)
+    n_total = punctates + n_rods + n_networks
+
+    outputs['punctate_count'] = punctates
+
+    outputs['rod_count']       = n_rods
+    outputs['rod_lens_mean']   = average(rod_lens)
+    outputs['rod_lens_med']    = median(rod_lens)
+    outputs['rod_lens_stdevp'] = pstdev(rod_lens)
+
+    outputs['network_count']              = n_networks
+    outputs['network_num_branches_count'] = network_branches
+    outputs['network_num_branches_mean']  = float(network_branches) / n_networks if n_networks > 0 else 0.0
+    outputs['network_branch_lens_mean']   = float(network_lens.sum()) / network_branches if network_branches > 0 else 0.0
+    outputs['network_lens_mean']   = average(network_lens)
+    outputs['network_lens_median'] = median(network_lens)
+    outputs['network_lens_stdevp'] = pstdev(network_lens)
+
+    # Caluculate percentage paramters
+    outputs['punctate_pct'] = 100.0 * punctates / n_total if n_total > 0 else 0.0
+    outputs['rod_pct']      = 100.0 * n_rods / n_total if n_total > 0 else 0.0
+    outputs['network_pct']  = 100.0 * n_networks / n_total if n_total > 0 else 0.0
+
+    summed_lengths = summed_lengths[summed_lengths > 0.0] # Eliminate punctates
+
+    outputs['all_branches']             = len(branch_lengths)
+    outputs['all_branches_lens_mean']   = average(branch_lengths)
+    outputs['all_branches_lens_med']    = median(branch_lengths)
+    outputs['all_branches_lens_stdevp'] = pstdev(branch_lengths)
+
+    outputs['summed_branches_lens_mean']   = average(summed_lengths)
+    outputs['summed_branches_lens_med']    = median(summed_lengths)
+    outputs['summed_branches_lens_stdevp'] = pstdev(summed_lengths)
+
+    # Per-skeleton branch counts and the branch lengths grouped by
+    # skeleton, for the component table
+    order = np.argsort(skel['branch_components'], kind='stable')
+    outputs['component_branches'] = branch_counts.tolist()
+    outputs['branch_lengths']     = branch_lengths[order].tolist()
+
+    return outputs
+
+# The run function..............................................................
+def run(image_paths, threshold_method='otsu', verbose=False):
+    '''Analyzes every image in image_paths.
+
+    Returns a dict of lists (one entry per image that could be read and
+    analyzed), keyed by the output names of the Fiji macro. An image that
+    fails is reported and skipped, so it does not stop the batch.
+    '''
+    outputs = {}
+
+    for ipath in image_paths:
+        try:
+            image = skimage.io.imread(ipath)
+        except (IOError, ValueError) as e:
+            print('Could not read', ipath, ':', e)
+            continue
+
+        if verbose:
+            print('Analyzing', ipath)
+
+        try:
+            image_outputs = analyze_image(image, threshold_method, read_spacing(ipath))
+        except Exception as e:
+            print('Could not analyze', ipath, ':', type(e).__name__, e)
+            continue
+        image_outputs['image_path']          = ipath
+        image_outputs['image_title']         = os.path.basename(ipath)
+        image_outputs['thresholding_op']     = threshold_method
+        image_outputs['use_ridge_detection'] = str(False)
+
+        for k, v in image_outputs.items():
+            outputs.setdefault(k, []).append(v)
+
+    return outputs
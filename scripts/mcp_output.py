@@ -0,0 +1,208 @@
+'''
+Crash-safe, incremental writing of the MitoCellPhe output CSV.
+
+Rows are appended to the CSV as each chunk of images completes, and every
+chunk is committed to an append-only journal next to the output
+("<output>.journal") once its rows are durably on disk. The journal is a
+text file of tab-separated records:
+
+    H <run settings as JSON>      first line, identifies the run
+    P <image path>                an image of the chunk being committed
+    C <CSV size> <row count>      commits the P records above it
+
+A rerun with the same settings truncates the CSV to the last committed
+size and skips the committed images, so an interrupted run resumes where
+it stopped. The journal is removed once the run completes.
+'''
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+# Skeleton classes of the component table, by number of branches (0, 1, 2+)
+COMPONENT_CLASSES = ['punctate', 'rod', 'network']
+
+
+class JournaledCSVWriter:
+    '''Appends DataFrame chunks to a CSV, journaling which images they cover.
+
+    Parameters:
+        output_path: string
+            - Path of the output .csv file.
+        run_info:    dict
+            - The settings of the run. An existing journal is only resumed
+              if it was written with the same settings, otherwise the
+              output is started over.
+    '''
+
+    def __init__(self, output_path, run_info):
+        self.output_path  = output_path
+        self.journal_path = output_path + '.journal'
+        self.header       = 'H\t' + json.dumps(run_info, sort_keys=True)
+        self.completed    = set() # Images of the committed chunks
+        self.rows         = 0     # Rows in the committed chunks
+        self.chunks       = 0     # Number of committed chunks
+
+        size, journal_size = self._recover()
+        if size is not None:
+            self.output = open(self.output_path, 'r+b')
+            self.output.truncate(size)
+            self.output.seek(size)
+
+            self.journal = open(self.journal_path, 'r+b')
+            self.journal.truncate(journal_size)
+            self.journal.seek(journal_size)
+        else:
+            self.output  = open(self.output_path, 'wb')
+            self.journal = open(self.journal_path, 'wb')
+            self._commit(self.journal, self.header + '\n')
+
+    def _recover(self):
+        '''Reads the committed state of an existing journal for this run.
+
+        Returns the committed CSV and journal sizes, or (None, None) if
+        there is nothing to resume.
+        '''
+        if not (os.path.isfile(self.journal_path) and os.path.isfile(self.output_path)):
+            return None, None
+
+        with open(self.journal_path, 'rb') as f:
+            lines = f.read().split(b'\n')
+
+        if lines[0].decode('utf-8', 'surrogateescape') != self.header:
+            return None, None
+
+        size, journal_size = None, len(lines[0]) + 1
+        position = journal_size
+        pending  = []
+
+        # The last element is whatever follows the final newline (a torn
+        # record, or nothing), so it is never part of a commit.
+        for line in lines[1:-1]:
+            position += len(line) + 1
+            fields = line.decode('utf-8', 'surrogateescape').split('\t')
+            if fields[0] == 'P':
+                pending.append(fields[1])
+            elif fields[0] == 'C':
+                size, self.rows = int(fields[1]), int(fields[2])
+                self.chunks += 1
+                self.completed.update(pending)
+                pending = []
+                journal_size = position
+
+        if size is None:
+            return 0, journal_size
+        if os.path.getsize(self.output_path) < size:
+            # The output does not match its journal, so do not trust either
+            self.completed, self.rows, self.chunks = set(), 0, 0
+            return None, None
+        return size, journal_size
+
+    @staticmethod
+    def _commit(f, text):
+        f.write(text.encode('utf-8', 'surrogateescape'))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def write(self, df, image_paths):
+        '''Appends the rows of df, which cover image_paths, and commits them.'''
+        if len(df) > 0:
+            self._commit(self.output, df.to_csv(header=(self.rows == 0)))
+            self.rows += len(df)
+
+        records = ''.join(f'P\t{path}\n' for path in image_paths)
+        self._commit(self.journal, records + f'C\t{self.output.tell()}\t{self.rows}\n')
+        self.completed.update(image_paths)
+        self.chunks += 1
+
+    def close(self):
+        self.output.close()
+        self.journal.close()
+
+    def finish(self):
+        '''Marks the run as complete, so the next run starts a new output.'''
+        os.remove(self.journal_path)
+
+
+class ComponentTableWriter:
+    '''Writes the per-skeleton (component) table of a run as one NPZ file.
+
+    The table has one entry per skeleton of every output row:
+
+        image          - index of the image's row in the output CSV
+        component      - index of the skeleton within its image
+        branches       - number of branches of the skeleton
+        summed_length  - summed length of its branches
+        class          - index into class_names (punctate, rod, network)
+        branch_lengths - length of every branch, grouped by skeleton; the
+                         branches of skeleton i are
+                         branch_lengths[branch_offsets[i]:branch_offsets[i + 1]]
+        image_titles   - title of each output row
+
+    Each committed chunk is saved as a part file in "<path>.parts" first, so
+    the parts of an interrupted run are kept for the rerun, and finish()
+    joins them into the final file.
+
+    Parameters:
+        path:       string
+            - Path of the .npz file.
+        first_part: int
+            - Index of the next chunk. Parts from that index on belong to
+              chunks that were never committed and are removed.
+    '''
+
+    def __init__(self, path, first_part):
+        self.path      = path
+        self.parts_dir = path + '.parts'
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+        for name in os.listdir(self.parts_dir):
+            if int(name.split('.')[0]) >= first_part:
+                os.remove(os.path.join(self.parts_dir, name))
+
+    def write(self, part, outputs, first_index, pix_to_um_scale):
+        '''Saves the skeletons of a chunk\'s outputs (a dict of lists), whose
+        rows start at first_index in the output CSV.'''
+        counts  = outputs.get('component_branches', [])
+        lengths = outputs.get('branch_lengths', [])
+
+        branches = np.array([n for image in counts for n in image], dtype=np.int32)
+        branch_lengths = np.array([l for image in lengths for l in image], dtype=np.float64) / pix_to_um_scale
+
+        owners  = np.repeat(np.arange(len(branches)), branches)
+        summed  = np.bincount(owners, weights=branch_lengths, minlength=len(branches))
+
+        np.savez(os.path.join(self.parts_dir, f'{part:08d}.npz'),
+                 image=np.repeat(np.arange(first_index, first_index + len(counts)),
+                                 [len(image) for image in counts]),
+                 component=np.array([i for image in counts for i in range(len(image))], dtype=np.int32),
+                 branches=branches,
+                 summed_length=summed,
+                 branch_lengths=branch_lengths,
+                 image_titles=np.array(outputs.get('image_title', []), dtype=str))
+
+    def finish(self):
+        '''Joins the parts into the final table and removes them.'''
+        parts = [np.load(os.path.join(self.parts_dir, name))
+                 for name in sorted(os.listdir(self.parts_dir))]
+
+        def join(key, dtype):
+            return np.concatenate([part[key] for part in parts] + [np.empty(0, dtype=dtype)])
+
+        branches = join('branches', np.int32)
+        np.savez_compressed(self.path,
+                            image=join('image', np.int64),
+                            component=join('component', np.int32),
+                            branches=branches,
+                            summed_length=join('summed_length', np.float64),
+                            **{'class': np.minimum(branches, 2).astype(np.int8)},
+                            class_names=np.array(COMPONENT_CLASSES),
+                            branch_lengths=join('branch_lengths', np.float64),
+                            branch_offsets=np.concatenate(([0], np.cumsum(branches, dtype=np.int64))),
+                            image_titles=join('image_titles', str))
+
+        for part in parts:
+            part.close()
+        shutil.rmtree(self.parts_dir)
@@ -0,0 +1,199 @@
+'''
+Directory scanner shared by mcp_batch, count_cells and the Fiji macro.
+
+Walks a tree with os.scandir and can keep the listing in a manifest file,
+so a rerun only lists the directories that changed since the last scan.
+Adding, removing or renaming an entry updates its directory's mtime, so a
+directory whose mtime is unchanged is taken from the manifest as is (one
+stat per directory instead of a listing). The sizes and mtimes of files
+are those of the last time their directory was listed.
+
+Directories can be visited by a pool of threads, which hides the latency
+of networked filesystems. walk() streams the directories as they are
+visited, and iter_files() streams the matches in sorted order, each as
+soon as the directories sorting before it have been listed.
+
+The manifest is a text file of JSON lines: a header
+
+    {"format": "mcp-manifest", "version": 1, "root": <root path>}
+
+followed by one line per directory
+
+    [<directory path>, <mtime (ns)>, [<subdirectory names>], [[<file name>, <size>, <mtime (ns)>], ...]]
+
+It only needs the json module to read, so the macro (Jython) consumes it too.
+'''
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+MANIFEST_FORMAT  = 'mcp-manifest'
+MANIFEST_VERSION = 1
+
+# Directories modified this close (ns) to the scan may still be changing
+# within their mtime's resolution, so they are listed again next time.
+SETTLE_TIME = 2 * 10**9
+
+
+def _list_directory(dir_path, mtime, started):
+    '''Lists a directory, returning its manifest entry.'''
+    subdirs, files = [], []
+    try:
+        entries = list(os.scandir(dir_path))
+    except OSError as e:
+        print('Could not list', dir_path, ':', e)
+        return [dir_path, -1, subdirs, files]
+
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                # Like os.walk, links to directories are not followed
+                if not entry.is_symlink():
+                    subdirs.append(entry.name)
+                continue
+            stat = entry.stat()
+        except OSError:
+            continue # i.e. a broken link or a file removed meanwhile
+        files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+
+    if mtime >= started - SETTLE_TIME:
+        mtime = -1
+    return [dir_path, mtime, subdirs, files]
+
+
+def read_manifest(manifest_path, root_path):
+    '''Returns the directory entries of a manifest keyed by path, or an empty
+    dict if there is no manifest for root_path.'''
+    if manifest_path is None or not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        try:
+            header = json.loads(f.readline())
+            if header != {'format': MANIFEST_FORMAT, 'version': MANIFEST_VERSION, 'root': root_path}:
+                return {}
+            return {entry[0]: entry for entry in map(json.loads, f)}
+        except ValueError:
+            print('Ignoring the unreadable manifest', manifest_path)
+            return {}
+
+
+def write_manifest(manifest_path, root_path, tree):
+    '''Atomically replaces the manifest with the directory entries of tree.'''
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        header = {'format': MANIFEST_FORMAT, 'version': MANIFEST_VERSION, 'root': root_path}
+        f.write(json.dumps(header) + '\n')
+        for entry in tree.values():
+            f.write(json.dumps(entry) + '\n')
+    os.replace(temp_path, manifest_path)
+
+
+def _walk_entries(root_path, manifest_path=None, threads=1):
+    '''Walks the tree under root_path like walk(), yielding the manifest
+    entry of every directory.'''
+    started  = time.time_ns()
+    manifest = read_manifest(manifest_path, root_path)
+    tree     = {}
+    listed   = 0
+
+    def visit(dir_path):
+        '''Returns the entry of a directory and whether it was listed.'''
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return None, False
+
+        entry = manifest.get(dir_path)
+        if entry is not None and entry[1] == mtime:
+            return entry, False
+        return _list_directory(dir_path, mtime, started), True
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        running = {pool.submit(visit, root_path)}
+        while running:
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                entry, fresh = future.result()
+                if entry is None:
+                    continue
+
+                dir_path, _, subdirs, files = entry
+                running.update(pool.submit(visit, os.path.join(dir_path, name)) for name in subdirs)
+
+                tree[dir_path] = entry
+                listed += fresh
+                yield entry
+
+    if manifest_path is not None and (listed > 0 or len(tree) != len(manifest)):
+        write_manifest(manifest_path, root_path, tree)
+
+
+def walk(root_path, manifest_path=None, threads=1):
+    '''Walks the tree under root_path, visiting `threads` directories at a time.
+
+    Yields (directory path, files) for every directory as soon as it is
+    visited, in no particular order. Directory paths are joined onto
+    root_path (as with os.walk) and files are lists of [name, size, mtime
+    (ns)]. If manifest_path is given, unchanged directories are read from
+    it and the manifest is updated once the walk is over.
+    '''
+    for dir_path, _, _, files in _walk_entries(root_path, manifest_path, threads):
+        yield dir_path, files
+
+
+def scan(root_path, manifest_path=None, threads=1):
+    '''Scans the tree under root_path.
+
+    Returns a dict mapping every directory path to the list of its files
+    (see walk()).
+    '''
+    return dict(walk(root_path, manifest_path, threads))
+
+
+def iter_files(root_path, regex_str, manifest_path=None, threads=1):
+    '''Yields the paths of the files under root_path whose name matches
+    regex_str, in sorted order (the order of find_files()).
+
+    The directories are visited as by walk(), and every path is yielded as
+    soon as the directories of the paths sorting before it are listed.
+    Within a directory, files sort by their name and subdirectories by
+    their name and a separator, which is where all of their paths sort.
+    '''
+    rgx     = re.compile(regex_str)
+    entries = _walk_entries(root_path, manifest_path, threads)
+    listed  = {}                   # Directory path -> entry, until it is reached
+    pending = [(root_path, False)] # (path, is a file), the next one last
+
+    while pending:
+        path, is_file = pending.pop()
+        if is_file:
+            yield path
+            continue
+
+        # Directories that could not be listed never come, and are empty
+        while path not in listed and entries is not None:
+            entry = next(entries, None)
+            if entry is None:
+                entries = None
+            else:
+                listed[entry[0]] = entry
+        _, _, subdirs, files = listed.pop(path, [path, -1, [], []])
+
+        children  = [(name, name, True) for name, _, _ in files if rgx.match(name)]
+        children += [(name + os.sep, name, False) for name in subdirs]
+        for _, name, child_is_file in sorted(children, reverse=True):
+            pending.append((os.path.join(path, name), child_is_file))
+
+    # Finish the walk, so that the manifest is written
+    if entries is not None:
+        for _ in entries:
+            pass
+
+
+def find_files(root_path, regex_str, manifest_path=None, threads=1):
+    '''Returns the sorted paths of the files under root_path whose name matches regex_str.'''
+    return list(iter_files(root_path, regex_str, manifest_path, threads))
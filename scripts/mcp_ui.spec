@@ -4,7 +4,7 @@ block_cipher = None
 
 
 a = Analysis(['mcp_ui.py'],
-             pathex=['C:\\Users\\cbmol\\GitHub\\MitoCellPhe\\scripts'],
+             pathex=['C:\\Users\\cbmol\\GitHub\\MitoCellPhe\\scripts', 'C:\\Users\\cbmol\\GitHub\\MitoCellPhe\\cellprofiler'],
              binaries=[],
              datas=[],
              hiddenimports=[],
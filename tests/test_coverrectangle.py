@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy
+import pytest
+
+pytest.importorskip("cellprofiler.setting")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cellprofiler"))
+import coverrectangle
+
+
+def test_cover_nothing_returns_a_writeable_copy():
+    pixels = numpy.zeros((5, 6))
+    template = numpy.zeros((5, 6), dtype=bool)
+
+    covered = coverrectangle.cover(pixels, template, 1.0)
+
+    # A later module writing into the output in place must not fail, nor
+    # change the input image
+    covered[0, 0] = 3.0
+    assert covered[0, 0] == 3.0
+    assert pixels[0, 0] == 0.0
+
+
+def test_cover_copies_unless_in_place():
+    pixels = numpy.zeros((5, 6))
+    template = coverrectangle.compile_template((5, 6), rectangles=[((1, 2), (3, 4))])
+
+    covered = coverrectangle.cover(pixels, template, 1.0)
+    assert covered.sum() == 4
+    assert pixels.sum() == 0
+
+    covered = coverrectangle.cover(pixels, template, 1.0, in_place=True)
+    assert covered is pixels
+    assert pixels.sum() == 4
+
+
+def test_cover_read_only_in_place_covers_a_copy():
+    pixels = numpy.zeros((5, 6))
+    pixels.flags.writeable = False
+    template = coverrectangle.compile_template((5, 6), rectangles=[((0, 0), (1, 1))])
+
+    covered = coverrectangle.cover(pixels, template, 1.0, in_place=True)
+    assert covered[0, 0] == 1.0
+    assert pixels[0, 0] == 0.0
+
+
+def test_vertices_are_row_column():
+    template = coverrectangle.compile_template(
+        (5, 6), polygons=[coverrectangle.parse_vertices("0,0; 0,5; 4,0")]
+    )
+
+    # The second vertex is on the first row, five columns in
+    assert template[0, 5]
+    assert not template[4, 5]
+
+    with pytest.raises(ValueError, match="row,column"):
+        coverrectangle.parse_vertices("1;2")